@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Program alignment - detection of actual program boundaries within a recording, by
+matching reference clips (e.g. station ID or theme music) against the recorded audio
+
+Reference clips are specified per program (``align`` entry in the program config, with
+``start_clip`` and/or ``end_clip``).  The start clip is searched for in the first
+``search`` seconds of the recording, and the end clip in the last ``search`` seconds, by
+normalized cross-correlation (computed via FFT) on audio decoded at a low sample rate.
+The recording is decoded in a single streaming pass, keeping only the head and tail
+windows in memory.  Detected boundaries are recorded as trim points (``trim_start`` is the
+start of the start clip, ``trim_end`` the end of the end clip) in the catalog.
+"""
+
+import os
+from collections import deque
+
+import numpy as np
+
+from core import BASE_DIR, cfg, log
+from utils import truthy
+from audio import pcm_chunks
+import catalog
+
+##########
+# config #
+##########
+
+ALIGN_DFLTS = {'enabled'  : False,
+               'pcm_rate' : 2000,   # samples/sec (downsampled for matching)
+               'search'   : 900,    # secs (at start and end of recording)
+               'min_score': 0.5}    # normalized correlation (0.0-1.0)
+
+def align_params(cfg_profile = None):
+    """Get alignment parameters (config overlaid on defaults)
+
+    :param cfg_profile: optional (None means ``default``)
+    :return: dict
+    """
+    params = dict(ALIGN_DFLTS)
+    params.update(cfg.config('analysis', cfg_profile).get('align') or {})
+    return params
+
+def clip_path(path):
+    """
+    :param path: pathname of reference clip (absolute, or relative to project)
+    :return: str
+    """
+    return path if path[0] in ('/.') else os.path.join(BASE_DIR, path)
+
+#####################
+# cross-correlation #
+#####################
+
+# decoded reference clips, keyed by (path, rate), with file mtime
+clip_cache = {}
+
+def load_clip(path, rate):
+    """
+    :param path: pathname of reference clip
+    :param rate: PCM decoding rate
+    :return: np.ndarray (float64)
+    """
+    path = clip_path(path)
+    mtime = os.path.getmtime(path)
+    cached = clip_cache.get((path, rate))
+    if cached and cached[0] == mtime:
+        return cached[1]
+    clip = np.concatenate(list(pcm_chunks(path, rate)) or [np.empty(0, dtype=np.int16)])
+    clip = clip.astype(np.float64)
+    clip_cache[(path, rate)] = (mtime, clip)
+    return clip
+
+def find_clip(signal, clip):
+    """Find best match for clip in signal, by normalized cross-correlation (insensitive to
+    level differences); all offsets are evaluated at once, via FFT
+
+    :param signal: np.ndarray (PCM samples)
+    :param clip: np.ndarray (PCM samples, same rate)
+    :return: tuple (offset in samples, score), or (None, 0.0) if no match possible
+    """
+    m, n = clip.size, signal.size
+    if m == 0 or n < m:
+        return None, 0.0
+    x = signal.astype(np.float64)
+    c = clip - clip.mean()
+    c_norm = np.sqrt(np.dot(c, c))
+    if c_norm == 0.0:
+        return None, 0.0
+    nfft = 1 << (n + m - 1).bit_length()
+    corr = np.fft.irfft(np.fft.rfft(x, nfft) * np.conj(np.fft.rfft(c, nfft)), nfft)[:n - m + 1]
+    # energy of signal (about its mean) in each window of clip length
+    csum = np.concatenate(([0.0], np.cumsum(x)))
+    csum2 = np.concatenate(([0.0], np.cumsum(x * x)))
+    win_sum = csum[m:] - csum[:-m]
+    win_var = (csum2[m:] - csum2[:-m]) - win_sum * win_sum / m
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ncc = corr / (np.sqrt(np.maximum(win_var, 0.0)) * c_norm)
+    ncc = np.nan_to_num(ncc, nan=0.0, posinf=0.0, neginf=0.0)
+    # guard against spurious matches on (near-)silence
+    ncc[win_var < 1e-6 * m] = 0.0
+    best = int(ncc.argmax())
+    return best, float(ncc[best])
+
+def head_tail(path, rate, search):
+    """Decode recording (single pass), keeping only the first and last ``search`` secs
+
+    :param path: pathname of recording
+    :param rate: PCM decoding rate
+    :param search: secs
+    :return: tuple (head, tail, total samples)
+    """
+    limit = int(search * rate)
+    head = []
+    head_len = 0
+    tail = deque()
+    tail_len = 0
+    total = 0
+    for chunk in pcm_chunks(path, rate):
+        total += chunk.size
+        if head_len < limit:
+            head.append(chunk[:limit - head_len])
+            head_len += head[-1].size
+        tail.append(chunk)
+        tail_len += chunk.size
+        while tail and tail_len - tail[0].size >= limit:
+            tail_len -= tail.popleft().size
+    empty = np.empty(0, dtype=np.int16)
+    head = np.concatenate(head) if head else empty
+    tail = np.concatenate(tail)[-limit:] if tail else empty
+    return head, tail, total
+
+def align_recording(path, start_clip = None, end_clip = None, cfg_profile = None, **kwargs):
+    """Detect program boundaries in recording
+
+    :param path: pathname of recording
+    :param start_clip: [optional] pathname of reference clip marking program start
+    :param end_clip: [optional] pathname of reference clip marking program end
+    :param cfg_profile: optional (None means ``default``)
+    :param kwargs: overrides for parameters in the ``analysis.align`` config
+    :return: dict (JSON-serializable) with ``trim_start`` and ``trim_end`` (secs, or None
+             if not detected), and match scores
+    """
+    params = align_params(cfg_profile)
+    params.update(kwargs)
+    rate = params['pcm_rate']
+    head, tail, total = head_tail(path, rate, params['search'])
+    result = {'duration': total / rate, 'trim_start': None, 'trim_end': None}
+    if start_clip:
+        offset, score = find_clip(head, load_clip(start_clip, rate))
+        result['start_score'] = round(score, 3)
+        if offset is not None and score >= params['min_score']:
+            result['trim_start'] = round(offset / rate, 3)
+    if end_clip:
+        clip = load_clip(end_clip, rate)
+        offset, score = find_clip(tail, clip)
+        result['end_score'] = round(score, 3)
+        if offset is not None and score >= params['min_score']:
+            result['trim_end'] = round((total - tail.size + offset + clip.size) / rate, 3)
+    log.debug("Alignment for \"%s\": %s" % (path, result))
+    return result
+
+def align_recordings(recordings, align_cfg, cfg_profile = None):
+    """Align recordings for a program run, and record trim points in the catalog (invoked
+    as a background job); for a run with multiple segments, the start clip is matched in
+    the first segment and the end clip in the last
+
+    :param recordings: list of (pathname, recording ID) tuples, in order
+    :param align_cfg: ``align`` entry from program config (``start_clip``, ``end_clip``)
+    :param cfg_profile: optional (None means ``default``)
+    :return: list of alignment results
+    """
+    results = []
+    last = len(recordings) - 1
+    for i, (path, rec_id) in enumerate(recordings):
+        start_clip = align_cfg.get('start_clip') if i == 0 else None
+        end_clip = align_cfg.get('end_clip') if i == last else None
+        if not (start_clip or end_clip):
+            continue
+        try:
+            result = align_recording(path, start_clip, end_clip, cfg_profile)
+        except Exception as e:
+            log.info("Could not align \"%s\": %s" % (path, e))
+            continue
+        results.append(result)
+        if catalog.catalog and rec_id is not None:
+            catalog.catalog.update_recording(rec_id, trim_start=result['trim_start'],
+                                             trim_end=result['trim_end'])
+    return results
+
+def align_enabled(cfg_profile = None):
+    """
+    :param cfg_profile: optional (None means ``default``)
+    :return: bool
+    """
+    return truthy(align_params(cfg_profile)['enabled'])
+
+#####################
+# command line tool #
+#####################
+
+import click
+
+@click.command()
+@click.option('--start',     default=None, help="Reference clip marking program start")
+@click.option('--end',       default=None, help="Reference clip marking program end")
+@click.option('--search',    default=ALIGN_DFLTS['search'], help="Secs to search at each end")
+@click.option('--min_score', default=ALIGN_DFLTS['min_score'], help="Match threshold (0.0-1.0)")
+@click.option('--profile',   default=None, help="Config profile (for analysis parameters)")
+@click.argument('path',      required=True)
+def main(start, end, search, min_score, profile, path):
+    """Detect program boundaries in recording, using reference clips
+    """
+    print(align_recording(path, start, end, profile, search=search, min_score=min_score))
+
+if __name__ == '__main__':
+    main()
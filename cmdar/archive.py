@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+"""Archive tier - background re-encoding of older recordings to a lower-bitrate profile
+
+The archive profile is defined per media type in the ``streamers`` config (``archive``
+entry under each media type).  Transcoding runs in a small pool of niced ``ffmpeg``
+processes, with a cap on input throughput, so that it never competes with live capture.
+The transcoded file replaces the original atomically (written to a temporary file in the
+same directory, then renamed), and the catalog entry is updated in the same step.
+"""
+
+import os
+import time
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from core import cfg, log
+from utils import truthy
+from audio import FFMPEG_CMD
+from seekindex import IDX_SUFFIX, FRAME_PARSERS, build_index
+from peaks import PEAKS_SUFFIX
+from checksum import HASH_SUFFIX, rehash
+from priority import PriorityClass, thread_initializer
+import priority
+import catalog
+
+##########
+# config #
+##########
+
+ARCHIVE_DFLTS = {'enabled'  : False,
+                 'min_age'  : 30,     # days
+                 'interval' : 3600,   # secs (between archive passes)
+                 'workers'  : 1,
+                 'nice'     : 19,
+                 'max_batch': 10,     # recordings per pass
+                 'max_failures': 3,   # attempts per recording (before giving up on it)
+                 'max_rate' : 0}      # bytes/sec of input (0 means unlimited)
+
+TMP_SUFFIX = '.archiving'
+
+# pathnames of recordings being transcoded (in this process)
+archiving = set()
+
+def archive_params(cfg_profile = None):
+    """Get archive parameters (config overlaid on defaults)
+
+    :param cfg_profile: optional (None means ``default``)
+    :return: dict
+    """
+    params = dict(ARCHIVE_DFLTS)
+    params.update(cfg.config('archive', cfg_profile))
+    return params
+
+def archive_profile(streamer, media_type, cfg_profile = None):
+    """
+    :param streamer: streamer name in config.yml
+    :param media_type: stream content-type (str)
+    :param cfg_profile: optional (None means ``default``)
+    :return: dict with archive profile (or None, if not defined)
+    """
+    info = cfg.config('streamers', cfg_profile).get(streamer, {})
+    media_info = info.get('media_types', {}).get(media_type, {})
+    return media_info.get('archive')
+
+def archive_media_types(streamer, cfg_profile = None):
+    """
+    :param streamer: streamer name in config.yml
+    :param cfg_profile: optional (None means ``default``)
+    :return: list of media types with an archive profile defined
+    """
+    info = cfg.config('streamers', cfg_profile).get(streamer, {})
+    return [media_type for media_type, media_info in info.get('media_types', {}).items()
+            if (media_info or {}).get('archive')]
+
+def archive_failed(rec):
+    """Record failed archive attempt for recording (see ``max_failures``)
+
+    :param rec: recording (dict from catalog)
+    """
+    catalog.catalog.update_recording(rec['id'],
+                                     archive_failures=(rec['archive_failures'] or 0) + 1)
+
+###############
+# transcoding #
+###############
+
+def transcode(path, profile, nice = 0):
+    """Re-encode recording to archive profile, replacing the original file
+
+    :param path: pathname of recording
+    :param profile: archive profile (dict with ``codec``, ``bitrate``, ``file_type``)
+    :param nice: niceness for ``ffmpeg`` process (overriding the ``archive`` priority class)
+    :return: pathname of archived recording
+    """
+    new_path = os.path.splitext(path)[0] + '.' + profile['file_type']
+    tmp_path = new_path + TMP_SUFFIX
+    args = [FFMPEG_CMD, '-nostdin', '-v', 'error', '-y', '-i', path, '-vn',
+            '-c:a', profile['codec'], '-b:a', str(profile['bitrate']), '-threads', '1',
+            '-f', profile.get('format', profile['file_type']), tmp_path]
+    log.debug("Archiving \"%s\", cmd = '%s'" % (path, ' '.join(args)))
+    try:
+        proc = priority.spawn(args, PriorityClass.ARCHIVE, nice or None,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        with proc.stderr:
+            stderr = proc.stderr.read()
+        if priority.wait(proc, PriorityClass.ARCHIVE) != 0:
+            raise subprocess.CalledProcessError(proc.returncode, args, stderr=stderr)
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, new_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return new_path
+
+def archive_recording(rec, profile, nice = 0):
+    """Transcode recording, and update catalog entry (and remove original file, if the
+    archive file type differs)
+
+    :param rec: recording (dict from catalog)
+    :param profile: archive profile
+    :param nice: niceness for ``ffmpeg`` process
+    :return: pathname of archived recording
+    """
+    path = rec['path']
+    archiving.add(path)
+    try:
+        new_path = transcode(path, profile, nice)
+    finally:
+        archiving.discard(path)
+    catalog.catalog.update_recording(rec['id'], path=new_path, size=os.path.getsize(new_path),
+                                     archived=profile.get('name', str(profile['bitrate'])),
+                                     sha256=rehash(new_path))
+    if new_path != path:
+        os.remove(path)
+        if os.path.exists(path + HASH_SUFFIX):
+            os.remove(path + HASH_SUFFIX)
+        if os.path.exists(path + PEAKS_SUFFIX):
+            os.replace(path + PEAKS_SUFFIX, new_path + PEAKS_SUFFIX)
+    # offsets in the seek index are no longer valid
+    if os.path.exists(path + IDX_SUFFIX):
+        os.remove(path + IDX_SUFFIX)
+    if os.path.splitext(new_path)[1].lower() in FRAME_PARSERS:
+        build_index(new_path)
+    log.info("Archived \"%s\" as \"%s\"" % (path, new_path))
+    return new_path
+
+def run_archive(streamer, cfg_profile = None):
+    """Archive pass: transcode a batch of recordings older than ``min_age`` (invoked as an
+    interval job by the scheduler)
+
+    :param streamer: streamer name in config.yml
+    :param cfg_profile: optional (None means ``default``)
+    :return: number of recordings archived
+    """
+    if not catalog.catalog:
+        return 0
+    params = archive_params(cfg_profile)
+    media_types = archive_media_types(streamer, cfg_profile)
+    if not media_types:
+        return 0
+    cutoff = time.time() - params['min_age'] * 86400
+    # recordings that keep failing (or have gone missing) are counted against
+    # ``max_failures``, so that they do not hold up the rest of the backlog
+    recs = catalog.catalog.get_recordings(created_before=cutoff, archived=False,
+                                          media_types=media_types,
+                                          max_failures=params['max_failures'],
+                                          limit=params['max_batch'])
+    todo = []
+    for rec in recs:
+        if rec['path'] in archiving:
+            continue
+        if not os.path.exists(rec['path']):
+            log.warning("Recording \"%s\" not found, skipping archive" % (rec['path']))
+            archive_failed(rec)
+            continue
+        todo.append((rec, archive_profile(streamer, rec['media_type'], cfg_profile)))
+    if not todo:
+        return 0
+
+    archived = 0
+    start = time.time()
+    in_bytes = 0
+    with ThreadPoolExecutor(params['workers'], thread_name_prefix='archive',
+                            initializer=thread_initializer(PriorityClass.ARCHIVE)) as pool:
+        futures = []
+        for rec, profile in todo:
+            # throttle: pace submissions so that input throughput stays under max_rate
+            if params['max_rate']:
+                ahead = in_bytes / params['max_rate'] - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+            in_bytes += rec['size'] or 0
+            futures.append((rec, pool.submit(archive_recording, rec, profile, params['nice'])))
+        for rec, future in futures:
+            try:
+                future.result()
+                archived += 1
+            except Exception as e:
+                log.error("Could not archive \"%s\": %s" % (rec['path'], e))
+                archive_failed(rec)
+    log.info("Archive pass: %d of %d recordings archived" % (archived, len(todo)))
+    return archived
+
+def start_archive(sched, jobstore, executor, streamer, cfg_profile = None):
+    """Schedule archive passes (no-op if not enabled)
+
+    :param sched: apscheduler handle
+    :param jobstore: job store alias (should be non-persistent)
+    :param executor: executor alias (should be separate from capture jobs)
+    :param streamer: streamer name in config.yml
+    :param cfg_profile: optional (None means ``default``)
+    """
+    params = archive_params(cfg_profile)
+    if not truthy(params['enabled']):
+        return
+    sched.add_job(run_archive, 'interval', seconds=params['interval'],
+                  args=(streamer, cfg_profile), id='archive', name='Archive pass',
+                  jobstore=jobstore, executor=executor, replace_existing=True, coalesce=True,
+                  max_instances=1)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+"""Audio analysis - decoding of recordings to PCM, and vectorized (NumPy) processing
+of the decoded signal
+"""
+
+import subprocess
+
+import numpy as np
+
+from core import cfg, log
+from priority import PriorityClass
+import priority
+
+################
+# PCM decoding #
+################
+
+FFMPEG_CMD     = 'ffmpeg'
+PCM_RATE       = 8000   # samples/sec (mono), plenty for loudness analysis
+PCM_CHUNK_SECS = 60
+PCM_FULL_SCALE = 32768.0
+
+def pcm_chunks(path, rate = PCM_RATE, chunk_secs = PCM_CHUNK_SECS):
+    """Decode audio file to mono 16-bit PCM, yielding one chunk at a time (so that
+    multi-hour recordings are never held in memory all at once)
+
+    :param path: pathname of recording (any format ffmpeg understands)
+    :param rate: sample rate to decode (resample) to
+    :param chunk_secs: size of yielded chunks, in seconds of audio
+    :return: generator of np.ndarray (int16)
+    """
+    args = [FFMPEG_CMD, '-nostdin', '-v', 'error', '-i', path,
+            '-f', 's16le', '-ac', '1', '-ar', str(rate), '-']
+    chunk_bytes = rate * chunk_secs * 2
+    proc = priority.spawn(args, PriorityClass.POSTPROC, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+    try:
+        while True:
+            data = proc.stdout.read(chunk_bytes)
+            if not data:
+                break
+            # guard against odd byte count on truncated input
+            yield np.frombuffer(data[:len(data) & ~1], dtype='<i2')
+    finally:
+        proc.stdout.close()
+        stderr = proc.stderr.read().decode(errors='replace')
+        proc.stderr.close()
+        priority.wait(proc, PriorityClass.POSTPROC)
+    if proc.returncode != 0:
+        raise RuntimeError("ffmpeg failed decoding \"%s\": %s" % (path, stderr.strip()))
+
+def rms_envelope(path, window, rate = PCM_RATE):
+    """Windowed RMS loudness of recording, in dBFS
+
+    :param path: pathname of recording
+    :param window: window size in seconds (float)
+    :param rate: PCM decoding rate
+    :return: np.ndarray (float32), one entry per window
+    """
+    win_len = max(int(window * rate), 1)
+    envs = []
+    carry = np.empty(0, dtype=np.int16)
+    for chunk in pcm_chunks(path, rate):
+        if carry.size:
+            chunk = np.concatenate((carry, chunk))
+        nwin = chunk.size // win_len
+        carry = chunk[nwin * win_len:]
+        if nwin == 0:
+            continue
+        frames = chunk[:nwin * win_len].astype(np.float32).reshape(nwin, win_len)
+        envs.append(np.sqrt(np.mean(frames * frames, axis=1)))
+    if not envs:
+        return np.empty(0, dtype=np.float32)
+    rms = np.concatenate(envs)
+    return (20.0 * np.log10(rms / PCM_FULL_SCALE + 1e-9)).astype(np.float32)
+
+######################
+# dead air detection #
+######################
+
+DEAD_AIR_DFLTS = {'pcm_rate'   : PCM_RATE,
+                  'window'     : 0.25,    # secs
+                  'silence_db' : -50.0,   # dBFS
+                  'min_silence': 30,      # secs
+                  'loop_min'   : 20,      # secs
+                  'loop_max'   : 300,     # secs
+                  'loop_corr'  : 0.95,
+                  'loop_tol'   : 0.05}
+
+def dead_air_params(cfg_profile = None):
+    """Get dead air detection parameters (config overlaid on defaults)
+
+    :param cfg_profile: optional (None means ``default``)
+    :return: dict
+    """
+    params = dict(DEAD_AIR_DFLTS)
+    params.update(cfg.config('analysis', cfg_profile).get('dead_air') or {})
+    return params
+
+def find_runs(mask):
+    """Find runs of True values in a boolean array
+
+    :param mask: np.ndarray (bool)
+    :return: np.ndarray of shape (n, 2), with [start, end) indexes for each run
+    """
+    edges = np.diff(np.concatenate(([False], mask, [False])).astype(np.int8))
+    return np.column_stack((np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+def find_silences(env, window, silence_db, min_silence):
+    """
+    :param env: RMS envelope in dBFS (see ``rms_envelope()``)
+    :param window: envelope window size (secs)
+    :param silence_db: loudness threshold for silence (dBFS)
+    :param min_silence: minimum length of silence to report (secs)
+    :return: list of [start, end] (secs)
+    """
+    runs = find_runs(env < silence_db)
+    runs = runs[(runs[:, 1] - runs[:, 0]) * window >= min_silence]
+    return (runs * window).tolist()
+
+def find_loops(env, window, loop_min, loop_max, loop_corr,
+               loop_tol = DEAD_AIR_DFLTS['loop_tol']):
+    """Detect repeating content (e.g. a station's fallback loop) by autocorrelation of the
+    loudness envelope, evaluated over consecutive segments of the recording (all segments
+    computed at once, via FFT)
+
+    A loop also correlates at multiples of its period (and the unbiased normalization
+    tends to favor longer lags), so the period reported is the shortest lag at a local
+    peak of the correlation within ``loop_tol`` of the highest peak.
+
+    :param env: RMS envelope in dBFS (see ``rms_envelope()``)
+    :param window: envelope window size (secs)
+    :param loop_min: shortest loop period to look for (secs)
+    :param loop_max: longest loop period to look for (secs)
+    :param loop_corr: normalized correlation threshold (0.0-1.0)
+    :param loop_tol: tolerance below the highest peak for shorter periods (0.0-1.0)
+    :return: list of [start, end, period] (secs)
+    """
+    lag_min = max(int(loop_min / window), 1)
+    lag_max = int(loop_max / window)
+    seg_len = lag_max * 3
+    nseg = env.size // seg_len
+    if nseg == 0 or lag_max <= lag_min:
+        return []
+
+    segs = env[:nseg * seg_len].reshape(nseg, seg_len).astype(np.float64)
+    segs -= segs.mean(axis=1, keepdims=True)
+    nfft = 1 << (2 * seg_len - 1).bit_length()
+    spec = np.fft.rfft(segs, nfft, axis=1)
+    acorr = np.fft.irfft(spec * np.conj(spec), nfft, axis=1)[:, :lag_max + 1]
+    energy = acorr[:, :1]
+    # unbiased normalization (correct for shrinking overlap at longer lags)
+    lags = np.arange(lag_max + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        norm = acorr / energy * (seg_len / (seg_len - lags))
+    norm = np.nan_to_num(norm[:, lag_min:lag_max + 1])
+    score = norm.max(axis=1)
+    padded = np.pad(norm, ((0, 0), (1, 1)), constant_values=-np.inf)
+    peaks = (norm >= padded[:, :-2]) & (norm >= padded[:, 2:])
+    best = (peaks & (norm >= score[:, None] - loop_tol)).argmax(axis=1)
+
+    loops = []
+    for seg in np.flatnonzero(score >= loop_corr):
+        start = float(seg * seg_len * window)
+        period = float((best[seg] + lag_min) * window)
+        if loops and loops[-1][1] == start and loops[-1][2] == period:
+            loops[-1][1] = start + seg_len * window
+        else:
+            loops.append([start, start + seg_len * window, period])
+    return loops
+
+def detect_dead_air(path, cfg_profile = None, **kwargs):
+    """Analyze recording for long silences and repeated-loop patterns
+
+    :param path: pathname of recording
+    :param cfg_profile: optional (None means ``default``)
+    :param kwargs: overrides for parameters in the ``analysis.dead_air`` config
+    :return: dict (JSON-serializable) with analysis results
+    """
+    params = dead_air_params(cfg_profile)
+    params.update(kwargs)
+    window = params['window']
+
+    env = rms_envelope(path, window, params['pcm_rate'])
+    silences = find_silences(env, window, params['silence_db'], params['min_silence'])
+    loops = find_loops(env, window, params['loop_min'], params['loop_max'], params['loop_corr'],
+                       params['loop_tol'])
+    result = {'duration'    : float(env.size * window),
+              'silences'    : silences,
+              'silence_secs': sum(e - s for s, e in silences),
+              'loops'       : loops,
+              'dead_air'    : bool(silences or loops)}
+    log.debug("Dead air analysis for \"%s\": %s" % (path, result))
+    return result
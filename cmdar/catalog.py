@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+"""Catalog - persistent record of job runs and recordings
+"""
+
+import os
+import json
+import time
+
+from sqlalchemy import (create_engine, MetaData, Table, Column, String, Integer, Float, Text,
+                        select, insert, update, delete, inspect, text, or_)
+
+from core import log
+
+##########
+# schema #
+##########
+
+metadata = MetaData()
+
+runs_tab = Table('runs', metadata,
+                 Column('id', Integer, primary_key=True, autoincrement=True),
+                 Column('run_id', String(64), nullable=False, unique=True),
+                 Column('job_id', String(191), index=True),
+                 Column('station', String(64)),
+                 Column('fire_time', Float),
+                 Column('started', Float, nullable=False, index=True),
+                 Column('ended', Float),
+                 Column('status', String(16), nullable=False),
+                 Column('path', Text),
+                 Column('spans', Text))  # JSON
+
+recordings_tab = Table('recordings', metadata,
+                       Column('id', Integer, primary_key=True, autoincrement=True),
+                       Column('path', Text, nullable=False, unique=True),
+                       Column('station', String(64), index=True),
+                       Column('job_id', String(191), index=True),
+                       Column('run_id', String(64)),
+                       Column('media_type', String(64)),
+                       Column('created', Float, nullable=False, index=True),
+                       Column('size', Integer),
+                       Column('archived', String(64)),  # archive profile (if transcoded)
+                       Column('trim_start', Float),     # secs (detected program boundaries,
+                       Column('trim_end', Float),       # see ``align.py``)
+                       Column('sha256', String(64)),    # content hash, see ``checksum.py``
+                       Column('archive_failures', Integer))  # failed archive attempts
+
+def add_columns(engine, tables = None):
+    """Add columns missing from existing tables (new columns must be nullable)
+
+    :param engine: sqlalchemy.engine.Engine
+    :param tables: [optional] list of tables (defaults to catalog tables)
+    """
+    with engine.begin() as conn:
+        insp = inspect(conn)
+        for table in tables or metadata.sorted_tables:
+            existing = {col['name'] for col in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name not in existing:
+                    log.info("Adding column \"%s\" to table \"%s\"" % (col.name, table.name))
+                    conn.execute(text('ALTER TABLE %s ADD COLUMN %s %s' %
+                                      (table.name, col.name,
+                                       col.type.compile(dialect=engine.dialect))))
+
+###########
+# Catalog #
+###########
+
+# catalog for the current process (set up by ``Dar``)
+catalog = None
+
+class Catalog(object):
+    """Persistent catalog of job runs
+    """
+    def __init__(self, db_url):
+        """
+        :param db_url: SQLAlchemy URL
+        """
+        self.db_url = db_url
+        self.engine = create_engine(db_url, connect_args={'check_same_thread': False}
+                                    if db_url.startswith('sqlite:') else {})
+        metadata.create_all(self.engine)
+        add_columns(self.engine)
+
+    def add_run(self, run):
+        """
+        :param run: run record (dict), see ``spans.Span.as_dict()``
+        """
+        with self.engine.begin() as conn:
+            conn.execute(insert(runs_tab).values(run_id=run['run_id'],
+                                                 job_id=run['job_id'],
+                                                 station=run.get('station'),
+                                                 fire_time=run['marks'].get('trigger'),
+                                                 started=run['marks']['dispatch'],
+                                                 ended=run.get('ended'),
+                                                 status=run['status'],
+                                                 path=run.get('path'),
+                                                 spans=json.dumps(run)))
+
+    def add_recording(self, path, station = None, job_id = None, run_id = None,
+                      media_type = None, sha256 = None):
+        """
+        :param path: pathname of recording
+        :param sha256: [optional] content hash (hex digest)
+        :return: recording ID (int)
+        """
+        size = os.path.getsize(path) if os.path.exists(path) else None
+        with self.engine.begin() as conn:
+            res = conn.execute(insert(recordings_tab).values(path=path, station=station,
+                                                             job_id=job_id, run_id=run_id,
+                                                             media_type=media_type,
+                                                             created=time.time(), size=size,
+                                                             sha256=sha256))
+        return res.inserted_primary_key[0]
+
+    def get_recording(self, rec_id):
+        """
+        :param rec_id: recording ID
+        :return: dict (or None, if not found)
+        """
+        with self.engine.connect() as conn:
+            row = conn.execute(select(recordings_tab)
+                               .where(recordings_tab.c.id == rec_id)).mappings().first()
+        return dict(row) if row else None
+
+    def get_recordings(self, station = None, job_id = None, created_before = None,
+                       archived = None, media_types = None, max_failures = None,
+                       limit = None):
+        """Query recordings (all criteria optional)
+
+        :param station: station name
+        :param job_id: scheduler job ID
+        :param created_before: epoch time
+        :param archived: bool (whether transcoded to archive profile)
+        :param media_types: list of media types
+        :param max_failures: exclude recordings with this many failed archive attempts
+        :param limit: max number of recordings
+        :return: list of dicts, oldest first
+        """
+        query = select(recordings_tab).order_by(recordings_tab.c.created)
+        if station:
+            query = query.where(recordings_tab.c.station == station)
+        if job_id:
+            query = query.where(recordings_tab.c.job_id == job_id)
+        if created_before:
+            query = query.where(recordings_tab.c.created < created_before)
+        if archived is not None:
+            query = query.where(recordings_tab.c.archived.isnot(None) if archived
+                                else recordings_tab.c.archived.is_(None))
+        if media_types is not None:
+            query = query.where(recordings_tab.c.media_type.in_(media_types))
+        if max_failures:
+            query = query.where(or_(recordings_tab.c.archive_failures.is_(None),
+                                    recordings_tab.c.archive_failures < max_failures))
+        if limit:
+            query = query.limit(limit)
+        with self.engine.connect() as conn:
+            return [dict(row) for row in conn.execute(query).mappings()]
+
+    def update_recording(self, rec_id, **values):
+        """
+        :param rec_id: recording ID
+        :param values: columns to update
+        """
+        with self.engine.begin() as conn:
+            conn.execute(update(recordings_tab)
+                         .where(recordings_tab.c.id == rec_id)
+                         .values(**values))
+
+    def delete_recording(self, rec_id):
+        """
+        :param rec_id: recording ID
+        """
+        with self.engine.begin() as conn:
+            conn.execute(delete(recordings_tab).where(recordings_tab.c.id == rec_id))
+
+    def get_runs(self, job_id, limit = 50):
+        """
+        :param job_id: scheduler job ID
+        :param limit: max number of runs to return
+        :return: list of run records (dicts), most recent first
+        """
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(runs_tab.c.spans)
+                                .where(runs_tab.c.job_id == job_id)
+                                .order_by(runs_tab.c.started.desc())
+                                .limit(limit)).scalars().all()
+        return [json.loads(row) for row in rows]
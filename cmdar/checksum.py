@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Checksums - content hashes for recordings, for detecting duplicates (e.g. reruns, or
+files copied between nodes) and corruption at rest
+
+The hash is computed incrementally while the recording is being written (the capture
+monitor thread feeds the bytes appended since the last sample, which are still in the
+page cache), so completing it does not require reading the file again.  This only holds
+for append-only formats (MP3 and ADTS AAC); MP4 files are patched by the muxer when the
+capture ends, so they are hashed on completion.
+
+The hash is written to a sidecar file (``<recording>.sha256``, in ``sha256sum`` format, so
+it travels with the recording and can be checked with ``sha256sum -c``), and stored in the
+catalog entry for the recording.  The command line tool verifies recordings against their
+stored hashes (bit rot) and reports duplicates, across all of ``rec_dir``.
+"""
+
+import os
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+
+from core import BASE_DIR, cfg, log
+from utils import truthy
+from seekindex import FRAME_PARSERS
+import catalog
+
+##########
+# config #
+##########
+
+CHECKSUM_DFLTS = {'enabled': True,
+                  'workers': 4}     # for verification
+
+HASH_ALGORITHM = 'sha256'
+HASH_SUFFIX    = '.sha256'
+READ_SIZE      = 1024 * 1024
+
+# sidecar and temporary files in ``rec_dir`` (not recordings)
+NON_RECORDING_SUFFIXES = ('.idx', '.peaks', '.stderr', '.tmp', '.archiving', '.publishing',
+                          HASH_SUFFIX)
+
+def checksum_params(cfg_profile = None):
+    """Get checksum parameters (config overlaid on defaults)
+
+    :param cfg_profile: optional (None means ``default``)
+    :return: dict
+    """
+    params = dict(CHECKSUM_DFLTS)
+    params.update(cfg.config('checksum', cfg_profile))
+    return params
+
+################
+# sidecar file #
+################
+
+def write_hash(path, digest):
+    """Write sidecar file (atomically)
+
+    :param path: pathname of recording
+    :param digest: hex digest
+    """
+    tmp_path = path + HASH_SUFFIX + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write("%s  %s\n" % (digest, os.path.basename(path)))
+    os.replace(tmp_path, path + HASH_SUFFIX)
+
+def read_hash(path):
+    """
+    :param path: pathname of recording
+    :return: hex digest from sidecar file (or None, if not present)
+    """
+    try:
+        with open(path + HASH_SUFFIX) as f:
+            return f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+def hash_file(path):
+    """
+    :param path: pathname
+    :return: hex digest of file content
+    """
+    h = hashlib.new(HASH_ALGORITHM)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+################
+# StreamHasher #
+################
+
+class StreamHasher(object):
+    """Incremental hash of a recording being written (``feed()`` may be called from another
+    thread than ``close()``)
+    """
+    def __init__(self, path):
+        """
+        :param path: pathname of recording
+        """
+        self.path        = path
+        self.append_only = os.path.splitext(path)[1].lower() in FRAME_PARSERS
+        self.hash        = hashlib.new(HASH_ALGORITHM)
+        self.offset      = 0
+        self.lock        = threading.Lock()
+
+    def feed(self):
+        """Hash bytes appended since last call (no-op for formats that are not append-only)
+
+        :return: bytes hashed so far
+        """
+        if not self.append_only:
+            return self.offset
+        with self.lock:
+            try:
+                with open(self.path, 'rb') as f:
+                    f.seek(self.offset)
+                    while True:
+                        data = f.read(READ_SIZE)
+                        if not data:
+                            break
+                        self.hash.update(data)
+                        self.offset += len(data)
+            except FileNotFoundError:
+                pass
+            return self.offset
+
+    def close(self):
+        """Complete hash, and write sidecar file
+
+        :return: hex digest (or None, if recording not found)
+        """
+        if not os.path.exists(self.path):
+            return None
+        if self.append_only:
+            self.feed()
+            # guard against the file having been truncated or rewritten
+            if os.path.getsize(self.path) == self.offset:
+                digest = self.hash.hexdigest()
+            else:
+                log.info("Recording \"%s\" not append-only, rehashing" % (self.path))
+                digest = hash_file(self.path)
+        else:
+            digest = hash_file(self.path)
+        write_hash(self.path, digest)
+        log.debug("Hash for \"%s\": %s" % (self.path, digest))
+        return digest
+
+def get_hasher(path, cfg_profile = None):
+    """
+    :param path: pathname of recording
+    :param cfg_profile: optional (None means ``default``)
+    :return: StreamHasher (or None, if not enabled)
+    """
+    if not truthy(checksum_params(cfg_profile)['enabled']):
+        return None
+    return StreamHasher(path)
+
+def rehash(path):
+    """Compute and store hash for a recording that was rewritten (e.g. archived)
+
+    :param path: pathname of recording
+    :return: hex digest
+    """
+    digest = hash_file(path)
+    write_hash(path, digest)
+    return digest
+
+################
+# verification #
+################
+
+def recording_files(rec_path):
+    """
+    :param rec_path: recordings directory
+    :return: list of pathnames of recordings (excluding sidecar and temporary files)
+    """
+    paths = []
+    for dir_path, _, files in os.walk(rec_path):
+        for name in files:
+            if not name.endswith(NON_RECORDING_SUFFIXES):
+                paths.append(os.path.join(dir_path, name))
+    return sorted(paths)
+
+def check_file(path, stored, verify = True):
+    """
+    :param path: pathname of recording
+    :param stored: stored hex digest (or None)
+    :param verify: recompute hash (otherwise only for recordings with no stored hash)
+    :return: tuple (path, stored digest, computed digest or None, error or None)
+    """
+    try:
+        computed = hash_file(path) if verify or not stored else None
+    except OSError as e:
+        return path, stored, None, str(e)
+    return path, stored, computed, None
+
+def scan(rec_path, workers = CHECKSUM_DFLTS['workers'], verify = True):
+    """Verify recordings against stored hashes (sidecar, or catalog), and find duplicates
+
+    :param rec_path: recordings directory
+    :param workers: number of files hashed in parallel
+    :param verify: recompute hashes (otherwise, duplicates are found from stored hashes,
+                   and only recordings with no stored hash are read)
+    :return: dict with ``corrupt``, ``duplicates``, ``unhashed`` (hashes computed and
+             stored for recordings that had none), and ``errors``
+    """
+    catalog_hashes = {}
+    if catalog.catalog:
+        for rec in catalog.catalog.get_recordings():
+            if rec.get('sha256'):
+                catalog_hashes[rec['path']] = rec['sha256']
+    paths = recording_files(rec_path)
+    stored = {path: read_hash(path) or catalog_hashes.get(path) for path in paths}
+
+    by_digest = defaultdict(list)
+    corrupt, unhashed, errors = [], [], {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda p: check_file(p, stored[p], verify), paths)
+        for path, known, computed, error in results:
+            if error:
+                errors[path] = error
+                continue
+            if known and computed and known != computed:
+                corrupt.append({'path': path, 'stored': known, 'computed': computed})
+                continue
+            if not known:
+                write_hash(path, computed)
+                unhashed.append(path)
+            by_digest[known or computed].append(path)
+    duplicates = [paths for paths in by_digest.values() if len(paths) > 1]
+    log.info("Checked %d recordings in \"%s\": %d corrupt, %d duplicate sets" %
+             (len(paths), rec_path, len(corrupt), len(duplicates)))
+    return {'recordings': len(paths),
+            'verified'  : bool(verify),
+            'corrupt'   : corrupt,
+            'duplicates': duplicates,
+            'unhashed'  : unhashed,
+            'errors'    : errors}
+
+#####################
+# command line tool #
+#####################
+
+import json
+import click
+
+@click.command()
+@click.option('--verify/--no-verify', default=True, help="Recompute hashes (default), or only compare stored hashes")
+@click.option('--workers',  default=None, type=int, help="Files hashed in parallel (defaults to config)")
+@click.option('--profile',  default=None, type=str, help="Profile in config.yml")
+@click.argument('rec_dir',  required=False)
+def main(verify, workers, profile, rec_dir):
+    """Verify recordings against stored hashes, and report duplicates (``rec_dir`` defaults
+    to the scheduler config)
+    """
+    scheduler = cfg.config('scheduler', profile)
+    if not rec_dir:
+        rec_dir = scheduler['rec_dir']
+        if rec_dir[0] not in ('/.'):
+            rec_dir = os.path.join(BASE_DIR, rec_dir)
+    if scheduler.get('catalog_file'):
+        db_dir = scheduler.get('db_dir') or '.'
+        if db_dir[0] not in ('/.'):
+            db_dir = os.path.join(BASE_DIR, db_dir)
+        catalog_path = os.path.join(db_dir, scheduler['catalog_file'])
+        if os.path.exists(catalog_path):
+            catalog.catalog = catalog.Catalog('sqlite:///' + catalog_path)
+    workers = workers or checksum_params(profile)['workers']
+    print(json.dumps(scan(rec_dir, workers, verify), indent=2))
+
+if __name__ == '__main__':
+    main()
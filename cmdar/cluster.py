@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+"""Recorder cluster - coordination of multiple DAR nodes sharing a single job store
+
+Each occurrence of a scheduled job is claimed (with a lease) by the node(s) recording it.
+Leases are renewed by a heartbeat thread on every node; the same thread takes over
+occurrences whose window is still open but which are no longer covered by a live (or
+completed) claim, either because the recording node died, the recording failed, or the
+program calls for redundant capture on more than one node.
+
+Each occurrence also records how to capture it (the recording args), since the job may no
+longer be in the job store when it is taken over (apscheduler removes one-off jobs as soon
+as they are submitted).
+
+Note: claims are serialized using SQLite ``BEGIN IMMEDIATE`` transactions, so the claim
+database must be SQLite (by default, it is the same file as the apscheduler job store).
+"""
+
+import os
+import json
+import socket
+import time
+import threading
+
+from sqlalchemy import (create_engine, event, MetaData, Table, Column, String, Integer,
+                        Float, Text, select, update, delete, insert)
+
+from core import log
+from utils import LOV
+from catalog import add_columns
+
+#################
+# config/schema #
+#################
+
+CLUSTER_DFLTS = {'enabled'      : False,
+                 'node_id'      : None,   # defaults to <hostname>:<pid>
+                 'db_url'       : None,   # defaults to scheduler job store
+                 'heartbeat'    : 10,     # secs
+                 'lease'        : 30,     # secs
+                 'min_remaining': 60,     # secs (not worth taking over if less)
+                 'purge_after'  : 86400}  # secs (after occurrence end)
+
+ClaimState = LOV(['ACTIVE',
+                  'DONE',
+                  'FAILED'],
+                 'lower')
+
+metadata = MetaData()
+
+nodes_tab = Table('dar_nodes', metadata,
+                  Column('node_id', String(191), primary_key=True),
+                  Column('host', String(191), nullable=False),
+                  Column('pid', Integer, nullable=False),
+                  Column('started', Float, nullable=False),
+                  Column('heartbeat', Float, nullable=False))
+
+claims_tab = Table('dar_claims', metadata,
+                   Column('job_id', String(191), primary_key=True),
+                   Column('run_time', Float, primary_key=True),
+                   Column('slot', Integer, primary_key=True),
+                   Column('node_id', String(191), nullable=False),
+                   Column('end_time', Float, nullable=False, index=True),
+                   Column('redundancy', Integer, nullable=False),
+                   Column('lease_expires', Float, nullable=False),
+                   Column('state', String(16), nullable=False),
+                   Column('spec', Text))  # JSON (recording args, for takeover)
+
+def claim_engine(db_url):
+    """Create SQLAlchemy engine for the claim database, with transactions that take the
+    SQLite write lock up front (so that check-then-claim is atomic across processes)
+
+    :param db_url: SQLAlchemy URL (must be ``sqlite:``)
+    :return: sqlalchemy.engine.Engine
+    """
+    if not db_url.startswith('sqlite:'):
+        raise RuntimeError("Cluster claim database must be SQLite (not \"%s\")" % (db_url))
+    engine = create_engine(db_url, connect_args={'timeout': 30, 'check_same_thread': False})
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_conn, conn_record):
+        # disable pysqlite's own transaction handling, see ``on_begin()``
+        dbapi_conn.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def on_begin(conn):
+        conn.exec_driver_sql('BEGIN IMMEDIATE')
+
+    metadata.create_all(engine)
+    add_columns(engine, metadata.sorted_tables)
+    return engine
+
+###############
+# ClusterNode #
+###############
+
+# node for the current process (set up by ``Dar``, if clustering is enabled)
+node = None
+
+class ClusterNode(object):
+    """Membership of the current process in a recorder cluster
+    """
+    def __init__(self, db_url, node_id = None, heartbeat = 10, lease = 30, min_remaining = 60,
+                 purge_after = 86400):
+        """
+        :param db_url: SQLAlchemy URL for claim database
+        :param node_id: unique name of node (defaults to <hostname>:<pid>)
+        :param heartbeat: interval (secs) for renewing leases and checking for takeovers
+        :param lease: lease duration (secs), must be comfortably longer than ``heartbeat``
+        :param min_remaining: minimum open window (secs) for taking over an occurrence
+        :param purge_after: time (secs) after occurrence end to keep claim records
+        """
+        self.host          = socket.gethostname()
+        self.pid           = os.getpid()
+        self.node_id       = node_id or "%s:%d" % (self.host, self.pid)
+        self.heartbeat     = heartbeat
+        self.lease         = lease
+        self.min_remaining = min_remaining
+        self.purge_after   = purge_after
+        self.engine        = claim_engine(db_url)
+        self.takeover      = None
+        self.stopping      = threading.Event()
+        self.thread        = None
+
+    def start(self, takeover):
+        """Register node and start heartbeat thread
+
+        :param takeover: callable, invoked with claim (dict) for occurrences taken over
+        """
+        if self.thread and self.thread.is_alive():
+            return
+        self.takeover = takeover
+        self.stopping.clear()
+        now = time.time()
+        with self.engine.begin() as conn:
+            conn.execute(delete(nodes_tab).where(nodes_tab.c.node_id == self.node_id))
+            conn.execute(insert(nodes_tab).values(node_id=self.node_id, host=self.host,
+                                                  pid=self.pid, started=now, heartbeat=now))
+        self.thread = threading.Thread(target=self.run, name='cluster-heartbeat', daemon=True)
+        self.thread.start()
+        log.info("Cluster node \"%s\" started" % (self.node_id))
+
+    def stop(self):
+        """Stop heartbeat thread and deregister node (active leases are left to expire)
+        """
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        with self.engine.begin() as conn:
+            conn.execute(delete(nodes_tab).where(nodes_tab.c.node_id == self.node_id))
+        log.info("Cluster node \"%s\" stopped" % (self.node_id))
+
+    def run(self):
+        """Heartbeat loop
+        """
+        while not self.stopping.wait(self.heartbeat):
+            try:
+                self.beat()
+                for claim in self.find_uncovered():
+                    log.info("Taking over job \"%s\" (slot %d)" % (claim['job_id'], claim['slot']))
+                    self.takeover(claim)
+            except Exception as e:
+                log.error("Cluster heartbeat failed: %s" % (e))
+
+    def beat(self):
+        """Update node heartbeat, renew leases, and purge old claim records
+        """
+        now = time.time()
+        with self.engine.begin() as conn:
+            conn.execute(update(nodes_tab)
+                         .where(nodes_tab.c.node_id == self.node_id)
+                         .values(heartbeat=now))
+            conn.execute(update(claims_tab)
+                         .where(claims_tab.c.node_id == self.node_id,
+                                claims_tab.c.state == ClaimState.ACTIVE)
+                         .values(lease_expires=now + self.lease))
+            conn.execute(delete(claims_tab)
+                         .where(claims_tab.c.end_time < now - self.purge_after))
+
+    @staticmethod
+    def covered(row, now):
+        """
+        :return: bool (whether claim record covers its slot)
+        """
+        if row.state == ClaimState.DONE:
+            return True
+        return row.state == ClaimState.ACTIVE and row.lease_expires > now
+
+    def claim(self, job_id, duration = None, redundancy = 1, spec = None):
+        """Claim a slot for the current occurrence of a job; a new occurrence is created if
+        ``duration`` is specified and there is no open occurrence
+
+        :param job_id: scheduler job ID
+        :param duration: length of occurrence (secs) starting now
+        :param redundancy: number of nodes that should record the occurrence
+        :param spec: [optional] recording args (JSON-serializable), for new occurrence
+        :return: claim (dict, with ``spec`` for the occurrence), or None if not claimed
+        """
+        now = time.time()
+        with self.engine.begin() as conn:
+            rows = conn.execute(select(claims_tab)
+                                .where(claims_tab.c.job_id == job_id,
+                                       claims_tab.c.end_time > now)
+                                .order_by(claims_tab.c.run_time, claims_tab.c.slot)).all()
+            if rows:
+                run_time   = rows[0].run_time
+                end_time   = rows[0].end_time
+                redundancy = rows[0].redundancy
+                rows = [row for row in rows if row.run_time == run_time]
+                spec_json  = next((row.spec for row in rows if row.spec), None)
+            elif duration:
+                run_time   = now
+                end_time   = now + duration
+                spec_json  = json.dumps(spec) if spec else None
+            else:
+                return None
+
+            if any(row.node_id == self.node_id for row in rows):
+                return None
+            if sum(self.covered(row, now) for row in rows) >= redundancy:
+                return None
+
+            lapsed = [row for row in rows if not self.covered(row, now)]
+            values = {'node_id'      : self.node_id,
+                      'lease_expires': now + self.lease,
+                      'state'        : ClaimState.ACTIVE}
+            if lapsed:
+                slot = lapsed[0].slot
+                conn.execute(update(claims_tab)
+                             .where(claims_tab.c.job_id == job_id,
+                                    claims_tab.c.run_time == run_time,
+                                    claims_tab.c.slot == slot)
+                             .values(**values))
+            else:
+                slot = len(rows)
+                conn.execute(insert(claims_tab).values(job_id=job_id, run_time=run_time,
+                                                       slot=slot, end_time=end_time,
+                                                       redundancy=redundancy, spec=spec_json,
+                                                       **values))
+        return {'job_id'  : job_id,
+                'run_time': run_time,
+                'slot'    : slot,
+                'end_time': end_time,
+                'spec'    : json.loads(spec_json) if spec_json else None}
+
+    def release(self, claim, failed = False):
+        """Release claim when recording is finished (a failed claim may be taken over by
+        another node, if the occurrence window is still open)
+
+        :param claim: claim returned by ``claim()``
+        :param failed: whether recording failed
+        """
+        state = ClaimState.FAILED if failed else ClaimState.DONE
+        with self.engine.begin() as conn:
+            conn.execute(update(claims_tab)
+                         .where(claims_tab.c.job_id == claim['job_id'],
+                                claims_tab.c.run_time == claim['run_time'],
+                                claims_tab.c.slot == claim['slot'],
+                                claims_tab.c.node_id == self.node_id)
+                         .values(state=state))
+
+    def find_uncovered(self):
+        """Claim open occurrences that are not fully covered by other nodes
+
+        :return: list of claims (dicts)
+        """
+        now = time.time()
+        with self.engine.connect() as conn:
+            job_ids = conn.execute(select(claims_tab.c.job_id).distinct()
+                                   .where(claims_tab.c.end_time > now + self.min_remaining)).scalars().all()
+        claims = []
+        for job_id in job_ids:
+            claim = self.claim(job_id)
+            if claim:
+                claims.append(claim)
+        return claims
+
+    def get_status(self):
+        """
+        :return: dict with cluster nodes and open claims
+        """
+        now = time.time()
+        with self.engine.connect() as conn:
+            nodes = conn.execute(select(nodes_tab)).mappings().all()
+            claims = conn.execute(select(claims_tab)
+                                  .where(claims_tab.c.end_time > now)).mappings().all()
+        return {'node_id': self.node_id,
+                'nodes'  : [dict(row, alive=row['heartbeat'] > now - self.lease) for row in nodes],
+                'claims' : [dict(row) for row in claims]}
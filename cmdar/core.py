@@ -4,6 +4,11 @@
 """
 
 import os.path
+import copy
+import json
+import queue
+import atexit
+import threading
 import logging
 import logging.handlers
 
@@ -24,28 +29,131 @@ cfg           = utils.Config(CONFIG_PATH)
 # logging #
 ###########
 
-# create logger (TODO: logging parameters belong in config file as well!!!)
-LOGGER_NAME  = 'cmdar'
-LOG_DIR      = 'log'
-LOG_FILE     = LOGGER_NAME + '.log'
-LOG_PATH     = os.path.join(BASE_DIR, LOG_DIR, LOG_FILE)
-LOG_FMTR     = logging.Formatter('%(asctime)s %(levelname)s [%(filename)s:%(lineno)s]: %(message)s')
-LOG_FILE_MAX = 50000000
-LOG_FILE_NUM = 50
+# Log records are handed off to a queue by the calling (e.g. recording or API) thread, and
+# written out by a single listener thread, so that file I/O (including rotation) never
+# happens under the logging lock of a scheduler or server thread
 
-dflt_hand = logging.handlers.RotatingFileHandler(LOG_PATH, 'a', LOG_FILE_MAX, LOG_FILE_NUM)
+LOGGER_NAME   = 'cmdar'
+LOG_DFLTS     = {'log_dir'   : 'log',
+                 'log_file'  : LOGGER_NAME + '.log',
+                 'file_max'  : 50000000,
+                 'file_num'  : 50,
+                 'level'     : 'INFO',
+                 'format'    : 'text',   # or 'json'
+                 'queue_size': 0}        # 0 means unbounded
+LOG_TEXT_FMT  = '%(asctime)s %(levelname)s [%(filename)s:%(lineno)s]: %(message)s'
+LOG_CONTEXT   = ('job_id', 'station')
+
+log_cfg = dict(LOG_DFLTS)
+log_cfg.update(cfg.config('logging'))
+
+if not log_cfg['log_dir'] or log_cfg['log_dir'][0] in ('/.'):
+    LOG_DIR   = log_cfg['log_dir'] or '.'
+else:
+    LOG_DIR   = os.path.join(BASE_DIR, log_cfg['log_dir'])
+LOG_PATH      = os.path.join(LOG_DIR, log_cfg['log_file'])
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as single-line JSON objects (including job context, if set)
+    """
+    def format(self, record):
+        data = {'time'   : self.formatTime(record),
+                'level'  : record.levelname,
+                'file'   : record.filename,
+                'line'   : record.lineno,
+                'thread' : record.threadName,
+                'message': record.getMessage()}
+        for attr in LOG_CONTEXT:
+            if getattr(record, attr, None) is not None:
+                data[attr] = getattr(record, attr)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, default=str)
+
+log_context = threading.local()
+
+class ContextFilter(logging.Filter):
+    """Attach job context (see ``set_log_context()``) of the calling thread to records
+    """
+    def filter(self, record):
+        for attr in LOG_CONTEXT:
+            setattr(record, attr, getattr(log_context, attr, None))
+        return True
+
+def set_log_context(**kwargs):
+    """Set job context for log records from the current thread (pass None to clear)
+
+    :param kwargs: any of ``LOG_CONTEXT`` (e.g. ``job_id``, ``station``)
+    """
+    for attr in LOG_CONTEXT:
+        setattr(log_context, attr, kwargs.get(attr))
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Non-blocking hand-off to the listener thread (records are dropped and counted, rather
+    than blocking the caller, if a bounded queue is full)
+    """
+    dropped = 0
+
+    def prepare(self, record):
+        """Resolve message arguments, and render traceback to ``exc_text`` (rather than
+        merging it into the message, as the default does), so that the listener's formatter
+        can report it separately (e.g. ``exc`` field for JSON)
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LogQueueHandler.dropped += 1
+
+if log_cfg['format'] == 'json':
+    LOG_FMTR  = JsonFormatter()
+else:
+    LOG_FMTR  = logging.Formatter(LOG_TEXT_FMT)
+
+os.makedirs(LOG_DIR, exist_ok=True)
+dflt_hand = logging.handlers.RotatingFileHandler(LOG_PATH, 'a', log_cfg['file_max'],
+                                                 log_cfg['file_num'])
 dflt_hand.setLevel(logging.DEBUG)
 dflt_hand.setFormatter(LOG_FMTR)
 
 dbg_hand = logging.StreamHandler()
 dbg_hand.setLevel(logging.DEBUG)
-dbg_hand.setFormatter(LOG_FMTR)
+dbg_hand.setFormatter(logging.Formatter(LOG_TEXT_FMT))
+
+log_queue = queue.Queue(log_cfg['queue_size'])
+queue_hand = LogQueueHandler(log_queue)
+queue_hand.addFilter(ContextFilter())
+log_listener = logging.handlers.QueueListener(log_queue, dflt_hand, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 log = logging.getLogger(LOGGER_NAME)
-log.setLevel(logging.INFO)
-log.addHandler(dflt_hand)
+log.setLevel(log_cfg['level'])
+log.addHandler(queue_hand)
+
+log_lock = threading.Lock()
+
+def debug_logging(level = logging.DEBUG):
+    """Set logging level and echo log records to the console (safe to call repeatedly, the
+    console handler is only added once)
+
+    :param level: logging level for ``cmdar`` logger
+    """
+    log.setLevel(level)
+    with log_lock:
+        if dbg_hand not in log_listener.handlers:
+            log_listener.handlers += (dbg_hand,)
 
 ############
 # defaults #
 ############
-
@@ -7,20 +7,46 @@
 import os.path
 import re
 import logging
+import time
+import threading
 import datetime as dt
 #from random import choice
 
 import apscheduler.schedulers as schedulers
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.triggers.date import DateTrigger
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.events import *
 
 from __init__ import *
-from core import BASE_DIR, cfg, log, dbg_hand
+from core import BASE_DIR, cfg, log, debug_logging, set_log_context
 from utils import LOV, str2timedelta, str2datetime, str2time, str2time_dt, truthy
-from streamer import Streamer
+from streamer import Streamer, StreamStalled
+from monitor import StallAction
+from playlist import get_playlists
+from archive import start_archive
+from retention import start_retention
+from peaks import make_peaks, read_peaks, peaks_enabled
+from align import align_recordings, align_enabled
+from staging import stage_filebase, publish, staged_files
+from checksum import read_hash
+from guide import GuideCache, guide_params, program_digest, GUIDE_PREFIX
+from jobstore import (jobstore_engine, jobstore_params, ChangeWatcher, NativeJobStore,
+                      JobStoreType, RECORD_FUNC, describe_job)
+from audio import detect_dead_air
+from priority import PriorityClass, thread_initializer, priority_params
+import cluster
+import catalog
+import inflight
+import relay
+import warmpool
+import spans
+import events
+import priority
+from spans import Stage, RunStatus
 
 #####################
 # utility functions #
@@ -121,6 +147,12 @@ def apsched_listener(event):
                 'run_time' : str(event.scheduled_run_time),
                 'retval'   : event.retval,
                 'exception': event.exception}
+    elif isinstance(event, JobSubmissionEvent):
+        info = {'event'    : apsched_eventname(event),
+                'job_id'   : event.job_id,
+                'jobstore' : event.jobstore,
+                'run_times': [str(t) for t in event.scheduled_run_times]}
+        spans.recorder.fire(event.job_id, event.scheduled_run_times[-1].timestamp())
     elif isinstance(event, JobEvent):
         info = {'event'    : apsched_eventname(event),
                 'job_id'   : event.job_id,
@@ -129,17 +161,90 @@ def apsched_listener(event):
         info = {'event'    : apsched_eventname(event),
                 'alias'    : event.alias}
     log.error(info) if info.get('exception') else log.info(info)
+    events.bus.publish(info['event'], info)
+
+# job store aliases: persistent (program/todo) jobs, and transient jobs internal to the
+# running process (e.g. takeovers, maintenance), which are never persisted
+JOBSTORE          = 'default'
+INTERNAL_JOBSTORE = 'internal'
+
+# executor aliases: captures, and background (maintenance) work, which is kept on its
+# own small thread pool so that it never holds up capture jobs
+EXECUTOR            = 'default'
+BACKGROUND_EXECUTOR = 'background'
+BACKGROUND_WORKERS  = 2
+# manual recordings through the warm pool (see ``warmpool.py``)
+WARM_EXECUTOR       = 'warm'
+
+# job ID prefix for manual recordings
+RECORD_PREFIX       = 'record:'
+
+# capture executor size (apscheduler default), and misfire grace time for recording jobs
+DFLT_WORKERS        = 10
+MISFIRE_GRACE_TIME  = 300
 
-def apsched_init(db_path, debug = 0):
+def pool_executor(workers, pclass):
+    """
+    :param workers: number of threads
+    :param pclass: priority class for worker threads (see ``priority.py``)
+    :return: apscheduler ThreadPoolExecutor
+    """
+    return ThreadPoolExecutor(workers, pool_kwargs={'initializer': thread_initializer(pclass)})
+
+class CaptureExecutor(ThreadPoolExecutor):
+    """Executor for capture jobs, keeping a snapshot of one-off (``DateTrigger``) jobs as
+    they are submitted: apscheduler removes such a job from the job store right after
+    submitting it, before a misfire is reported (see ``Dar.on_job_missed()``)
+    """
+    def __init__(self, workers):
+        """
+        :param workers: number of threads
+        """
+        super().__init__(workers, {'initializer': thread_initializer(PriorityClass.CAPTURE)})
+        self.submitted = {}   # job ID -> Job
+        self.snap_lock = threading.Lock()
+
+    def submit_job(self, job, run_times):
+        if isinstance(job.trigger, DateTrigger):
+            with self.snap_lock:
+                self.submitted[job.id] = job
+        try:
+            super().submit_job(job, run_times)
+        except BaseException:
+            self.pop_job(job.id)
+            raise
+
+    def pop_job(self, job_id):
+        """
+        :param job_id: job ID
+        :return: snapshot of submitted one-off job (or None)
+        """
+        with self.snap_lock:
+            return self.submitted.pop(job_id, None)
+
+def apsched_init(db_path, debug = 0, workers = DFLT_WORKERS, engine = None, jobstore = None,
+                 executor = None):
     """Initialize and return apscheduler handle
+
+    :param db_path: pathname of job store database
+    :param debug: integer 0-3 (or higher, for apscheduler debug logging)
+    :param workers: number of threads for capture jobs
+    :param engine: [optional] SQLAlchemy engine for job store (see ``jobstore_engine()``)
+    :param jobstore: [optional] job store (defaults to ``SQLAlchemyJobStore``)
+    :param executor: [optional] executor for capture jobs (defaults to ``CaptureExecutor``)
     """
     if debug > 3:
         logging.basicConfig()
         logging.getLogger('apscheduler').setLevel(logging.DEBUG)
 
     sched = BackgroundScheduler()
-    db_url = 'sqlite:///' + db_path
-    sched.add_jobstore(SQLAlchemyJobStore(url=db_url))
+    if engine is None:
+        engine = jobstore_engine(db_path)
+    sched.add_jobstore(jobstore or SQLAlchemyJobStore(engine=engine), JOBSTORE)
+    sched.add_jobstore(MemoryJobStore(), INTERNAL_JOBSTORE)
+    sched.add_executor(executor or CaptureExecutor(workers), EXECUTOR)
+    sched.add_executor(pool_executor(BACKGROUND_WORKERS, PriorityClass.POSTPROC),
+                       BACKGROUND_EXECUTOR)
     sched.add_listener(apsched_listener)
     return sched
 
@@ -147,33 +252,267 @@ def apsched_init(db_path, debug = 0):
 # streamer functions #
 ######################
 
-def validate_streamer(streamer):
+def validate_streamer(streamer, cfg_profile = None):
     """
+    :param streamer: streamer name in config.yml
+    :param cfg_profile: optional (None means ``default``)
     """
-    engine = Streamer.get(streamer)
+    engine = Streamer.get(streamer, cfg_profile)
     if not issubclass(engine, Streamer) or type(engine) is Streamer:
         raise RuntimeError("Bad engine type \"%s\" for \"%s\"" % (engine.__name__, streamer))
 
-def do_record(streamer, cfg_profile, *args, **kwargs):
+# URLs (stream mirrors) that have recently produced dead air
+failed_urls = set()
+failed_lock = threading.Lock()
+
+def select_url(url, mirrors = None):
+    """Choose stream URL to record from, skipping mirrors that have recently produced dead
+    air (falls back to the scheduled URL, and resets, if all mirrors are marked as failed)
+
+    :param url: URL scheduled for the job
+    :param mirrors: list of all stream URLs for the station (or None)
+    :return: str
+    """
+    if not mirrors:
+        return url
+    candidates = [url] + [m for m in mirrors if m != url]
+    with failed_lock:
+        for cand in candidates:
+            if cand not in failed_urls:
+                return cand
+        failed_urls.difference_update(candidates)
+    return url
+
+def fail_url(url, mirrors = None):
+    """Mark stream URL as failed, so that subsequent recordings fail over to the next mirror
+
+    :param url: URL that produced bad content
+    :param mirrors: list of all stream URLs for the station (no-op if no alternatives)
+    :return: bool (whether failover was triggered)
     """
-    Note that streamer and cfg_profile must be positional args (no defaults), so that
-    additional positional args (and keyword args) can be passed to Streamer.get()
+    if not mirrors or len(mirrors) < 2:
+        return False
+    with failed_lock:
+        failed_urls.add(url)
+    log.info("Failing over from stream URL \"%s\"" % (url))
+    return True
+
+def do_record(streamer, cfg_profile, url, media_type, filebase, duration, mirrors = None,
+              job_id = None, station = None, redundancy = 1, claim = None, late_start = None,
+              **kwargs):
+    """
+    Note that streamer and cfg_profile must be positional args (no defaults), consistent
+    with the args tuple built by ``Dar.schedule_item()``
 
     :param streamer: streamer name in config.yml
     :param cfg_profile: must be specified (or None)
-    :param args: passed through to streamer engine
+    :param url: stream URL (str)
+    :param media_type: stream content-type (str)
+    :param filebase: file or path name [minus file type] (str)
+    :param duration: seconds (int) or [HH:]MM:SS (str)
+    :param mirrors: [optional] all stream URLs for station, for failover
+    :param job_id: [optional] scheduler job ID (for logging context)
+    :param station: [optional] station name (for logging context)
+    :param redundancy: number of cluster nodes that should record the occurrence
+    :param claim: [optional] cluster claim already held (e.g. for takeover)
+    :param late_start: [optional] scheduled start (epoch), if joining a missed occurrence
     :param kwargs: passed through to streamer engine
-    :return: pathname of recorded stream
+    :return: dict with job outcome (``path`` is the pathname of recorded stream)
     """
     # REVISIT: this is a little bit of a fudge, need to rethink the relatioship between
     # debug and verbosity levels across the streamer and scheduler modules!!!
     debug = kwargs.get('verbose', 0)
     if debug > 0:
-        log.setLevel(logging.DEBUG)
-        log.addHandler(dbg_hand)
-
+        debug_logging(logging.DEBUG)
+    set_log_context(job_id=job_id, station=station)
+    span = spans.recorder.begin(job_id, station)
+    status = RunStatus.FAILED
+    outcome = {}
+    try:
+        node = cluster.node
+        if node and job_id and not claim:
+            if isinstance(duration, str):
+                duration = str2timedelta(duration).seconds
+            # recording args are kept with the claim, in case the job is gone from the job
+            # store by the time another node takes over (e.g. one-off jobs)
+            spec = {'args'  : [streamer, cfg_profile, url, media_type, filebase],
+                    'kwargs': dict(kwargs, mirrors=mirrors, job_id=job_id, station=station,
+                                   redundancy=redundancy)}
+            claim = node.claim(job_id, duration, redundancy, spec)
+            if not claim:
+                log.info("Occurrence of job \"%s\" claimed by other node(s)" % (job_id))
+                status = RunStatus.SKIPPED
+                return {'path': None, 'skipped': True}
+        if claim and claim['slot'] > 0:
+            # redundant copy, keep from colliding with primary recording
+            filebase += '-r%d-' % (claim['slot'])
+        try:
+            outcome = record_stream(streamer, cfg_profile, url, media_type, filebase, duration,
+                                    mirrors, **kwargs)
+        except Exception:
+            if node and claim:
+                node.release(claim, failed=True)
+            raise
+        if node and claim:
+            node.release(claim)
+            outcome['claim'] = claim
+        if late_start:
+            outcome['partial'] = True
+            outcome['late_secs'] = round(span.marks[Stage.DISPATCH] - late_start, 3)
+        status = RunStatus.COMPLETED
+        outcome['run_id'] = span.run_id
+        outcome['job_id'] = job_id
+        if catalog.catalog:
+            outcome['rec_ids'] = catalog_recordings(outcome, station, job_id, span.run_id,
+                                                    media_type)
+        return outcome
+    finally:
+        spans.recorder.finish(span, status, outcome.get('path'))
+        set_log_context()
+
+def catalog_recordings(outcome, station, job_id, run_id, media_type):
+    """Add recording (and any restarted segments) to catalog
+
+    :param outcome: job outcome from ``record_stream()``
+    :return: list of recording IDs
+    """
+    rec_ids = []
+    for path in outcome.get('segments') or [outcome['path']]:
+        try:
+            rec_ids.append(catalog.catalog.add_recording(path, station, job_id, run_id,
+                                                         media_type, read_hash(path)))
+        except Exception as e:
+            log.error("Could not add recording \"%s\" to catalog: %s" % (path, e))
+    return rec_ids
+
+# minimum remaining time (secs) worth restarting a stalled capture for
+MIN_RESTART_SECS = 10
+
+# minimum remaining time (secs) worth joining a missed occurrence for
+MIN_LATE_JOIN_SECS = 60
+
+# minimum age (secs since last write) for publishing files left in the staging directory
+MIN_STAGED_AGE = 60
+
+def record_stream(streamer, cfg_profile, url, media_type, filebase, duration, mirrors,
+                  **kwargs):
+    """Record stream and post-process the result (see ``do_record()`` for params); stalled
+    captures are restarted (or failed over to the next mirror) for the remaining duration,
+    with each restart written to a new segment file.  Captures are written to the staging
+    directory (if configured), and published into ``rec_dir`` after post-processing.
+
+    :return: dict with job outcome
+    """
+    if isinstance(duration, str):
+        duration = str2timedelta(duration).seconds
+    end_time = time.time() + duration
+    url = select_url(url, mirrors)
     engine = Streamer.get(streamer, cfg_profile)
-    return engine.save_stream(*args, **kwargs)
+    spans.mark(Stage.STREAMER_GET)
+    dest_dir = os.path.dirname(filebase) or '.'
+    bps = None
+    if media_type in engine.info['media_types']:
+        bps = engine.expected_bps(media_type, kwargs.get('bitrate'))
+    filebase = stage_filebase(filebase, duration, bps, cfg_profile)
+    playlists = get_playlists(cfg_profile)
+    segments = []
+    seg_base = filebase
+    stall_level = 0
+    while True:
+        try:
+            stream_url = playlists.resolve(url) if playlists else url
+            segments.append(engine.save_stream(stream_url, media_type, seg_base, duration,
+                                               stall_level=stall_level,
+                                               cfg_profile=cfg_profile, **kwargs))
+            break
+        except StreamStalled as e:
+            segments.append(e.path)
+            stall_level = e.level
+            duration = int(end_time - time.time())
+            if duration < MIN_RESTART_SECS:
+                break
+            if e.action == StallAction.FAILOVER and fail_url(url, mirrors):
+                url = select_url(url, mirrors)
+            seg_base = "%s-%d-" % (filebase, len(segments))
+            log.info("Restarting capture (%s) for %d secs" % (e.action, duration))
+    outcome = postprocess(segments[0], url, cfg_profile, mirrors)
+    segments = [publish(path, dest_dir, cfg_profile) for path in segments]
+    outcome['path'] = segments[0]
+    if stream_url != url:
+        outcome['stream_url'] = stream_url
+    if len(segments) > 1:
+        outcome['segments'] = segments
+    return outcome
+
+def postprocess(path, url, cfg_profile, mirrors = None):
+    """Post-process recording (dead air analysis, with failover to next mirror)
+
+    :param path: pathname of recording
+    :param url: stream URL recorded from
+    :param cfg_profile: must be specified (or None)
+    :param mirrors: [optional] all stream URLs for station
+    :return: dict with job outcome
+    """
+    outcome = {'path': path, 'url': url}
+    dead_air_cfg = cfg.config('analysis', cfg_profile).get('dead_air') or {}
+    if truthy(dead_air_cfg.get('enabled')):
+        try:
+            outcome['dead_air'] = detect_dead_air(path, cfg_profile)
+        except (OSError, RuntimeError) as e:
+            log.info("Dead air analysis failed for \"%s\": %s" % (path, e))
+            outcome['dead_air'] = None
+        if outcome['dead_air'] and outcome['dead_air']['dead_air']:
+            log.notice("Dead air detected in \"%s\"" % (path))
+            if truthy(dead_air_cfg.get('failover')):
+                outcome['failover'] = fail_url(url, mirrors)
+    spans.mark(Stage.POSTPROC)
+    return outcome
+
+def reattach_recording(streamer, cfg_profile, entry, dest_dir = None):
+    """Reattach to capture started by a previous server process, wait for it to complete,
+    and finish post-processing (invoked as a job, see ``Dar.reattach_recordings()``)
+
+    :param streamer: streamer name in config.yml
+    :param cfg_profile: must be specified (or None)
+    :param entry: ``inflight`` registry entry (dict)
+    :param dest_dir: [optional] station directory to publish staged recording to
+    :return: dict with job outcome
+    """
+    job_id, station, path = entry['job_id'], entry['station'], entry['path']
+    set_log_context(job_id=job_id, station=station)
+    span = spans.recorder.begin(job_id, station)
+    status = RunStatus.FAILED
+    outcome = {}
+    try:
+        proc = inflight.ReattachedProcess(entry['pid'], entry['proc_start'])
+        if proc.poll() is None:
+            log.info("Reattached to capture \"%s\" (pid %d)" % (path, entry['pid']))
+        else:
+            log.info("Capture \"%s\" ended while detached" % (path))
+        engine = Streamer.get(streamer, cfg_profile)
+        spans.mark(Stage.STREAMER_GET)
+        try:
+            engine.wait_capture(proc, path, entry['media_type'], cfg_profile=cfg_profile)
+        except StreamStalled:
+            log.info("Reattached capture \"%s\" stalled (not restarted)" % (path))
+        finally:
+            inflight.registry.remove(path)
+        if not os.path.exists(path):
+            raise RuntimeError("Recording \"%s\" not found" % (path))
+        outcome = postprocess(path, entry['url'], cfg_profile)
+        if dest_dir:
+            outcome['path'] = publish(path, dest_dir, cfg_profile)
+        outcome['reattached'] = True
+        status = RunStatus.COMPLETED
+        outcome['run_id'] = span.run_id
+        outcome['job_id'] = job_id
+        if catalog.catalog:
+            outcome['rec_ids'] = catalog_recordings(outcome, station, job_id, span.run_id,
+                                                    entry['media_type'])
+        return outcome
+    finally:
+        spans.recorder.finish(span, status, outcome.get('path'))
+        set_log_context()
 
 ################
 # DAR entities #
@@ -206,19 +545,25 @@ TunerState    = LOV(['ACTIVE',
                      'INACTIVE'],
                     'lower')
 
+# internal attributes not shown in ``Dar.get_info()``
+INFO_EXCLUDE = {'sched', 'guides', 'reattached', 'engine', 'watcher', 'jobstore',
+                'executor'}
+
 class Dar(object):
     """
     """
-    def __init__(self, streamer, debug = 0, cfg_profile = None):
+    def __init__(self, streamer, debug = 0, cfg_profile = None, node_id = None):
         """
         :param streamer: streamer name in ``config.yml``
         :param debug: integer 0-3 (default: 0)
         :param cfg_profile: optional (None means ``default``)
+        :param node_id: optional cluster node name (overrides config)
         """
         self.streamer    = streamer
         self.debug       = debug
         self.cfg_profile = cfg_profile
 
+        self.generation  = 0
         self.stations    = cfg.config('stations', self.cfg_profile)
         self.programs    = cfg.config('programs', self.cfg_profile)
         self.scheduler   = cfg.config('scheduler', self.cfg_profile)
@@ -236,7 +581,57 @@ class Dar(object):
             self.db_path = os.path.join(self.db_dir, self.db_file)
         else:
             self.db_path = os.path.join(BASE_DIR, self.db_dir, self.db_file)
-        self.sched = apsched_init(self.db_path, self.debug)
+        self.workers = self.scheduler.get('workers', DFLT_WORKERS)
+        self.jobstore_cfg = jobstore_params(self.scheduler)
+        self.engine = jobstore_engine(self.db_path, truthy(self.jobstore_cfg['wal']),
+                                      self.jobstore_cfg['busy_timeout'])
+        self.jobstore = None
+        if self.jobstore_cfg['job_store'] == JobStoreType.NATIVE:
+            self.jobstore = NativeJobStore(self.engine)
+        elif self.jobstore_cfg['job_store'] != JobStoreType.PICKLE:
+            raise ConfigError("Unknown job_store \"%s\"" % (self.jobstore_cfg['job_store']))
+        self.executor = CaptureExecutor(self.workers)
+        self.sched = apsched_init(self.db_path, self.debug, self.workers, self.engine,
+                                  self.jobstore, self.executor)
+        self.watcher = None
+        if self.jobstore_cfg['change_poll']:
+            self.watcher = ChangeWatcher(self.engine, self.on_store_changed,
+                                         self.jobstore_cfg['change_poll'])
+        self.sched.add_listener(self.on_job_executed, EVENT_JOB_EXECUTED)
+        self.sched.add_listener(self.on_job_missed, EVENT_JOB_MISSED)
+        self.sched.add_listener(self.on_job_done, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+        self.late_join = truthy(self.scheduler.get('late_join', True))
+        self.min_late_join = self.scheduler.get('min_late_join', MIN_LATE_JOIN_SECS)
+
+        self.catalog_file = self.scheduler.get('catalog_file')
+        if self.catalog_file:
+            catalog_path = os.path.join(os.path.dirname(self.db_path), self.catalog_file)
+            catalog.catalog = catalog.Catalog('sqlite:///' + catalog_path)
+        spans.recorder = spans.SpanRecorder(self.scheduler.get('span_ring', spans.RING_SIZE))
+        events.bus = events.EventBus(self.scheduler.get('event_buffer', events.BUFFER_SIZE))
+        priority.classes = priority.PriorityClasses(priority_params(self.cfg_profile))
+
+        self.started_at = time.time()
+        self.reattached = set()
+        if truthy(self.scheduler.get('reattach', True)):
+            inflight.registry = inflight.InflightRegistry('sqlite:///' + self.db_path,
+                                                          self.engine)
+
+        if truthy(relay.relay_params(self.cfg_profile)['enabled']):
+            relay.hub = relay.RelayHub(self.stations, self.cfg_profile)
+
+        self.warm_cfg = warmpool.warm_params(self.cfg_profile)
+        if truthy(self.warm_cfg['enabled']):
+            validate_streamer(self.warm_cfg['streamer'], self.cfg_profile)
+            warmpool.pool = warmpool.WarmPool(self.stations, self.cfg_profile)
+            self.sched.add_executor(pool_executor(self.warm_cfg['workers'], PriorityClass.CAPTURE),
+                                    WARM_EXECUTOR)
+
+        self.guide_cfg = guide_params(self.cfg_profile)
+        self.guides = None
+        if truthy(self.guide_cfg['enabled']):
+            guide_cache = os.path.join(os.path.dirname(self.db_path), self.guide_cfg['cache_file'])
+            self.guides = GuideCache(guide_cache, self.guide_cfg['timeout'])
 
         if not self.rec_dir:
             self.rec_path = '.'
@@ -248,13 +643,271 @@ class Dar(object):
         if not os.path.isdir(self.rec_path):
             raise ConfigError("rec_dir \"%s\" is not a valid directory" % (self.rec_dir))
 
-        validate_streamer(self.streamer)
+        validate_streamer(self.streamer, self.cfg_profile)
+
+        cluster_cfg = dict(cluster.CLUSTER_DFLTS)
+        cluster_cfg.update(cfg.config('cluster', self.cfg_profile))
+        if truthy(cluster_cfg['enabled']) or node_id:
+            cluster.node = cluster.ClusterNode(cluster_cfg['db_url'] or 'sqlite:///' + self.db_path,
+                                               node_id or cluster_cfg['node_id'],
+                                               cluster_cfg['heartbeat'],
+                                               cluster_cfg['lease'],
+                                               cluster_cfg['min_remaining'],
+                                               cluster_cfg['purge_after'])
 
     def get_info(self):
-        info = dict(vars(self), state=self.state)
-        del info['sched']
+        info = {k: v for k, v in vars(self).items() if k not in INFO_EXCLUDE}
+        info['state'] = self.state
         return info
 
+    @property
+    def version(self):
+        """Version of DAR state, for caching API responses (changes with every scheduler
+        event, and with config reloads)
+
+        :return: str
+        """
+        return "%d.%d" % (self.generation, events.bus.last_id)
+
+    def station_urls(self):
+        """
+        :return: set of all stream URLs (including mirrors) for configured stations
+        """
+        urls = set()
+        for station in self.stations.values():
+            if isinstance(station['stream_url'], list):
+                urls.update(station['stream_url'])
+            else:
+                urls.add(station['stream_url'])
+        return urls
+
+    def get_runs(self, job_id, history = False, limit = 50):
+        """Get timing spans for recent runs of a job
+
+        :param job_id: scheduler job ID
+        :param history: read from catalog (rather than in-memory ring of recent runs)
+        :param limit: max number of runs (for ``history``)
+        :return: list of run records (dicts), most recent first
+        """
+        if truthy(history) and catalog.catalog:
+            return catalog.catalog.get_runs(job_id, int(limit))
+        return spans.recorder.get_runs(job_id)
+
+    def simulate(self, days = 7, start = None, workers = None, streamer = None):
+        """Play out the configured programs against a virtual clock (see ``simulate.py``);
+        does not touch the job store or record anything
+
+        :param days: number of days to simulate
+        :param start: aware datetime (defaults to now)
+        :param workers: executor size (defaults to the configured size)
+        :param streamer: ``simulate.FakeStreamer`` (optional)
+        :return: report (dict)
+        """
+        from simulate import Simulator
+
+        sim = Simulator(self.programs, self.stations, workers=workers or self.workers,
+                        streamer=streamer)
+        return sim.run(start, days)
+
+    def reattach_recordings(self):
+        """Reattach to captures still running from a previous server process on this host
+        (or finish post-processing for ones that ended in the meantime); captures owned by
+        another live process (e.g. a second cluster node on this host) are left alone
+
+        :return: list of pathnames of reattached recordings
+        """
+        if not inflight.registry:
+            return []
+        paths = []
+        for entry in inflight.registry.orphaned():
+            if entry['path'] in self.reattached or not inflight.registry.claim(entry):
+                continue
+            self.reattached.add(entry['path'])
+            dest_dir = self.station_dir(entry['path'])
+            self.sched.add_job(reattach_recording,
+                               args=(self.streamer, self.cfg_profile, entry, dest_dir),
+                               name="Reattach \"%s\"" % (entry['path']),
+                               jobstore=INTERNAL_JOBSTORE, executor=EXECUTOR)
+            paths.append(entry['path'])
+        if paths:
+            log.info("Reattaching to %d in-flight recording(s)" % (len(paths)))
+        return paths
+
+    def station_dir(self, path):
+        """
+        :param path: pathname of recording (possibly in staging directory)
+        :return: station directory in ``rec_dir`` for recording
+        """
+        return os.path.join(self.rec_path, os.path.basename(os.path.dirname(path)))
+
+    def publish_staged(self):
+        """Publish recordings left in the staging directory (e.g. by a crash, or a failed
+        publish), other than in-flight captures
+
+        :return: list of pathnames of published recordings
+        """
+        active = set(self.reattached)
+        if inflight.registry:
+            active.update(entry['path'] for entry in inflight.registry.entries())
+        published = []
+        for path in staged_files(self.cfg_profile):
+            # leave files that may still be written to (e.g. orphaned captures)
+            if path in active or time.time() - os.path.getmtime(path) < MIN_STAGED_AGE:
+                continue
+            dest_dir = self.station_dir(path)
+            os.makedirs(dest_dir, exist_ok=True)
+            new_path = publish(path, dest_dir, self.cfg_profile)
+            if new_path != path:
+                published.append(new_path)
+        return published
+
+    def upcoming_recordings(self, secs):
+        """
+        :param secs: look-ahead window
+        :return: list of dicts (``media_type``, ``duration``, ``bitrate``) for recordings
+                 scheduled to start within ``secs``
+        """
+        cutoff = dt.datetime.now(dt.timezone.utc) + dt.timedelta(0, secs)
+        upcoming = []
+        if self.jobstore:
+            for row in self.jobstore.list_jobs(due_before=cutoff, func=RECORD_FUNC):
+                upcoming.append({'media_type': row['args'][3],
+                                 'duration'  : row['duration'],
+                                 'bitrate'   : row['kwargs'].get('bitrate')})
+            return upcoming
+        for job in self.sched.get_jobs(JOBSTORE):
+            if job.func_ref != RECORD_FUNC or not job.next_run_time:
+                continue
+            if job.next_run_time > cutoff:
+                continue
+            duration = job.args[5]
+            if isinstance(duration, str):
+                duration = str2timedelta(duration).seconds
+            upcoming.append({'media_type': job.args[3],
+                             'duration'  : duration,
+                             'bitrate'   : job.kwargs.get('bitrate')})
+        return upcoming
+
+    def on_job_executed(self, event):
+        """Scheduler listener: queue post-processing of completed recordings (peaks, and
+        program alignment) on the background executor
+        """
+        outcome = event.retval
+        if not isinstance(outcome, dict) or not outcome.get('path'):
+            return
+        paths = outcome.get('segments') or [outcome['path']]
+        if peaks_enabled(self.cfg_profile):
+            self.sched.add_job(make_peaks, args=(paths, self.cfg_profile),
+                               name="Peaks for %s" % (event.job_id),
+                               jobstore=INTERNAL_JOBSTORE, executor=BACKGROUND_EXECUTOR)
+        program = self.programs.get(outcome.get('job_id')) or {}
+        if program.get('align') and align_enabled(self.cfg_profile):
+            rec_ids = outcome.get('rec_ids') or [None] * len(paths)
+            self.sched.add_job(align_recordings,
+                               args=(list(zip(paths, rec_ids)), program['align'],
+                                     self.cfg_profile),
+                               name="Alignment for %s" % (event.job_id),
+                               jobstore=INTERNAL_JOBSTORE, executor=BACKGROUND_EXECUTOR)
+
+    def on_job_done(self, event):
+        """Scheduler listener: discard snapshot of one-off job (see ``CaptureExecutor``)
+        """
+        self.executor.pop_job(event.job_id)
+
+    def on_store_changed(self):
+        """Job store changed by another process (see ``ChangeWatcher``): reschedule, and
+        invalidate cached API responses
+        """
+        self.generation += 1
+        self.sched.wakeup()
+
+    def on_job_missed(self, event):
+        """Scheduler listener: join a missed recording late (e.g. after a restart), for the
+        remainder of the occurrence window, if still open; missed jobs are all submitted
+        right away, so they start in parallel (up to executor capacity)
+        """
+        # one-off jobs may already be removed from the job store (use snapshot)
+        snapshot = self.executor.pop_job(event.job_id)
+        if not self.late_join or event.jobstore != JOBSTORE:
+            return
+        job = self.sched.get_job(event.job_id, JOBSTORE) or snapshot
+        if not job or job.func_ref != 'dar:do_record':
+            return
+        args = list(job.args)
+        # duration is the last positional arg (see ``schedule_item()``)
+        start = event.scheduled_run_time.timestamp()
+        remaining = int(start + args[-1] - time.time())
+        if remaining < self.min_late_join:
+            log.info("Not joining missed job \"%s\" (%d secs remaining)" % (job.id, remaining))
+            return
+        args[-1] = remaining
+        kwargs = dict(job.kwargs, late_start=start)
+        log.info("Joining missed job \"%s\" late, for %d secs" % (job.id, remaining))
+        self.sched.add_job(do_record, args=args, kwargs=kwargs, jobstore=INTERNAL_JOBSTORE,
+                           executor=EXECUTOR, name="%s [late join]" % (job.name))
+
+    def get_peaks(self, rec_id, width = None, level = None):
+        """Get waveform peaks for recording (see ``peaks.read_peaks()``)
+
+        :param rec_id: recording ID (in catalog)
+        :param width: [optional] number of peaks wanted (e.g. pixels), defaults to 2000
+        :param level: [optional] level number (0 is finest)
+        :return: dict (or None, if recording or peaks not found)
+        """
+        if not catalog.catalog:
+            return None
+        rec = catalog.catalog.get_recording(int(rec_id))
+        if not rec:
+            return None
+        return read_peaks(rec['path'], width, level)
+
+    def relay_stream(self, station):
+        """Listen to station through relay (see ``relay.py``)
+
+        :param station: station name
+        :return: tuple (media type, iterator of bytes), or None if relay not enabled
+        """
+        if not relay.hub:
+            return None
+        return relay.hub.listen(station)
+
+    def get_relay(self):
+        """
+        :return: dict with status of active station relays (or None, if not enabled)
+        """
+        return relay.hub.get_status() if relay.hub else None
+
+    def get_cluster(self):
+        """
+        :return: dict with cluster status (or None, if not clustered)
+        """
+        return cluster.node.get_status() if cluster.node else None
+
+    def takeover(self, claim):
+        """Record remainder of an occurrence claimed from another node (invoked from the
+        cluster heartbeat thread)
+
+        :param claim: cluster claim (dict)
+        """
+        duration = int(claim['end_time'] - time.time())
+        job = self.sched.get_job(claim['job_id'], JOBSTORE)
+        if job:
+            # duration is the last positional arg (see ``schedule_item()``)
+            args = list(job.args[:-1]) + [duration]
+            kwargs = dict(job.kwargs, claim=claim)
+            name = job.name
+        elif claim.get('spec'):
+            # job no longer in the job store (e.g. one-off job, removed once submitted)
+            args = claim['spec']['args'] + [duration]
+            kwargs = dict(claim['spec']['kwargs'], claim=claim)
+            name = claim['job_id']
+        else:
+            log.info("Job \"%s\" not found for takeover" % (claim['job_id']))
+            cluster.node.release(claim, failed=True)
+            return
+        self.sched.add_job(do_record, args=args, kwargs=kwargs, jobstore=INTERNAL_JOBSTORE,
+                           name="%s [takeover]" % (name))
+
     @property
     def state(self):
         """
@@ -270,18 +923,41 @@ class Dar(object):
         """
         :return: bool
         """
+        self.generation += 1
         if self.state == DarState.STARTED:
             return False
         if self.state == DarState.PAUSED:
             self.sched.resume()
         else:
             self.sched.start()
+        if self.watcher:
+            self.watcher.start()
+        if cluster.node:
+            cluster.node.start(self.takeover)
+        playlists = get_playlists(self.cfg_profile)
+        if playlists:
+            playlists.start_refresh(self.station_urls())
+        self.reattach_recordings()
+        if warmpool.pool:
+            warmpool.pool.start(self.sched, INTERNAL_JOBSTORE, BACKGROUND_EXECUTOR)
+        self.sched.add_job(self.publish_staged, name="Publish staged recordings",
+                           jobstore=INTERNAL_JOBSTORE, executor=BACKGROUND_EXECUTOR)
+        start_archive(self.sched, INTERNAL_JOBSTORE, BACKGROUND_EXECUTOR, self.streamer,
+                      self.cfg_profile)
+        start_retention(self.sched, INTERNAL_JOBSTORE, BACKGROUND_EXECUTOR, self.streamer,
+                        self.rec_path, self.upcoming_recordings, self.cfg_profile)
+        if self.guides:
+            self.sched.add_job(self.sync_guides, 'interval', seconds=self.guide_cfg['interval'],
+                               next_run_time=dt.datetime.now(), id='guides', name='Guide sync',
+                               jobstore=INTERNAL_JOBSTORE, executor=BACKGROUND_EXECUTOR,
+                               replace_existing=True, coalesce=True, max_instances=1)
         return True
 
     def pause_scheduler(self):
         """
         :return: bool
         """
+        self.generation += 1
         if self.state != DarState.STARTED:
             return False
         self.sched.pause()
@@ -291,6 +967,7 @@ class Dar(object):
         """
         :return: bool
         """
+        self.generation += 1
         if self.state != DarState.PAUSED:
             return False
         self.sched.resume()
@@ -300,8 +977,18 @@ class Dar(object):
         """
         :return: bool
         """
+        self.generation += 1
         if self.state == DarState.SHUTDOWN:
             return False
+        if self.watcher:
+            self.watcher.stop()
+        if cluster.node:
+            cluster.node.stop()
+        playlists = get_playlists(self.cfg_profile)
+        if playlists:
+            playlists.stop_refresh()
+        if warmpool.pool:
+            warmpool.pool.stop()
         self.sched.shutdown(wait=wait_for_jobs)
         return True
 
@@ -312,7 +999,27 @@ class Dar(object):
         # REVISIT: should we reset the state of the scheduler before returning???
         if not self.sched.running:
             self.sched.start(paused=True)
-        return self.sched.get_jobs()
+        return self.sched.get_jobs(JOBSTORE)
+
+    def list_todos(self, station = None):
+        """List todo items (with the native job store, this is an index query, and jobs are
+        not reconstituted)
+
+        :param station: [optional] station name
+        :return: list of dicts (``id``, ``status``, ``info``)
+        """
+        if self.jobstore:
+            rows = self.jobstore.list_jobs(station=station)
+            return [{'id'    : row['id'],
+                     'status': TodoState.QUEUED if row['next_run_time'] else TodoState.SUSPENDED,
+                     'info'  : describe_job(row)} for row in rows]
+        todos = []
+        for job in self.get_jobs():
+            if station and job.kwargs.get('station') != station:
+                continue
+            status = TodoState.QUEUED if job.next_run_time else TodoState.SUSPENDED
+            todos.append({'id': job.id, 'status': status, 'info': str(job)})
+        return todos
 
     def get_job(self, job_id):
         """
@@ -321,10 +1028,50 @@ class Dar(object):
         # REVISIT: should we reset the state of the scheduler before returning???
         if not self.sched.running:
             self.sched.start(paused=True)
-        return self.sched.get_job(job_id)
+        return self.sched.get_job(job_id, JOBSTORE)
 
-    def schedule_item(self, label, item_info):
+    def record_station(self, station, duration):
+        """Start manual recording of station right away (through the warm pool, if enabled
+        and the station media type is supported by the pool's streamer)
+
+        :param station: station name
+        :param duration: seconds (int) or [HH:]MM:SS (str)
+        :return: job ID (str)
+        """
+        if station not in self.stations:
+            raise KeyError(station)
+        label = "%s%s:%s" % (RECORD_PREFIX, station, dt.datetime.now().strftime('%Y%m%d%H%M%S'))
+        item_info = {'station': station,
+                     'schedule': {'type': ScheduleType.IMMEDIATE, 'duration': duration}}
+        media_type = self.stations[station]['media_type']
+        if warmpool.pool:
+            engine = Streamer.get(self.warm_cfg['streamer'], self.cfg_profile)
+            if media_type in engine.info['media_types']:
+                self.schedule_item(label, item_info, engine.name, WARM_EXECUTOR)
+                return label
+            log.info("Media type \"%s\" not supported by warm pool, recording \"%s\" cold" %
+                     (media_type, station))
+        self.schedule_item(label, item_info)
+        return label
+
+    def get_warm_pool(self):
         """
+        :return: dict with warm pool status (or None, if not enabled)
+        """
+        return warmpool.pool.get_status() if warmpool.pool else None
+
+    def get_priorities(self):
+        """
+        :return: dict with settings, and CPU secs consumed, per priority class
+        """
+        return priority.classes.get_status()
+
+    def schedule_item(self, label, item_info, streamer = None, executor = EXECUTOR):
+        """
+        :param label: job ID
+        :param item_info: program config (``station``, ``schedule``, ...)
+        :param streamer: [optional] streamer name in config.yml (defaults to the DAR streamer)
+        :param executor: [optional] executor alias
         """
         station_name = item_info['station']
         sched_info   = item_info['schedule']
@@ -346,12 +1093,20 @@ class Dar(object):
         trigger      = schedule_trigger(sched_info)
 
         name         = "%s [dur %s]" % (label, str(dt.timedelta(0, duration)))
-        args         = (self.streamer, self.cfg_profile, url, media_type, filebase, duration)
+        args         = (streamer or self.streamer, self.cfg_profile, url, media_type, filebase,
+                        duration)
         # TODO: get parameters for the streamer from the config file (hard-wiring
         # values to use for now)!!!
-        kwargs       = {'add_ts': True, 'verbose': 1}
+        kwargs       = {'add_ts': True, 'verbose': 1, 'job_id': label, 'station': station_name}
+        if isinstance(station['stream_url'], list):
+            kwargs['mirrors'] = station['stream_url']
+        if station.get('bitrate'):
+            kwargs['bitrate'] = station['bitrate']
+        if item_info.get('redundancy'):
+            kwargs['redundancy'] = int(item_info['redundancy'])
         self.sched.add_job('dar:do_record', trigger, args=args, kwargs=kwargs, id=label,
-                           name=name, replace_existing=True, misfire_grace_time=300)
+                           name=name, jobstore=JOBSTORE, executor=executor,
+                           replace_existing=True, misfire_grace_time=MISFIRE_GRACE_TIME)
 
     def reload_programs(self, do_create = True, do_update = True, do_pause = False):
         """Reload program definitions from ``config.yml`` and schedule jobs for them automatically
@@ -361,11 +1116,14 @@ class Dar(object):
         :param do_pause: pause jobs for programs not found in config (defaults to False)
         :return: {'created': set(<ids>), 'updated': set(<ids>), 'paused': set(<ids>)}
         """
+        self.generation += 1
         # REVISIT: should we reset the state of the scheduler before returning???
         if not self.sched.running:
             self.sched.start(paused=True)
 
-        current_jobs = set([job.id for job in self.sched.get_jobs()])
+        # note: guide-derived programs are managed by ``sync_guides()``
+        current_jobs = set([job.id for job in self.sched.get_jobs(JOBSTORE)
+                            if not job.id.startswith((GUIDE_PREFIX, RECORD_PREFIX))])
         loaded_jobs  = set()
         created_jobs = set()
         updated_jobs = set()
@@ -397,12 +1155,67 @@ class Dar(object):
             if truthy(do_pause):
                 log.debug("Pausing job for program \"%s\"" % (job_id))
                 paused_jobs.add(prog)
-                self.sched.get_job(job_id).pause()
+                self.sched.get_job(job_id, JOBSTORE).pause()
             else:
                 log.debug("NOT pausing job for program \"%s\"" % (job_id))
 
         return {'created': created_jobs, 'updated': updated_jobs, 'paused': paused_jobs}
 
+    def sync_guides(self):
+        """Import programs from station guides, and apply only the changes (added, changed
+        or removed programs) to the job store
+
+        :return: {'created': set(<ids>), 'updated': set(<ids>), 'removed': set(<ids>)}
+                 (or None, if guides are not enabled)
+        """
+        self.generation += 1
+        if not self.guides:
+            return None
+        if not self.sched.running:
+            self.sched.start(paused=True)
+
+        programs = self.guides.fetch_all(self.guide_cfg['stations'])
+        with self.guides.lock:
+            current_jobs = set([job.id for job in self.sched.get_jobs(JOBSTORE)
+                                if job.id.startswith(GUIDE_PREFIX)])
+            created_jobs = set()
+            updated_jobs = set()
+            removed_jobs = set()
+            applied      = {}
+
+            for label, info in programs.items():
+                if info['station'] not in self.stations:
+                    log.info("Skipping guide program \"%s\" (unknown station)" % (label))
+                    continue
+                digest = program_digest(info)
+                if label in current_jobs and self.guides.applied.get(label) == digest:
+                    applied[label] = digest
+                    continue
+                # note: a malformed guide entry (bad days or times) only skips that program
+                try:
+                    self.schedule_item(label, info)
+                except (ConfigError, NotImplementedError, ValueError, KeyError, TypeError,
+                        AttributeError) as e:
+                    log.info("Skipping guide program \"%s\": %s" % (label, e))
+                    continue
+                applied[label] = digest
+                (updated_jobs if label in current_jobs else created_jobs).add(label)
+
+            for job_id in current_jobs.difference(applied):
+                log.debug("Removing job for guide program \"%s\"" % (job_id))
+                self.sched.remove_job(job_id, JOBSTORE)
+                removed_jobs.add(job_id)
+
+            if applied != self.guides.applied:
+                self.guides.applied = applied
+                self.guides.dirty = True
+            self.guides.save()
+
+        if created_jobs or updated_jobs or removed_jobs:
+            log.info("Guide sync: %d created, %d updated, %d removed" %
+                     (len(created_jobs), len(updated_jobs), len(removed_jobs)))
+        return {'created': created_jobs, 'updated': updated_jobs, 'removed': removed_jobs}
+
 class Station(object):
     """
     - Create
@@ -563,15 +1376,15 @@ import click
 @click.option('--streamer', default='vlc', help="Name of streamer in config file (defaults to 'vlc')")
 @click.option('--debug',    default=0, help="Debug level (0-3)")
 @click.option('--profile',  default=None, type=str, help="Profile in config.yml")
+@click.option('--node',     default=None, type=str, help="Cluster node name (enables clustering)")
 #@click.argument('name',    default='all', required=True)
-def main(list_jobs, reload, norun, run_time, nowait, streamer, debug, profile):
+def main(list_jobs, reload, norun, run_time, nowait, streamer, debug, profile, node):
     """Digital Audio Recorder command line interface
     """
     if debug > 0:
-        log.setLevel(logging.DEBUG if debug > 1 else logging.INFO)
-        log.addHandler(dbg_hand)
+        debug_logging(logging.DEBUG if debug > 1 else logging.INFO)
 
-    dar = Dar(streamer, debug, profile)
+    dar = Dar(streamer, debug, profile, node)
 
     if reload:
         print("Loading/reloading jobs from config file...")
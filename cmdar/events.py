@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+"""Event bus - in-process publication of scheduler events to any number of subscribers
+(e.g. server-sent event streams), with a bounded replay buffer so that reconnecting
+clients can catch up from the last event ID they saw
+
+Event IDs are sequence numbers within a bus; as seen by clients, they are prefixed by the
+bus epoch (``<epoch>-<seq>``), so that an ID from a previous process (or bus) is not
+mistaken for a position in the current sequence.
+"""
+
+import json
+import time
+import threading
+from collections import deque
+
+BUFFER_SIZE = 1000
+KEEPALIVE   = 15  # secs
+
+############
+# EventBus #
+############
+
+class EventBus(object):
+    """Publish/subscribe for events; publishers never block on subscribers (subscribers
+    read from the shared replay buffer at their own pace)
+    """
+    def __init__(self, size = BUFFER_SIZE):
+        """
+        :param size: number of events kept for replay
+        """
+        self.buffer  = deque(maxlen=size)
+        self.last_id = 0
+        self.epoch   = int(time.time() * 1000)
+        self.cond    = threading.Condition()
+
+    def publish(self, name, data):
+        """
+        :param name: event name
+        :param data: event data (JSON-serializable)
+        :return: event ID (int)
+        """
+        with self.cond:
+            self.last_id += 1
+            self.buffer.append((self.last_id, name, time.time(), data))
+            self.cond.notify_all()
+            return self.last_id
+
+    def parse_id(self, event_id):
+        """Get sequence number for event ID from a client (e.g. ``Last-Event-ID``)
+
+        :param event_id: str (``<epoch>-<seq>``, or just ``<seq>``), or None
+        :return: int (0, if the ID is from a different epoch), or None
+        :raises ValueError: if ``event_id`` is not a valid event ID
+        """
+        if event_id is None:
+            return None
+        epoch, sep, seq = str(event_id).rpartition('-')
+        if sep and int(epoch) != self.epoch:
+            # events in the buffer all postdate the last one seen by the client
+            return 0
+        return int(seq)
+
+    def events_after(self, last_id):
+        """
+        :param last_id: last event ID seen by subscriber
+        :return: list of (id, name, time, data) tuples, in order
+        """
+        with self.cond:
+            if not self.buffer or self.buffer[-1][0] <= last_id:
+                return []
+            # buffer IDs are contiguous, so index directly instead of scanning
+            start = max(last_id + 1 - self.buffer[0][0], 0)
+            return [self.buffer[i] for i in range(start, len(self.buffer))]
+
+    def subscribe(self, last_id = None, keepalive = KEEPALIVE, stop = None):
+        """Generator of events; yields None after ``keepalive`` secs with no events (so that
+        the caller can send a keepalive, or detect a closed connection)
+
+        :param last_id: last event ID seen (None means only new events, 0 means replay all)
+        :param keepalive: secs
+        :param stop: [optional] threading.Event to end the subscription
+        :return: generator of (id, name, time, data) tuples (or None)
+        """
+        if last_id is None:
+            last_id = self.last_id
+        elif last_id > self.last_id:
+            # ID from an earlier sequence (e.g. before a restart), replay the whole buffer
+            last_id = 0
+        while not (stop and stop.is_set()):
+            with self.cond:
+                if self.last_id <= last_id:
+                    self.cond.wait(keepalive)
+            events = self.events_after(last_id)
+            if not events:
+                yield None
+                continue
+            for event in events:
+                yield event
+            last_id = events[-1][0]
+
+def sse_format(event, epoch = None):
+    """Format event for ``text/event-stream``
+
+    :param event: (id, name, time, data) tuple, or None for a keepalive comment
+    :param epoch: [optional] bus epoch, to prefix the event ID with
+    :return: str
+    """
+    if event is None:
+        return ": keepalive\n\n"
+    event_id, name, when, data = event
+    payload = json.dumps({'time': when, 'data': data}, default=str)
+    event_id = "%d-%d" % (epoch, event_id) if epoch else "%d" % (event_id)
+    return "id: %s\nevent: %s\ndata: %s\n\n" % (event_id, name, payload)
+
+# bus for the current process
+bus = EventBus()
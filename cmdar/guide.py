@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""Program guides - import of station schedules into program definitions
+
+Each station with a guide (``guides`` config) names an importer (subclass of ``Guide``)
+and a guide URL (``http:``, ``https:`` or ``file:``).  Guides are fetched with conditional
+revalidation, and parsed guides are cached (along with their validators) in a cache file,
+so an unchanged guide is neither downloaded nor parsed again.  The resulting programs have
+the same structure as the ``programs`` config section, so they are scheduled through
+``Dar.schedule_item()``; only programs that were added, changed or removed are written to
+the job store (see ``Dar.sync_guides()``).
+"""
+
+import os
+import re
+import sys
+import json
+import hashlib
+import threading
+
+from core import cfg, log
+from utils import conditional_get
+
+##########
+# config #
+##########
+
+GUIDE_DFLTS = {'enabled'   : False,
+               'interval'  : 3600,   # secs (between syncs)
+               'timeout'   : 10,     # secs (HTTP request)
+               'cache_file': 'guides.json',
+               'stations'  : {}}
+
+# job IDs for guide-derived programs (distinguishes them from configured programs)
+GUIDE_PREFIX = 'guide:'
+
+def guide_params(cfg_profile = None):
+    """Get guide parameters (config overlaid on defaults)
+
+    :param cfg_profile: optional (None means ``default``)
+    :return: dict
+    """
+    params = dict(GUIDE_DFLTS)
+    params.update(cfg.config('guides', cfg_profile))
+    return params
+
+def program_digest(info):
+    """
+    :param info: program definition (dict)
+    :return: str (stable across runs, for detecting changed programs)
+    """
+    return hashlib.sha1(json.dumps(info, sort_keys=True).encode()).hexdigest()
+
+##############
+# base class #
+##############
+
+class Guide(object):
+    """Obtain importer subclass by name (as specified in ``guides`` config for a station)
+    """
+    @classmethod
+    def get(cls, name):
+        """
+        :param name: importer class name (e.g. ``JsonGuide``)
+        """
+        subcls = getattr(sys.modules[cls.__module__], name, None)
+        if not (isinstance(subcls, type) and issubclass(subcls, Guide)) or subcls is Guide:
+            raise RuntimeError("Guide importer \"%s\" not known" % (name))
+        return subcls
+
+    @classmethod
+    def parse(cls, body, station):
+        """Parse guide content into program entries
+
+        :param body: guide content (bytes)
+        :param station: station name
+        :return: list of dicts with ``title``, and schedule keys (``days``, ``start_time``,
+                 and ``end_time`` or ``duration``)
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def programs(cls, body, station, titles = None):
+        """Parse guide, and convert entries to program definitions
+
+        :param body: guide content (bytes)
+        :param station: station name
+        :param titles: [optional] list of regexes; only matching titles are imported
+        :return: dict of program definitions (``programs`` config format), keyed by label
+        """
+        patterns = [re.compile(title, re.IGNORECASE) for title in titles or []]
+        programs = {}
+        for entry in cls.parse(body, station):
+            if not isinstance(entry, dict) or not isinstance(entry.get('title'), str):
+                log.info("Skipping bad guide entry for \"%s\": %r" % (station, entry))
+                continue
+            title = entry['title'].strip()
+            if patterns and not any(p.search(title) for p in patterns):
+                continue
+            schedule = {'type': 'weekly'}
+            for key in ('days', 'start_time', 'end_time', 'duration'):
+                if entry.get(key):
+                    schedule[key] = entry[key]
+            label = "%s%s:%s (%s %s)" % (GUIDE_PREFIX, station, title, schedule.get('days'),
+                                        schedule.get('start_time'))
+            programs[label] = {'station': station, 'schedule': schedule}
+        return programs
+
+#############
+# JsonGuide #
+#############
+
+class JsonGuide(Guide):
+    """Guide as a JSON list of programs (or an object with a ``programs`` list), each with
+    ``title``, ``days``, ``start_time``, and ``end_time`` or ``duration``
+    """
+    @classmethod
+    def parse(cls, body, station):
+        data = json.loads(body.decode('utf-8'))
+        entries = data['programs'] if isinstance(data, dict) else data
+        if not isinstance(entries, list):
+            raise RuntimeError("Bad guide format for station \"%s\"" % (station))
+        return entries
+
+##############
+# GuideCache #
+##############
+
+class GuideCache(object):
+    """Parsed guides (with validators for conditional revalidation), and digests of the
+    programs last applied to the job store; persisted as JSON
+    """
+    def __init__(self, path, timeout = GUIDE_DFLTS['timeout']):
+        """
+        :param path: pathname of cache file
+        :param timeout: secs for HTTP requests
+        """
+        self.path    = path
+        self.timeout = timeout
+        self.lock    = threading.Lock()
+        self.guides  = {}  # {station: {'url', 'etag', 'last_modified', 'programs'}}
+        self.applied = {}  # {label: digest}
+        self.dirty   = False
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                self.guides  = data.get('guides', {})
+                self.applied = data.get('applied', {})
+            except (OSError, ValueError) as e:
+                log.info("Ignoring unreadable guide cache \"%s\": %s" % (path, e))
+
+    def save(self):
+        """Write cache file (atomically), if anything changed
+        """
+        if not self.dirty:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'guides': self.guides, 'applied': self.applied}, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def fetch(self, station, info):
+        """Get programs from guide for station, revalidating cached guide; if the guide
+        cannot be fetched or parsed, the cached programs (if any) are returned
+
+        :param station: station name
+        :param info: guide config for station (``importer``, ``url``, ``titles``)
+        :return: dict of program definitions, keyed by label
+        """
+        importer_name = info.get('importer', 'JsonGuide')
+        titles = info.get('titles')
+        # cached programs are already filtered by ``titles``, so the cache is only valid
+        # for the same guide config
+        cached = self.guides.get(station)
+        if cached and (cached['url'] != info['url'] or
+                       cached.get('importer') != importer_name or
+                       cached.get('titles') != titles):
+            cached = None
+        etag, modified = (cached['etag'], cached['last_modified']) if cached else (None, None)
+        try:
+            body, etag, modified = conditional_get(info['url'], etag, modified, self.timeout)
+            if body is None:
+                log.debug("Guide for \"%s\" not modified" % (station))
+                return cached['programs']
+            importer = Guide.get(importer_name)
+            programs = importer.programs(body, station, titles)
+        except Exception as e:
+            log.info("Could not fetch guide for \"%s\": %s" % (station, e))
+            return cached['programs'] if cached else {}
+        log.info("Guide for \"%s\" updated (%d programs)" % (station, len(programs)))
+        self.guides[station] = {'url'          : info['url'],
+                                'importer'     : importer_name,
+                                'titles'       : titles,
+                                'etag'         : etag,
+                                'last_modified': modified,
+                                'programs'     : programs}
+        self.dirty = True
+        return programs
+
+    def fetch_all(self, stations):
+        """
+        :param stations: ``stations`` entry in guides config
+        :return: dict of program definitions for all stations, keyed by label
+        """
+        programs = {}
+        with self.lock:
+            for station, info in stations.items():
+                programs.update(self.fetch(station, info))
+        return programs
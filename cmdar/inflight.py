@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""In-flight recordings - durable registry of running capture processes
+
+Capture processes are started in their own session (with stderr written to a file, rather
+than a pipe), so that they survive the server process.  Each running capture is recorded
+in the registry (pid, output file, scheduled end); when the server starts again, the
+registry is used to reattach to the surviving captures (and to finish post-processing for
+captures that ended in the meantime), see ``Dar.reattach_recordings()``.
+
+Each entry also records its owner (the server process that started, or has reattached to,
+the capture).  Other processes on the same host (e.g. a second cluster node, or the
+command line tool) only reattach to entries whose owner is no longer running, and take
+over ownership atomically, so a capture is never monitored or post-processed twice.
+"""
+
+import os
+import time
+import signal
+import socket
+
+from sqlalchemy import (create_engine, MetaData, Table, Column, String, Integer, Float,
+                        Text, select, delete, insert, update)
+
+from core import log
+from catalog import add_columns
+
+STDERR_SUFFIX = '.stderr'
+POLL_INTERVAL = 1.0  # secs (waiting for a reattached process to exit)
+
+##########
+# schema #
+##########
+
+metadata = MetaData()
+
+inflight_tab = Table('dar_inflight', metadata,
+                     Column('path', String(767), primary_key=True),
+                     Column('host', String(191), nullable=False),
+                     Column('pid', Integer, nullable=False),
+                     Column('proc_start', Float),   # process start time (guards pid reuse)
+                     Column('job_id', String(191)),
+                     Column('station', String(64)),
+                     Column('url', Text),
+                     Column('media_type', String(64)),
+                     Column('started', Float, nullable=False),
+                     Column('end_time', Float, nullable=False),
+                     Column('owner_pid', Integer),      # server process owning the entry
+                     Column('owner_start', Float))
+
+def process_start(pid):
+    """
+    :param pid: process ID
+    :return: process start time (clock ticks since boot), or None if not available
+    """
+    try:
+        with open('/proc/%d/stat' % (pid)) as f:
+            stat = f.read()
+        # skip past command name (which may contain spaces)
+        return float(stat[stat.rindex(')') + 2:].split()[19])
+    except (OSError, ValueError, IndexError):
+        return None
+
+def pid_alive(pid, proc_start = None):
+    """
+    :param pid: process ID
+    :param proc_start: [optional] expected process start time
+    :return: bool (False if pid now belongs to a different process)
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return proc_start is None or process_start(pid) in (proc_start, None)
+
+#####################
+# ReattachedProcess #
+#####################
+
+class ReattachedProcess(object):
+    """Stand-in for ``subprocess.Popen``, for a capture process that is not a child of the
+    current process (exit status is not available)
+    """
+    def __init__(self, pid, proc_start = None):
+        self.pid        = pid
+        self.proc_start = proc_start
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None and not pid_alive(self.pid, self.proc_start):
+            self.returncode = 0
+        return self.returncode
+
+    def wait(self, timeout = None):
+        deadline = time.time() + timeout if timeout else None
+        while self.poll() is None:
+            if deadline and time.time() >= deadline:
+                return None
+            time.sleep(POLL_INTERVAL)
+        return self.returncode
+
+    def terminate(self):
+        if self.poll() is None:
+            os.kill(self.pid, signal.SIGTERM)
+
+####################
+# InflightRegistry #
+####################
+
+# registry for the current process (set up by ``Dar``)
+registry = None
+
+class InflightRegistry(object):
+    """Registry of running captures, for this host
+    """
+    def __init__(self, db_url, engine = None):
+        """
+        :param db_url: SQLAlchemy URL
+        :param engine: [optional] existing engine for ``db_url`` (e.g. shared with job store)
+        """
+        self.host   = socket.gethostname()
+        self.engine = engine or create_engine(db_url, connect_args={'timeout': 30,
+                                                                    'check_same_thread': False}
+                                              if db_url.startswith('sqlite:') else {})
+        # owner of entries added (or claimed) by this process
+        self.owner_pid   = os.getpid()
+        self.owner_start = process_start(self.owner_pid)
+        metadata.create_all(self.engine)
+        add_columns(self.engine, [inflight_tab])
+
+    def add(self, proc, path, duration, job_id = None, station = None, url = None,
+            media_type = None):
+        """
+        :param proc: subprocess.Popen for capture process
+        :param path: pathname of output file
+        :param duration: secs (scheduled)
+        """
+        now = time.time()
+        with self.engine.begin() as conn:
+            conn.execute(delete(inflight_tab).where(inflight_tab.c.path == path))
+            conn.execute(insert(inflight_tab).values(path=path, host=self.host, pid=proc.pid,
+                                                     proc_start=process_start(proc.pid),
+                                                     job_id=job_id, station=station, url=url,
+                                                     media_type=media_type, started=now,
+                                                     end_time=now + duration,
+                                                     owner_pid=self.owner_pid,
+                                                     owner_start=self.owner_start))
+
+    def remove(self, path):
+        """Remove entry (only if owned by this process)
+
+        :param path: pathname of output file
+        """
+        with self.engine.begin() as conn:
+            conn.execute(delete(inflight_tab).where(inflight_tab.c.path == path,
+                                                    inflight_tab.c.host == self.host,
+                                                    inflight_tab.c.owner_pid == self.owner_pid))
+
+    def entries(self):
+        """
+        :return: list of dicts for captures registered on this host
+        """
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(inflight_tab)
+                                .where(inflight_tab.c.host == self.host)
+                                .order_by(inflight_tab.c.started)).mappings()
+            return [dict(row) for row in rows]
+
+    def orphaned(self):
+        """
+        :return: list of dicts for captures registered on this host whose owner process is
+                 no longer running
+        """
+        orphans = []
+        for entry in self.entries():
+            owner = entry['owner_pid']
+            if not (owner and pid_alive(owner, entry['owner_start'])):
+                orphans.append(entry)
+        return orphans
+
+    def claim(self, entry):
+        """Take over ownership of an orphaned entry (atomically, so that only one process
+        reattaches to a capture)
+
+        :param entry: registry entry (dict, see ``orphaned()``)
+        :return: bool (whether ownership was taken)
+        """
+        owner = inflight_tab.c.owner_pid
+        with self.engine.begin() as conn:
+            res = conn.execute(update(inflight_tab)
+                               .where(inflight_tab.c.path == entry['path'],
+                                      inflight_tab.c.host == self.host,
+                                      owner == entry['owner_pid'] if entry['owner_pid']
+                                      else owner.is_(None))
+                               .values(owner_pid=self.owner_pid, owner_start=self.owner_start))
+            return res.rowcount == 1
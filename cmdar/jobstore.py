@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+
+"""Job store database - SQLite setup for concurrent access by the server and the command
+line tool (and other DAR nodes on the same host)
+
+The database is put in WAL mode (readers never block the writer, and vice versa), with a
+busy timeout so that lock contention waits rather than fails, and a single engine (shared
+connection pool) per database for all users within the process.  Changes committed by
+other processes are detected by polling ``PRAGMA data_version``, so that the scheduler
+can be woken up to pick up new or modified jobs right away.
+
+Jobs are stored either by apscheduler's ``SQLAlchemyJobStore`` (``job_store: pickle``, each
+job pickled whole), or by ``NativeJobStore`` (``job_store: native``), which keeps jobs in a
+schema'd table: station, duration, trigger spec (JSON, triggers are rebuilt on load),
+args and state in columns of their own, with indexes on next run time and station, so
+that todo items can be listed and filtered with index queries (see ``list_jobs()``),
+without reconstituting apscheduler jobs.
+"""
+
+import json
+import threading
+
+from sqlalchemy import (create_engine, event, inspect, MetaData, Table, Column, Unicode,
+                        String, Integer, Float, Text, select, insert, update, delete, and_)
+from sqlalchemy.exc import IntegrityError
+from apscheduler.job import Job
+from apscheduler.jobstores.base import BaseJobStore, ConflictingIdError, JobLookupError
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.util import (datetime_to_utc_timestamp, utc_timestamp_to_datetime,
+                              datetime_repr)
+
+from core import log
+from utils import LOV, str2timedelta
+
+##########
+# config #
+##########
+
+JobStoreType = LOV(['PICKLE',
+                    'NATIVE'], 'lower')
+
+JOBSTORE_DFLTS = {'job_store'   : JobStoreType.PICKLE,
+                  'wal'         : True,
+                  'busy_timeout': 30,    # secs
+                  'change_poll' : 2}     # secs (0 disables change notification)
+
+def jobstore_params(scheduler_cfg):
+    """
+    :param scheduler_cfg: ``scheduler`` config section (dict)
+    :return: dict
+    """
+    return {key: scheduler_cfg.get(key, dflt) for key, dflt in JOBSTORE_DFLTS.items()}
+
+##########
+# engine #
+##########
+
+engines = {}
+engines_lock = threading.Lock()
+
+def jobstore_engine(db_path, wal = True, busy_timeout = JOBSTORE_DFLTS['busy_timeout']):
+    """Get (shared) SQLAlchemy engine for job store database
+
+    :param db_path: pathname of SQLite database
+    :param wal: use WAL journal mode
+    :param busy_timeout: secs to wait for a lock held by another connection
+    :return: sqlalchemy.engine.Engine
+    """
+    with engines_lock:
+        if db_path in engines:
+            return engines[db_path]
+        engine = create_engine('sqlite:///' + db_path,
+                               connect_args={'timeout': busy_timeout,
+                                             'check_same_thread': False})
+
+        @event.listens_for(engine, 'connect')
+        def on_connect(dbapi_conn, conn_record):
+            cursor = dbapi_conn.cursor()
+            if wal:
+                cursor.execute('PRAGMA journal_mode=WAL')
+                # durable at checkpoint, safe against application crashes
+                cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.execute('PRAGMA busy_timeout=%d' % (int(busy_timeout * 1000)))
+            cursor.close()
+
+        engines[db_path] = engine
+        return engine
+
+#################
+# ChangeWatcher #
+#################
+
+class ChangeWatcher(object):
+    """Detect changes committed to the database by other connections (e.g. the command line
+    tool reloading programs), using ``PRAGMA data_version``
+    """
+    def __init__(self, engine, callback, interval = JOBSTORE_DFLTS['change_poll']):
+        """
+        :param engine: SQLAlchemy engine (see ``jobstore_engine()``)
+        :param callback: function to call (no args) when a change is detected
+        :param interval: secs between polls
+        """
+        self.engine   = engine
+        self.callback = callback
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread   = None
+
+    def start(self):
+        """
+        """
+        if self.thread and self.thread.is_alive():
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name='jobstore-watcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        """
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        """Poll loop; the same (dedicated) connection must be used throughout, since
+        ``data_version`` only reflects commits from other connections
+        """
+        with self.engine.connect() as conn:
+            dbapi_conn = conn.connection.dbapi_connection
+            version = None
+            while not self.stopping.wait(self.interval):
+                try:
+                    cursor = dbapi_conn.execute('PRAGMA data_version')
+                    new_version = cursor.fetchone()[0]
+                    cursor.close()
+                except Exception as e:
+                    log.info("Could not poll job store for changes: %s" % (e))
+                    continue
+                if version is not None and new_version != version:
+                    log.debug("Job store changed, waking up scheduler")
+                    self.callback()
+                version = new_version
+
+##################
+# NativeJobStore #
+##################
+
+# positional args for recording jobs (see ``Dar.schedule_item()``)
+RECORD_FUNC  = 'dar:do_record'
+DURATION_ARG = 5
+
+# job state (paused jobs have no next run time)
+JobState = LOV(['ACTIVE',
+                'PAUSED'], 'lower')
+
+metadata = MetaData()
+
+jobs_tab = Table('dar_jobs', metadata,
+                 Column('id', Unicode(191), primary_key=True),
+                 Column('func', String(191), nullable=False),
+                 Column('name', Text),
+                 Column('station', String(64), index=True),
+                 Column('duration', Integer),           # secs (recording jobs)
+                 Column('trigger', Text, nullable=False),  # JSON (see ``trigger_spec()``)
+                 Column('args', Text, nullable=False),     # JSON
+                 Column('kwargs', Text, nullable=False),   # JSON
+                 Column('executor', String(64), nullable=False),
+                 Column('misfire_grace_time', Integer),
+                 Column('coalesce', Integer, nullable=False),
+                 Column('max_instances', Integer, nullable=False),
+                 Column('state', String(16), nullable=False),
+                 Column('next_run_time', Float(25), index=True))
+
+def iso(value):
+    """
+    :param value: datetime (or None)
+    :return: str (or None)
+    """
+    return value.isoformat() if value else None
+
+def trigger_spec(trigger):
+    """
+    :param trigger: apscheduler trigger (date, cron or interval)
+    :return: dict (JSON-serializable)
+    """
+    if isinstance(trigger, DateTrigger):
+        return {'type': 'date', 'run_date': iso(trigger.run_date)}
+    if isinstance(trigger, CronTrigger):
+        return {'type'      : 'cron',
+                'fields'    : {field.name: str(field) for field in trigger.fields
+                               if not field.is_default},
+                'timezone'  : str(trigger.timezone),
+                'start_date': iso(trigger.start_date),
+                'end_date'  : iso(trigger.end_date),
+                'jitter'    : trigger.jitter}
+    if isinstance(trigger, IntervalTrigger):
+        return {'type'      : 'interval',
+                'seconds'   : trigger.interval.total_seconds(),
+                'timezone'  : str(trigger.timezone),
+                'start_date': iso(trigger.start_date),
+                'end_date'  : iso(trigger.end_date),
+                'jitter'    : trigger.jitter}
+    raise ValueError("Trigger type \"%s\" not supported by native job store" %
+                     (type(trigger).__name__))
+
+def build_trigger(spec):
+    """
+    :param spec: dict (see ``trigger_spec()``)
+    :return: apscheduler trigger
+    """
+    if spec['type'] == 'date':
+        return DateTrigger(run_date=spec['run_date'])
+    if spec['type'] == 'cron':
+        return CronTrigger(timezone=spec['timezone'], start_date=spec['start_date'],
+                           end_date=spec['end_date'], jitter=spec['jitter'], **spec['fields'])
+    if spec['type'] == 'interval':
+        return IntervalTrigger(seconds=spec['seconds'], timezone=spec['timezone'],
+                               start_date=spec['start_date'], end_date=spec['end_date'],
+                               jitter=spec['jitter'])
+    raise ValueError("Unknown trigger type \"%s\"" % (spec['type']))
+
+class NativeJobStore(BaseJobStore):
+    """Job store with a compact, schema'd representation of jobs (rather than pickled
+    ``Job`` objects); jobs must have a textual function reference, JSON-serializable args,
+    and a date, cron or interval trigger
+    """
+    def __init__(self, engine, migrate = True):
+        """
+        :param engine: SQLAlchemy engine (see ``jobstore_engine()``)
+        :param migrate: move jobs from the pickled job store table, if present
+        """
+        super().__init__()
+        self.engine  = engine
+        self.migrate = migrate
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        metadata.create_all(self.engine)
+        if self.migrate:
+            self.migrate_jobs()
+
+    def migrate_jobs(self):
+        """Move jobs from the table of apscheduler's ``SQLAlchemyJobStore`` (if any)
+        """
+        if not inspect(self.engine).has_table('apscheduler_jobs'):
+            return
+        legacy = SQLAlchemyJobStore(engine=self.engine)
+        legacy.start(self._scheduler, self._alias)
+        jobs = legacy.get_all_jobs()
+        for job in jobs:
+            try:
+                self.add_job(job)
+            except ConflictingIdError:
+                self.update_job(job)
+        legacy.remove_all_jobs()
+        if jobs:
+            log.info("Migrated %d job(s) to native job store" % (len(jobs)))
+
+    def job_values(self, job):
+        """
+        :param job: apscheduler.job.Job
+        :return: dict of column values
+        """
+        duration = None
+        if job.func_ref == RECORD_FUNC and len(job.args) > DURATION_ARG:
+            duration = job.args[DURATION_ARG]
+            if isinstance(duration, str):
+                duration = str2timedelta(duration).seconds
+        try:
+            args = json.dumps(list(job.args))
+            kwargs = json.dumps(job.kwargs)
+        except TypeError as e:
+            raise ValueError("Args for job \"%s\" not serializable: %s" % (job.id, e))
+        return {'func'              : job.func_ref,
+                'name'              : job.name,
+                'station'           : job.kwargs.get('station'),
+                'duration'          : duration,
+                'trigger'           : json.dumps(trigger_spec(job.trigger)),
+                'args'              : args,
+                'kwargs'            : kwargs,
+                'executor'          : job.executor,
+                'misfire_grace_time': job.misfire_grace_time,
+                'coalesce'          : int(job.coalesce),
+                'max_instances'     : job.max_instances,
+                'state'             : JobState.ACTIVE if job.next_run_time else JobState.PAUSED,
+                'next_run_time'     : datetime_to_utc_timestamp(job.next_run_time)}
+
+    def reconstitute(self, row):
+        """
+        :param row: row mapping from jobs table
+        :return: apscheduler.job.Job
+        """
+        job = Job.__new__(Job)
+        job.__setstate__({'version'           : 1,
+                          'id'                : row['id'],
+                          'func'              : row['func'],
+                          'trigger'           : build_trigger(json.loads(row['trigger'])),
+                          'executor'          : row['executor'],
+                          'args'              : tuple(json.loads(row['args'])),
+                          'kwargs'            : json.loads(row['kwargs']),
+                          'name'              : row['name'],
+                          'misfire_grace_time': row['misfire_grace_time'],
+                          'coalesce'          : bool(row['coalesce']),
+                          'max_instances'     : row['max_instances'],
+                          'next_run_time'     : utc_timestamp_to_datetime(row['next_run_time'])})
+        job._scheduler = self._scheduler
+        job._jobstore_alias = self._alias
+        return job
+
+    def get_jobs(self, *conditions):
+        """
+        :param conditions: SQLAlchemy where clauses
+        :return: list of apscheduler.job.Job, by next run time
+        """
+        query = select(jobs_tab).order_by(jobs_tab.c.next_run_time)
+        if conditions:
+            query = query.where(and_(*conditions))
+        jobs = []
+        with self.engine.connect() as conn:
+            rows = conn.execute(query).mappings().all()
+        for row in rows:
+            try:
+                jobs.append(self.reconstitute(row))
+            except Exception as e:
+                # unlike apscheduler's store, leave the row in place for inspection
+                log.error("Could not restore job \"%s\": %s" % (row['id'], e))
+        return jobs
+
+    def lookup_job(self, job_id):
+        jobs = self.get_jobs(jobs_tab.c.id == job_id)
+        return jobs[0] if jobs else None
+
+    def get_due_jobs(self, now):
+        return self.get_jobs(jobs_tab.c.next_run_time <= datetime_to_utc_timestamp(now))
+
+    def get_next_run_time(self):
+        query = (select(jobs_tab.c.next_run_time)
+                 .where(jobs_tab.c.next_run_time.isnot(None))
+                 .order_by(jobs_tab.c.next_run_time)
+                 .limit(1))
+        with self.engine.connect() as conn:
+            return utc_timestamp_to_datetime(conn.execute(query).scalar())
+
+    def get_all_jobs(self):
+        jobs = self.get_jobs()
+        self._fix_paused_jobs_sorting(jobs)
+        return jobs
+
+    def add_job(self, job):
+        values = self.job_values(job)
+        with self.engine.begin() as conn:
+            try:
+                conn.execute(insert(jobs_tab).values(id=job.id, **values))
+            except IntegrityError:
+                raise ConflictingIdError(job.id)
+
+    def update_job(self, job):
+        values = self.job_values(job)
+        with self.engine.begin() as conn:
+            res = conn.execute(update(jobs_tab).where(jobs_tab.c.id == job.id).values(**values))
+            if res.rowcount == 0:
+                raise JobLookupError(job.id)
+
+    def remove_job(self, job_id):
+        with self.engine.begin() as conn:
+            res = conn.execute(delete(jobs_tab).where(jobs_tab.c.id == job_id))
+            if res.rowcount == 0:
+                raise JobLookupError(job_id)
+
+    def remove_all_jobs(self):
+        with self.engine.begin() as conn:
+            conn.execute(delete(jobs_tab))
+
+    def shutdown(self):
+        # note: engine is shared (see ``jobstore_engine()``), so it is not disposed
+        pass
+
+    def list_jobs(self, station = None, state = None, due_before = None, func = None):
+        """List jobs (index queries, jobs are not reconstituted); all criteria optional
+
+        :param station: station name
+        :param state: ``JobState`` value
+        :param due_before: datetime (next run time before)
+        :param func: function reference (e.g. ``dar:do_record``)
+        :return: list of dicts, by next run time (paused jobs last)
+        """
+        query = select(jobs_tab.c.id, jobs_tab.c.name, jobs_tab.c.station, jobs_tab.c.duration,
+                       jobs_tab.c.trigger, jobs_tab.c.state, jobs_tab.c.next_run_time,
+                       jobs_tab.c.args, jobs_tab.c.kwargs)
+        if station:
+            query = query.where(jobs_tab.c.station == station)
+        if state:
+            query = query.where(jobs_tab.c.state == state)
+        if due_before:
+            query = query.where(jobs_tab.c.next_run_time <= datetime_to_utc_timestamp(due_before))
+        if func:
+            query = query.where(jobs_tab.c.func == func)
+        query = query.order_by(jobs_tab.c.next_run_time.is_(None), jobs_tab.c.next_run_time)
+        with self.engine.connect() as conn:
+            rows = conn.execute(query).mappings().all()
+        jobs = []
+        for row in rows:
+            job = dict(row)
+            job['trigger'] = json.loads(job['trigger'])
+            job['args'] = json.loads(job['args'])
+            job['kwargs'] = json.loads(job['kwargs'])
+            jobs.append(job)
+        return jobs
+
+    def __repr__(self):
+        return "<%s (url=%s)>" % (self.__class__.__name__, self.engine.url)
+
+def describe_job(row):
+    """
+    :param row: dict from ``NativeJobStore.list_jobs()``
+    :return: str (same format as ``str(job)`` for an apscheduler job)
+    """
+    next_run = utc_timestamp_to_datetime(row['next_run_time'])
+    status = "next run at: " + datetime_repr(next_run) if next_run else "paused"
+    return "%s (trigger: %s, %s)" % (row['name'], build_trigger(row['trigger']), status)
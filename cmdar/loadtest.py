@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Load test harness for the REST API - drives API routes (as polled by dashboards) at a
+configurable concurrency against a DAR with a large synthetic job store, and reports
+latency percentiles and throughput per route
+
+The DAR runs in-process with the ``null`` streamer (see ``NullStreamer``), so that probe
+recordings can be scheduled during the run: the lateness of their starts (dispatch and
+spawn, relative to the scheduled time) under API load is reported alongside an idle
+baseline, to verify that API load does not delay scheduled recordings.
+
+The API is served in one of the ``ServeMode`` modes (``threaded`` is what ``server.py`` uses),
+so that results can be compared across serving modes; a running server can also be
+targeted directly (``--url``), in which case no probes are scheduled.
+"""
+
+import os
+import time
+import random
+import logging
+import shutil
+import tempfile
+import threading
+import http.client
+import urllib.parse
+import datetime as dt
+from collections import defaultdict, Counter
+
+from core import cfg, log
+from utils import LOV
+from dar import Dar, JOBSTORE, MISFIRE_GRACE_TIME
+from simulate import synthesize_programs
+import spans
+
+ServeMode = LOV(['THREADED',
+                 'SINGLE',
+                 'WAITRESS'],
+                'lower')
+
+LOADTEST_PROFILE = 'loadtest'
+LOADTEST_STREAMER = 'null'
+
+# routes polled by clients, with relative weights
+ROUTE_MIX = [('/dar',       4),
+             ('/todos',     4),
+             ('/dar/state', 2),
+             ('/cluster',   1)]
+
+DFLT_PROGRAMS   = 2000
+PROBE_INTERVAL  = 2      # secs (between probe recordings)
+PROBE_DURATION  = 1      # secs
+REQUEST_TIMEOUT = 30     # secs
+
+#########
+# setup #
+#########
+
+def loadtest_profile(tmp_dir, programs, base = None):
+    """Register config profile for the load test (job store and recordings in ``tmp_dir``,
+    ``null`` streamer, and background features that do external I/O disabled)
+
+    :param tmp_dir: working directory
+    :param programs: dict (``programs`` config format)
+    :param base: [optional] profile to derive from (for stations and scheduler config)
+    :return: profile name
+    """
+    streamers = dict(cfg.config('streamers', base))
+    media_types = {}
+    for info in streamers.values():
+        media_types.update(info.get('media_types', {}))
+    streamers[LOADTEST_STREAMER] = {'subclass': 'NullStreamer', 'media_types': media_types}
+    scheduler = dict(cfg.config('scheduler', base))
+    scheduler.update({'db_dir'      : tmp_dir,
+                      'db_file'     : 'apscheduler.db',
+                      'rec_dir'     : os.path.join(tmp_dir, 'rec'),
+                      'catalog_file': 'catalog.db',
+                      'late_join'   : False})
+    os.makedirs(scheduler['rec_dir'], exist_ok=True)
+    disabled = {'enabled': False}
+    cfg.add_profile(LOADTEST_PROFILE, {'programs' : programs,
+                                       'streamers': streamers,
+                                       'scheduler': scheduler,
+                                       'analysis' : {},
+                                       'playlists': disabled,
+                                       'staging'  : disabled,
+                                       'peaks'    : disabled,
+                                       'guides'   : disabled,
+                                       'cluster'  : disabled,
+                                       'archive'  : disabled,
+                                       'relay'    : disabled}, base)
+    return LOADTEST_PROFILE
+
+def setup_dar(num_programs, tmp_dir, base = None, seed = None):
+    """
+    :param num_programs: number of synthetic programs in job store
+    :param tmp_dir: working directory
+    :param base: [optional] profile to derive from
+    :param seed: random seed (for synthetic programs)
+    :return: Dar (scheduler started)
+    """
+    stations = list(cfg.config('stations', base))
+    programs = synthesize_programs(num_programs, stations, seed)
+    profile = loadtest_profile(tmp_dir, programs, base)
+    dar = Dar(LOADTEST_STREAMER, cfg_profile=profile)
+    start = time.time()
+    dar.reload_programs()
+    log.info("Load test job store populated (%d programs, %.1f secs)" %
+             (num_programs, time.time() - start))
+    dar.start_scheduler()
+    return dar
+
+###########
+# serving #
+###########
+
+class ServerThread(object):
+    """API server (``server.app``) running in a background thread, on an ephemeral port
+    """
+    def __init__(self, dar, mode = ServeMode.THREADED, threads = 8):
+        """
+        :param dar: Dar instance to serve
+        :param mode: ``ServeMode`` value
+        :param threads: worker threads (``waitress`` only)
+        """
+        import server
+        server.dar = dar
+        self.mode = mode
+        if mode == ServeMode.WAITRESS:
+            from waitress.server import create_server
+            self.server = create_server(server.app, host='127.0.0.1', port=0, threads=threads)
+            self.port = self.server.effective_port
+            self.run, self.stop = self.server.run, self.server.close
+        elif mode in (ServeMode.THREADED, ServeMode.SINGLE):
+            from werkzeug.serving import make_server
+            # per-request logging would dominate the measurements
+            logging.getLogger('werkzeug').setLevel(logging.WARNING)
+            self.server = make_server('127.0.0.1', 0, server.app,
+                                      threaded=(mode == ServeMode.THREADED))
+            self.port = self.server.server_port
+            self.run, self.stop = self.server.serve_forever, self.server.shutdown
+        else:
+            raise RuntimeError("Serving mode \"%s\" not known" % (mode))
+        self.thread = threading.Thread(target=self.run, name='loadtest-server', daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % (self.port)
+
+    def start(self):
+        self.thread.start()
+
+############
+# load gen #
+############
+
+def percentiles(values, scale = 1000.0):
+    """
+    :param values: list of numbers (secs)
+    :param scale: multiplier for reported values (default: millisecs)
+    :return: dict with p50, p95, p99 and max (None if no values)
+    """
+    vals = sorted(values)
+    def pct(p):
+        return round(vals[min(int(len(vals) * p), len(vals) - 1)] * scale, 2) if vals else None
+    return {'p50': pct(0.50), 'p95': pct(0.95), 'p99': pct(0.99),
+            'max': round(vals[-1] * scale, 2) if vals else None}
+
+class LoadGenerator(object):
+    """Client threads issuing requests back to back (each over a persistent connection,
+    where the server allows)
+    """
+    def __init__(self, url, concurrency = 10, conditional = False, mix = ROUTE_MIX,
+                 seed = None):
+        """
+        :param url: base URL of API server
+        :param concurrency: number of client threads
+        :param conditional: send ``If-None-Match`` with last ETag seen (as a polling
+                            dashboard would)
+        :param mix: list of (route, weight)
+        :param seed: random seed (for route choice)
+        """
+        parsed           = urllib.parse.urlsplit(url)
+        self.host        = parsed.hostname
+        self.port        = parsed.port or 80
+        self.concurrency = concurrency
+        self.conditional = conditional
+        self.routes      = [route for route, _ in mix]
+        self.weights     = [weight for _, weight in mix]
+        self.seed        = seed
+        self.lock        = threading.Lock()
+        self.latencies   = defaultdict(list)
+        self.statuses    = defaultdict(Counter)
+        self.errors      = Counter()
+        self.elapsed     = 0.0
+
+    def client(self, num, deadline):
+        """Client thread: issue requests until ``deadline``
+        """
+        rand = random.Random(None if self.seed is None else self.seed + num)
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=REQUEST_TIMEOUT)
+        etags = {}
+        latencies = defaultdict(list)
+        statuses = defaultdict(Counter)
+        errors = Counter()
+        while time.time() < deadline:
+            route = rand.choices(self.routes, self.weights)[0]
+            headers = {}
+            if self.conditional and route in etags:
+                headers['If-None-Match'] = etags[route]
+            start = time.perf_counter()
+            try:
+                conn.request('GET', route, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+            except (OSError, http.client.HTTPException):
+                errors[route] += 1
+                conn.close()
+                continue
+            latencies[route].append(time.perf_counter() - start)
+            statuses[route][resp.status] += 1
+            if resp.getheader('ETag'):
+                etags[route] = resp.getheader('ETag')
+            if resp.will_close:
+                conn.close()
+        conn.close()
+        with self.lock:
+            for route in latencies:
+                self.latencies[route].extend(latencies[route])
+                self.statuses[route].update(statuses[route])
+            self.errors.update(errors)
+
+    def run(self, duration):
+        """
+        :param duration: secs
+        :return: report (dict)
+        """
+        start = time.time()
+        deadline = start + duration
+        threads = [threading.Thread(target=self.client, args=(i, deadline),
+                                    name='loadtest-client-%d' % (i), daemon=True)
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.time() - start
+        return self.report()
+
+    def report(self):
+        """
+        :return: dict with per-route and total latency (millisecs) and throughput
+        """
+        routes = {}
+        for route in self.routes:
+            lat = self.latencies.get(route, [])
+            routes[route] = dict(percentiles(lat),
+                                 requests=len(lat),
+                                 errors=self.errors[route],
+                                 statuses=dict(self.statuses[route]),
+                                 rps=round(len(lat) / self.elapsed, 1) if self.elapsed else None)
+        all_lat = [l for lat in self.latencies.values() for l in lat]
+        return {'concurrency': self.concurrency,
+                'conditional': self.conditional,
+                'secs'       : round(self.elapsed, 2),
+                'requests'   : len(all_lat),
+                'errors'     : sum(self.errors.values()),
+                'rps'        : round(len(all_lat) / self.elapsed, 1) if self.elapsed else None,
+                'latency'    : percentiles(all_lat),
+                'routes'     : routes}
+
+##########
+# probes #
+##########
+
+class Probes(object):
+    """Short recordings scheduled through the job store during a test phase, to measure
+    start lateness (relative to the scheduled time)
+    """
+    def __init__(self, dar, interval = PROBE_INTERVAL, duration = PROBE_DURATION):
+        """
+        :param dar: Dar instance (scheduler started)
+        :param interval: secs between probes
+        :param duration: secs per probe recording
+        """
+        self.dar      = dar
+        self.interval = interval
+        self.duration = duration
+        self.job_ids  = defaultdict(list)   # {phase: [job_id, ...]}
+        self.station  = next(iter(dar.stations))
+
+    def schedule(self, phase, secs, lead = 1.0):
+        """Schedule probes over the next ``secs``
+
+        :param phase: name of test phase
+        :param secs: length of phase
+        :param lead: secs before first probe
+        """
+        info = self.dar.stations[self.station]
+        url = info['stream_url'][-1] if isinstance(info['stream_url'], list) else info['stream_url']
+        filebase = os.path.join(self.dar.rec_path, 'probe-')
+        now = dt.datetime.now()
+        count = max(int((secs - lead) // self.interval), 1)
+        for i in range(count):
+            job_id = 'loadtest-probe:%s:%d' % (phase, i)
+            run_date = now + dt.timedelta(seconds=lead + i * self.interval)
+            self.dar.sched.add_job('dar:do_record', 'date', run_date=run_date,
+                                   args=(LOADTEST_STREAMER, self.dar.cfg_profile, url,
+                                         info['media_type'], filebase, self.duration),
+                                   kwargs={'job_id': job_id, 'station': self.station},
+                                   id=job_id, name=job_id, jobstore=JOBSTORE,
+                                   replace_existing=True, misfire_grace_time=MISFIRE_GRACE_TIME)
+            self.job_ids[phase].append(job_id)
+
+    def report(self, phase):
+        """
+        :param phase: name of test phase
+        :return: dict with dispatch and spawn lateness (millisecs)
+        """
+        dispatch, spawn, missing = [], [], 0
+        for job_id in self.job_ids[phase]:
+            runs = spans.recorder.get_runs(job_id)
+            marks = runs[0]['marks'] if runs else {}
+            if 'trigger' not in marks or 'dispatch' not in marks:
+                missing += 1
+                continue
+            dispatch.append(marks['dispatch'] - marks['trigger'])
+            if 'spawn' in marks:
+                spawn.append(marks['spawn'] - marks['trigger'])
+        return {'probes'  : len(self.job_ids[phase]),
+                'missing' : missing,
+                'dispatch': percentiles(dispatch),
+                'spawn'   : percentiles(spawn)}
+
+#######
+# run #
+#######
+
+def run_loadtest(duration = 30, concurrency = 10, mode = ServeMode.THREADED,
+                 programs = DFLT_PROGRAMS, baseline = 10, conditional = False, base = None,
+                 seed = None, url = None):
+    """
+    :param duration: secs of API load
+    :param concurrency: number of client threads
+    :param mode: ``ServeMode`` value
+    :param programs: number of synthetic programs in job store
+    :param baseline: secs of idle baseline (probes only) before load phase
+    :param conditional: clients send ``If-None-Match``
+    :param base: [optional] config profile to derive from
+    :param seed: random seed
+    :param url: [optional] base URL of running server (no DAR set up, or probes)
+    :return: report (dict)
+    """
+    if url:
+        load = LoadGenerator(url, concurrency, conditional, seed=seed)
+        return {'url': url, 'load': load.run(duration)}
+
+    tmp_dir = tempfile.mkdtemp(prefix='cmdar-loadtest-')
+    try:
+        dar = setup_dar(programs, tmp_dir, base, seed)
+        srv = ServerThread(dar, mode, concurrency)
+        srv.start()
+        probes = Probes(dar)
+        try:
+            probes.schedule('baseline', baseline)
+            time.sleep(baseline + probes.duration + 1)
+            probes.schedule('load', duration)
+            load = LoadGenerator(srv.url, concurrency, conditional, seed=seed)
+            load_report = load.run(duration)
+            # let the last probes complete
+            time.sleep(probes.duration + 1)
+        finally:
+            srv.stop()
+            dar.stop_scheduler(wait_for_jobs=False)
+        return {'mode'    : mode,
+                'programs': programs,
+                'load'    : load_report,
+                'probes'  : {'baseline': probes.report('baseline'),
+                             'load'    : probes.report('load')}}
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+#####################
+# command line tool #
+#####################
+
+import json
+import click
+
+@click.command()
+@click.option('--duration',    default=30, help="Secs of API load (defaults to 30)")
+@click.option('--concurrency', default=10, help="Number of client threads (defaults to 10)")
+@click.option('--mode',        default=ServeMode.THREADED, type=click.Choice(ServeMode.values()),
+              help="Serving mode (defaults to 'threaded')")
+@click.option('--programs',    default=DFLT_PROGRAMS, help="Synthetic programs in job store")
+@click.option('--baseline',    default=10, help="Secs of idle baseline before load (defaults to 10)")
+@click.option('--conditional', is_flag=True, help="Send If-None-Match (polling dashboards)")
+@click.option('--seed',        default=None, type=int, help="Random seed")
+@click.option('--profile',     default=None, type=str, help="Profile in config.yml (for stations)")
+@click.option('--url',         default=None, type=str, help="Target running server (no probes)")
+def main(duration, concurrency, mode, programs, baseline, conditional, seed, profile, url):
+    """Load test the REST API, and print report
+    """
+    report = run_loadtest(duration, concurrency, mode, programs, baseline, conditional,
+                          profile, seed, url)
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
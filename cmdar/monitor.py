@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""Capture monitor - stall watchdog for active recordings
+
+A single thread samples the output file size of every active capture, and compares the
+observed throughput against the expected bitrate for the stream.  If throughput stays
+below threshold for ``window`` seconds, the capture is escalated to the next action
+(e.g. ``log``, then ``restart``, then ``failover``); for the latter two, the capture
+process is terminated, and the streamer reports the action back to the caller.
+"""
+
+import os
+import time
+import threading
+from collections import deque
+
+from core import cfg, log
+from utils import LOV, truthy
+
+##########
+# config #
+##########
+
+MONITOR_DFLTS = {'enabled'  : True,
+                 'interval' : 5,      # secs (between samples)
+                 'window'   : 30,     # secs (of low throughput, before escalating)
+                 'min_ratio': 0.25,   # fraction of expected bitrate
+                 'startup'  : 15,     # secs (connect/buffering time not monitored)
+                 'actions'  : ['log', 'restart', 'failover']}
+
+StallAction   = LOV(['LOG',
+                     'RESTART',
+                     'FAILOVER'],
+                    'lower')
+
+def monitor_params(cfg_profile = None):
+    """Get capture monitor parameters (config overlaid on defaults)
+
+    :param cfg_profile: optional (None means ``default``)
+    :return: dict
+    """
+    params = dict(MONITOR_DFLTS)
+    params.update(cfg.config('monitor', cfg_profile))
+    return params
+
+###########
+# Capture #
+###########
+
+class Capture(object):
+    """Active recording being monitored
+    """
+    def __init__(self, proc, path, expected_bps, level = 0, indexer = None, hasher = None):
+        """
+        :param proc: subprocess.Popen for capture process
+        :param path: pathname of output file
+        :param expected_bps: expected throughput (bytes/sec)
+        :param level: escalation level to start at (e.g. if capture is a restart)
+        :param indexer: [optional] ``seekindex.SeekIndexer``, fed on each sample
+        :param hasher: [optional] ``checksum.StreamHasher``, fed on each sample
+        """
+        self.proc         = proc
+        self.path         = path
+        self.expected_bps = expected_bps
+        self.level        = level
+        self.started      = time.time()
+        self.samples      = deque()   # (time, size)
+        self.low_since    = None
+        self.action       = None      # set if capture process terminated by monitor
+        self.first_byte   = None
+        self.last_byte    = None
+        self.indexer      = indexer
+        self.hasher       = hasher
+
+    def sample(self, now, window):
+        """Record current output file size, and compute throughput over ``window``
+
+        :return: bytes/sec (or None, if not enough history)
+        """
+        try:
+            size = os.stat(self.path).st_size
+        except FileNotFoundError:
+            size = 0
+        if size and not self.first_byte:
+            self.first_byte = now
+        if size > (self.samples[-1][1] if self.samples else 0):
+            self.last_byte = now
+        self.samples.append((now, size))
+        while len(self.samples) > 1 and self.samples[1][0] <= now - window:
+            self.samples.popleft()
+        t0, s0 = self.samples[0]
+        if now - t0 < window:
+            return None
+        return (size - s0) / (now - t0)
+
+##################
+# CaptureMonitor #
+##################
+
+class CaptureMonitor(object):
+    """Watchdog thread for all active captures
+    """
+    def __init__(self, interval, window, min_ratio, startup, actions, **kwargs):
+        """
+        :param interval: secs between samples
+        :param window: secs of low throughput before escalating
+        :param min_ratio: fraction of expected throughput considered "low"
+        :param startup: secs after start before monitoring kicks in
+        :param actions: list of ``StallAction`` values, in escalation order
+        """
+        self.interval  = interval
+        self.window    = window
+        self.min_ratio = min_ratio
+        self.startup   = startup
+        self.actions   = actions
+        self.captures  = set()
+        self.lock      = threading.Lock()
+        self.thread    = None
+
+    def add(self, capture):
+        """Start monitoring capture (starts monitor thread, if needed)
+        """
+        with self.lock:
+            self.captures.add(capture)
+            if not self.thread or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='capture-monitor',
+                                               daemon=True)
+                self.thread.start()
+
+    def remove(self, capture):
+        """Stop monitoring capture (monitor thread exits when there are no more captures)
+        """
+        with self.lock:
+            self.captures.discard(capture)
+
+    def run(self):
+        """Monitor loop
+        """
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.captures:
+                    self.thread = None
+                    return
+                captures = list(self.captures)
+            now = time.time()
+            for capture in captures:
+                try:
+                    self.check(capture, now)
+                except Exception as e:
+                    log.error("Capture monitor failed for \"%s\": %s" % (capture.path, e))
+
+    def check(self, capture, now):
+        """Sample capture (and update seek index and hash) and escalate if throughput is
+        below threshold for ``window``
+        """
+        if capture.indexer:
+            capture.indexer.feed()
+        if capture.hasher:
+            capture.hasher.feed()
+        rate = capture.sample(now, self.window)
+        if rate is None or now - capture.started < self.startup or capture.action:
+            return
+        if rate >= capture.expected_bps * self.min_ratio:
+            capture.low_since = None
+            return
+        # escalate immediately (rate is already measured over the window), and then again
+        # after each subsequent window, if throughput does not recover
+        if capture.low_since and now - capture.low_since < self.window:
+            return
+
+        capture.low_since = now
+        if capture.level >= len(self.actions):
+            return
+        action = self.actions[capture.level]
+        capture.level += 1
+        log.notice("Stalled capture \"%s\" (%d of %d bytes/sec), action: %s" %
+                   (capture.path, rate, capture.expected_bps, action))
+        if action in (StallAction.RESTART, StallAction.FAILOVER):
+            capture.action = action
+            capture.proc.terminate()
+
+# monitor instance for the current process (created on first use)
+monitor = None
+monitor_lock = threading.Lock()
+
+def get_monitor(cfg_profile = None):
+    """
+    :param cfg_profile: optional (None means ``default``)
+    :return: CaptureMonitor (or None, if not enabled)
+    """
+    global monitor
+    with monitor_lock:
+        if monitor is None:
+            params = monitor_params(cfg_profile)
+            if not truthy(params['enabled']):
+                return None
+            monitor = CaptureMonitor(**params)
+    return monitor
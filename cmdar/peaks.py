@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""Waveform peaks - multi-resolution min/max peaks for recordings, precomputed so that a
+waveform overview can be drawn without decoding the recording
+
+Peaks are computed (vectorized, one decoded chunk at a time) after a recording completes,
+and written to a sidecar file (``<recording>.peaks``).  The finest level has one min/max
+pair per ``base`` PCM samples; each following level is ``factor`` times coarser.
+
+Sidecar format: header (magic, PCM rate, base, factor, number of levels, as little-endian
+uint32), followed by the number of peaks in each level (uint32), followed by the peaks for
+each level, finest first (int8 min/max pairs).
+"""
+
+import os
+import struct
+
+import numpy as np
+
+from core import cfg, log
+from utils import truthy
+from audio import pcm_chunks, PCM_RATE
+
+##########
+# config #
+##########
+
+PEAKS_DFLTS = {'enabled' : True,
+               'pcm_rate': PCM_RATE,
+               'base'    : 256,   # PCM samples per peak (finest level)
+               'factor'  : 4,     # between levels
+               'levels'  : 6}
+
+# peaks wanted if neither width nor level specified (about a screen width), so that a
+# long recording does not return its finest level by default
+DFLT_WIDTH   = 2000
+
+PEAKS_SUFFIX = '.peaks'
+PEAKS_MAGIC  = b'DARPEAK\x01'
+PEAKS_HEADER = struct.Struct('<8sIIII')
+
+def peaks_params(cfg_profile = None):
+    """Get peaks parameters (config overlaid on defaults)
+
+    :param cfg_profile: optional (None means ``default``)
+    :return: dict
+    """
+    params = dict(PEAKS_DFLTS)
+    params.update(cfg.config('peaks', cfg_profile))
+    return params
+
+###############
+# computation #
+###############
+
+def reduce_peaks(peaks, factor):
+    """Compute next coarser level
+
+    :param peaks: np.ndarray (n, 2) of min/max pairs
+    :param factor: number of peaks combined into one
+    :return: np.ndarray (ceil(n / factor), 2)
+    """
+    if not len(peaks):
+        return peaks
+    idx = np.arange(0, len(peaks), factor)
+    return np.stack((np.minimum.reduceat(peaks[:, 0], idx),
+                     np.maximum.reduceat(peaks[:, 1], idx)), axis=1)
+
+def compute_peaks(path, pcm_rate = PCM_RATE, base = PEAKS_DFLTS['base'],
+                  factor = PEAKS_DFLTS['factor'], levels = PEAKS_DFLTS['levels'], **kwargs):
+    """
+    :param path: pathname of recording
+    :param pcm_rate: PCM decoding rate
+    :param base: PCM samples per peak, for finest level
+    :param factor: between levels
+    :param levels: number of levels
+    :return: list of np.ndarray (n, 2) int8, finest level first
+    """
+    finest = []
+    carry = np.empty(0, dtype=np.int16)
+    for chunk in pcm_chunks(path, pcm_rate):
+        if carry.size:
+            chunk = np.concatenate((carry, chunk))
+        nwin = chunk.size // base
+        carry = chunk[nwin * base:]
+        if nwin == 0:
+            continue
+        frames = chunk[:nwin * base].reshape(nwin, base)
+        finest.append(np.stack((frames.min(axis=1), frames.max(axis=1)), axis=1))
+    if carry.size:
+        finest.append(np.array([[carry.min(), carry.max()]], dtype=np.int16))
+    peaks = np.concatenate(finest) if finest else np.empty((0, 2), dtype=np.int16)
+    # int16 -> int8 (arithmetic shift keeps sign)
+    result = [(peaks >> 8).astype(np.int8)]
+    for _ in range(1, levels):
+        result.append(reduce_peaks(result[-1], factor))
+    return result
+
+##############
+# peaks file #
+##############
+
+def write_peaks(path, peaks, pcm_rate, base, factor):
+    """Write peaks sidecar file (atomically)
+
+    :param path: pathname of recording
+    :param peaks: list of levels, see ``compute_peaks()``
+    """
+    tmp_path = path + PEAKS_SUFFIX + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(PEAKS_HEADER.pack(PEAKS_MAGIC, pcm_rate, base, factor, len(peaks)))
+        f.write(np.array([len(level) for level in peaks], dtype='<u4').tobytes())
+        for level in peaks:
+            f.write(level.tobytes())
+    os.replace(tmp_path, path + PEAKS_SUFFIX)
+
+def read_peaks(path, width = None, level = None):
+    """Read peaks for recording, at resolution suitable for display ``width`` (i.e. the
+    coarsest level with at least ``width`` peaks), or at specified ``level``
+
+    :param path: pathname of recording
+    :param width: [optional] number of peaks wanted (e.g. pixels), defaults to ``DFLT_WIDTH``
+    :param level: [optional] level number (0 is finest), overrides ``width``
+    :return: dict (or None, if peaks not computed for recording)
+    """
+    if not os.path.exists(path + PEAKS_SUFFIX):
+        return None
+    with open(path + PEAKS_SUFFIX, 'rb') as f:
+        data = f.read()
+    magic, pcm_rate, base, factor, nlevels = PEAKS_HEADER.unpack_from(data)
+    if magic != PEAKS_MAGIC:
+        raise RuntimeError("Not a peaks file: \"%s\"" % (path + PEAKS_SUFFIX))
+    counts = np.frombuffer(data, dtype='<u4', count=nlevels, offset=PEAKS_HEADER.size)
+    if level is None:
+        fits = [i for i, n in enumerate(counts) if n >= int(width or DFLT_WIDTH)]
+        level = fits[-1] if fits else 0
+    level = min(max(int(level), 0), nlevels - 1)
+    offset = PEAKS_HEADER.size + counts.nbytes + 2 * int(counts[:level].sum())
+    peaks = np.frombuffer(data, dtype=np.int8, count=2 * int(counts[level]), offset=offset)
+    samples = base * factor ** level
+    return {'level'        : level,
+            'levels'       : nlevels,
+            'secs_per_peak': samples / pcm_rate,
+            'duration'     : int(counts[0]) * base / pcm_rate,
+            'peaks'        : peaks.reshape(-1, 2).tolist()}
+
+def make_peaks(paths, cfg_profile = None):
+    """Compute and write peaks for recordings (invoked as a background job)
+
+    :param paths: list of pathnames
+    :param cfg_profile: optional (None means ``default``)
+    :return: number of peaks files written
+    """
+    params = peaks_params(cfg_profile)
+    written = 0
+    for path in paths:
+        try:
+            peaks = compute_peaks(path, **params)
+            write_peaks(path, peaks, params['pcm_rate'], params['base'], params['factor'])
+            written += 1
+            log.debug("Wrote peaks for \"%s\" (%d peaks at finest level)" %
+                      (path, len(peaks[0])))
+        except Exception as e:
+            log.info("Could not compute peaks for \"%s\": %s" % (path, e))
+    return written
+
+def peaks_enabled(cfg_profile = None):
+    """
+    :param cfg_profile: optional (None means ``default``)
+    :return: bool
+    """
+    return truthy(peaks_params(cfg_profile)['enabled'])
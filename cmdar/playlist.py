@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+"""Playlist resolution - station URLs pointing to ``.m3u``/``.pls`` playlists are resolved
+ahead of time to the direct stream URL(s), and cached (with TTL and conditional
+revalidation), so that the streamer does not pay for the playlist round trip at fire time
+"""
+
+import re
+import time
+import threading
+import urllib.parse
+
+from core import cfg, log
+from utils import conditional_get, truthy
+
+##########
+# config #
+##########
+
+PLAYLIST_DFLTS = {'enabled': True,
+                  'ttl'    : 3600,   # secs (before revalidation)
+                  'timeout': 5,      # secs (HTTP request)
+                  'refresh': True}   # revalidate in background, ahead of expiration
+
+PLAYLIST_EXTS  = ('.m3u', '.pls')
+
+def is_playlist(url):
+    """
+    :param url: station stream URL
+    :return: bool
+    """
+    path = urllib.parse.urlparse(url).path.lower()
+    return path.endswith(PLAYLIST_EXTS)
+
+def parse_playlist(url, body):
+    """Parse ``.m3u`` or ``.pls`` playlist
+
+    :param url: playlist URL (for resolving relative entries)
+    :param body: playlist content (bytes)
+    :return: list of stream URLs
+    """
+    text = body.decode('utf-8', errors='replace')
+    if urllib.parse.urlparse(url).path.lower().endswith('.pls'):
+        entries = re.findall(r'^\s*File\d+\s*=\s*(\S+)\s*$', text, re.MULTILINE | re.IGNORECASE)
+    else:
+        entries = [line.strip() for line in text.splitlines()
+                   if line.strip() and not line.strip().startswith('#')]
+    return [urllib.parse.urljoin(url, entry) for entry in entries]
+
+#################
+# PlaylistCache #
+#################
+
+class PlaylistCache(object):
+    """Resolved stream URLs for playlist URLs, keyed by playlist URL
+    """
+    def __init__(self, ttl, timeout, refresh = True, **kwargs):
+        """
+        :param ttl: secs before cached entry is revalidated
+        :param timeout: secs for HTTP requests
+        :param refresh: whether to revalidate in the background (see ``start_refresh()``)
+        """
+        self.ttl      = ttl
+        self.timeout  = timeout
+        self.refresh  = refresh
+        self.entries  = {}  # {url: {'streams', 'etag', 'last_modified', 'expires'}}
+        self.lock     = threading.Lock()
+        self.urls     = set()
+        self.stopping = threading.Event()
+        self.thread   = None
+
+    def fetch(self, url):
+        """Fetch (or revalidate) playlist and update cache entry
+
+        :param url: playlist URL
+        :return: cache entry (dict)
+        """
+        with self.lock:
+            entry = self.entries.get(url)
+        etag, modified = (entry['etag'], entry['last_modified']) if entry else (None, None)
+        body, etag, modified = conditional_get(url, etag, modified, self.timeout)
+        if body is None:
+            log.debug("Playlist \"%s\" not modified" % (url))
+            streams = entry['streams']
+        else:
+            streams = parse_playlist(url, body)
+            if not streams:
+                raise RuntimeError("No streams in playlist \"%s\"" % (url))
+            log.debug("Playlist \"%s\" resolved to %s" % (url, streams))
+        entry = {'streams'      : streams,
+                 'etag'         : etag,
+                 'last_modified': modified,
+                 'expires'      : time.time() + self.ttl}
+        with self.lock:
+            self.entries[url] = entry
+        return entry
+
+    def resolve(self, url):
+        """Get direct stream URL for station URL (non-playlist URLs are returned as is); if
+        the playlist cannot be fetched, a stale entry or the original URL is returned
+
+        :param url: station stream URL
+        :return: str
+        """
+        if not is_playlist(url):
+            return url
+        with self.lock:
+            self.urls.add(url)
+            entry = self.entries.get(url)
+        if not entry or entry['expires'] <= time.time():
+            try:
+                entry = self.fetch(url)
+            except Exception as e:
+                log.info("Could not resolve playlist \"%s\": %s" % (url, e))
+                if not entry:
+                    return url
+        return entry['streams'][0]
+
+    def start_refresh(self, urls):
+        """Resolve playlist URLs and start background revalidation, so that entries are
+        always fresh at fire time
+
+        :param urls: iterable of station stream URLs (non-playlist URLs are ignored)
+        """
+        with self.lock:
+            self.urls.update(url for url in urls if is_playlist(url))
+        if not self.refresh or (self.thread and self.thread.is_alive()):
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name='playlist-refresh', daemon=True)
+        self.thread.start()
+
+    def stop_refresh(self):
+        """
+        """
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        """Refresh loop: revalidate entries when within half a TTL of expiring
+        """
+        delay = 0
+        while not self.stopping.wait(delay):
+            with self.lock:
+                urls = list(self.urls)
+                entries = dict(self.entries)
+            for url in urls:
+                entry = entries.get(url)
+                if entry and entry['expires'] - time.time() > self.ttl / 2:
+                    continue
+                try:
+                    self.fetch(url)
+                except Exception as e:
+                    log.info("Could not refresh playlist \"%s\": %s" % (url, e))
+            delay = max(self.ttl / 4, 1)
+
+# cache instance for the current process (created on first use)
+playlists = None
+playlists_lock = threading.Lock()
+
+def get_playlists(cfg_profile = None):
+    """
+    :param cfg_profile: optional (None means ``default``)
+    :return: PlaylistCache (or None, if not enabled)
+    """
+    global playlists
+    with playlists_lock:
+        if playlists is None:
+            params = dict(PLAYLIST_DFLTS)
+            params.update(cfg.config('playlists', cfg_profile))
+            if not truthy(params['enabled']):
+                return None
+            playlists = PlaylistCache(**params)
+    return playlists
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+
+"""Priority classes - CPU and I/O scheduling priorities for capture processes and worker
+threads, by class of work, with accounting of CPU time consumed per class
+
+Classes (``PriorityClass``) are ``capture`` (live capture processes, capture job threads,
+and relay pumps), ``postproc`` (post-processing: decoding for analysis, peaks, alignment,
+and other background jobs), ``archive`` (transcoding) and ``api`` (REST API request
+handling).  Each class may specify ``nice`` (niceness), ``ioclass`` (I/O scheduling class:
+``realtime``, ``best_effort`` or ``idle``) with ``iolevel`` (0-7, highest first), and
+``cpus`` (CPU affinity, list of CPU numbers).  Settings are applied to spawned processes
+(by the parent, right after the process is started, since ``preexec_fn`` is not safe in
+a multi-threaded server), and to worker threads (Linux scheduling priorities are per
+thread), when the thread first runs.  Live captures always have the highest priority:
+other classes are never given a lower niceness than ``capture``.
+
+Note that an unprivileged process can only lower its priority (and new threads inherit
+the priority of the thread creating them), so the ``capture`` class should generally be
+left at the defaults (raising it requires ``CAP_SYS_NICE``), and long-lived capture
+threads (relay pumps) are started through a launcher thread that runs at ``capture``
+priority (see ``start_thread()``).  Settings that could not be applied are logged, and
+reported (``failed``) in the status.
+
+CPU time is accounted per class: for child processes (from ``wait4()`` resource usage),
+and for threads (per-thread CPU clocks of worker threads, and per-request thread time for
+API handling).
+"""
+
+import os
+import time
+import queue
+import ctypes
+import platform
+import threading
+import subprocess
+
+from core import cfg, log
+from utils import LOV
+
+##########
+# config #
+##########
+
+PriorityClass = LOV(['CAPTURE',
+                     'POSTPROC',
+                     'ARCHIVE',
+                     'API'], 'lower')
+
+IoClass = LOV(['REALTIME',
+               'BEST_EFFORT',
+               'IDLE'], 'lower')
+
+PRIORITY_DFLTS = {PriorityClass.CAPTURE : {'nice': 0,  'ioclass': IoClass.BEST_EFFORT, 'iolevel': 0},
+                  PriorityClass.POSTPROC: {'nice': 10, 'ioclass': IoClass.BEST_EFFORT, 'iolevel': 6},
+                  PriorityClass.ARCHIVE : {'nice': 19, 'ioclass': IoClass.IDLE,        'iolevel': 7},
+                  PriorityClass.API     : {'nice': 5,  'ioclass': IoClass.BEST_EFFORT, 'iolevel': 4}}
+
+def priority_params(cfg_profile = None):
+    """Get priority class settings (``priorities`` in ``scheduler`` config, overlaid on
+    defaults, per class)
+
+    :param cfg_profile: optional (None means ``default``)
+    :return: dict of dicts, keyed by class
+    """
+    overrides = cfg.config('scheduler', cfg_profile).get('priorities') or {}
+    params = {}
+    for pclass, dflts in PRIORITY_DFLTS.items():
+        params[pclass] = dict(dflts, cpus=None)
+        params[pclass].update(overrides.get(pclass) or {})
+    # live captures always highest
+    floor = params[PriorityClass.CAPTURE]['nice']
+    for pclass, settings in params.items():
+        if settings['nice'] < floor:
+            log.info("Niceness for priority class \"%s\" raised to %d (capture)" % (pclass, floor))
+            settings['nice'] = floor
+    return params
+
+#######################
+# scheduling syscalls #
+#######################
+
+# ``ioprio_set`` syscall numbers (no wrapper in glibc)
+IOPRIO_SYSCALLS    = {'x86_64': 251, 'aarch64': 30, 'i686': 289, 'armv7l': 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASSES     = {IoClass.REALTIME: 1, IoClass.BEST_EFFORT: 2, IoClass.IDLE: 3}
+
+libc = ctypes.CDLL(None, use_errno=True)
+
+def ioprio_set(ioclass, level, tid = 0):
+    """
+    :param ioclass: ``IoClass`` value
+    :param level: 0-7 (ignored for ``idle``)
+    :param tid: thread (or process) ID, 0 for the calling thread
+    :return: bool (success)
+    """
+    nr = IOPRIO_SYSCALLS.get(platform.machine())
+    if nr is None or ioclass not in IOPRIO_CLASSES:
+        return False
+    ioprio = (IOPRIO_CLASSES[ioclass] << IOPRIO_CLASS_SHIFT) | (int(level) & 0x7)
+    return libc.syscall(nr, IOPRIO_WHO_PROCESS, tid, ioprio) == 0
+
+def apply_settings(settings, tid = 0):
+    """Apply class settings to a thread (or process); failures (e.g. lack of privilege)
+    are ignored
+
+    :param settings: dict (``nice``, ``ioclass``, ``iolevel``, ``cpus``)
+    :param tid: thread (or process) ID, 0 for the calling thread
+    :return: list of settings that could not be applied
+    """
+    failed = []
+    try:
+        # note: absolute niceness (``os.nice()`` is relative)
+        os.setpriority(os.PRIO_PROCESS, tid, settings['nice'])
+    except OSError:
+        failed.append('nice')
+    if settings.get('ioclass') and not ioprio_set(settings['ioclass'], settings['iolevel'], tid):
+        failed.append('ioclass')
+    if settings.get('cpus'):
+        try:
+            os.sched_setaffinity(tid, settings['cpus'])
+        except OSError:
+            failed.append('cpus')
+    return failed
+
+def apply_process(settings, pid):
+    """Apply class settings to a (child) process, including any threads it has already
+    started
+
+    :param settings: dict (``nice``, ``ioclass``, ``iolevel``, ``cpus``)
+    :param pid: process ID
+    :return: list of settings that could not be applied
+    """
+    failed = set(apply_settings(settings, pid))
+    try:
+        tids = [int(tid) for tid in os.listdir('/proc/%d/task' % (pid)) if int(tid) != pid]
+    except OSError:
+        tids = []
+    for tid in tids:
+        failed.update(apply_settings(settings, tid))
+    return sorted(failed)
+
+###################
+# PriorityClasses #
+###################
+
+# priority classes for the current process (set up by ``Dar``)
+classes = None
+
+class PriorityClasses(object):
+    """Priority class settings, and CPU time accounting per class
+    """
+    def __init__(self, params):
+        """
+        :param params: settings per class (see ``priority_params()``)
+        """
+        self.params   = params
+        self.cpu      = {pclass: {'processes': 0.0, 'threads': 0.0} for pclass in params}
+        self.threads  = {pclass: [] for pclass in params}   # worker threads
+        self.failed   = {pclass: set() for pclass in params}  # settings not applied
+        self.lock     = threading.Lock()
+        # launcher for capture threads (created here, before any thread is reniced)
+        self.launches = queue.Queue()
+        self.launcher = threading.Thread(target=self.launch_loop, name='priority-launcher',
+                                         daemon=True)
+        self.launcher.start()
+
+    def report_failed(self, pclass, failed):
+        """
+        :param pclass: ``PriorityClass`` value
+        :param failed: list of settings that could not be applied
+        """
+        with self.lock:
+            new = set(failed) - self.failed[pclass]
+            self.failed[pclass].update(failed)
+        if not new:
+            return
+        msg = "Could not apply %s for priority class \"%s\"" % (', '.join(sorted(new)), pclass)
+        if pclass == PriorityClass.CAPTURE:
+            # captures may end up running below other classes
+            log.error(msg)
+        else:
+            log.info(msg)
+
+    def launch_loop(self):
+        """Start threads queued by ``start_thread()`` (so that they inherit ``capture``
+        priority)
+        """
+        self.apply_thread(PriorityClass.CAPTURE, register=False)
+        while True:
+            thread, started, error = self.launches.get()
+            try:
+                thread.start()
+            except Exception as e:
+                error.append(e)
+            finally:
+                started.set()
+
+    def start_thread(self, thread):
+        """Start thread from the launcher thread, and wait for it to be started
+
+        :param thread: threading.Thread (not yet started)
+        """
+        if threading.current_thread() is self.launcher:
+            thread.start()
+            return
+        started, error = threading.Event(), []
+        self.launches.put((thread, started, error))
+        started.wait()
+        if error:
+            raise error[0]
+
+    def apply_thread(self, pclass, register = True):
+        """Apply class settings to the calling thread
+
+        :param pclass: ``PriorityClass`` value
+        :param register: account CPU time of thread to class (for long-lived threads)
+        """
+        self.report_failed(pclass, apply_settings(self.params[pclass]))
+        if register:
+            with self.lock:
+                self.threads[pclass] = [t for t in self.threads[pclass] if t.is_alive()]
+                self.threads[pclass].append(threading.current_thread())
+
+    def release_thread(self, pclass):
+        """Account CPU time of the calling (exiting) thread to class, and stop tracking it
+
+        :param pclass: ``PriorityClass`` value
+        """
+        thread = threading.current_thread()
+        with self.lock:
+            if thread in self.threads[pclass]:
+                self.threads[pclass].remove(thread)
+                self.cpu[pclass]['threads'] += time.thread_time()
+
+    def apply_process(self, pclass, pid, nice = None):
+        """Apply class settings to a child process
+
+        :param pclass: ``PriorityClass`` value
+        :param pid: process ID
+        :param nice: [optional] niceness, overriding the class setting
+        """
+        settings = dict(self.params[pclass])
+        if nice is not None:
+            settings['nice'] = max(nice, self.params[PriorityClass.CAPTURE]['nice'])
+        self.report_failed(pclass, apply_process(settings, pid))
+
+    def account(self, pclass, kind, secs):
+        """
+        :param pclass: ``PriorityClass`` value
+        :param kind: 'processes' or 'threads'
+        :param secs: CPU time
+        """
+        with self.lock:
+            self.cpu[pclass][kind] += secs
+
+    def get_status(self):
+        """
+        :return: dict with settings, and CPU secs (user + system) consumed, per class
+        """
+        status = {}
+        with self.lock:
+            for pclass, settings in self.params.items():
+                threads = self.cpu[pclass]['threads']
+                for thread in self.threads[pclass]:
+                    try:
+                        threads += time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+                    except (OSError, TypeError):
+                        pass  # thread exited
+                status[pclass] = {'settings' : settings,
+                                  'failed'   : sorted(self.failed[pclass]),
+                                  'processes': round(self.cpu[pclass]['processes'], 3),
+                                  'threads'  : round(threads, 3)}
+        return status
+
+#############
+# functions #
+#############
+
+def thread_initializer(pclass):
+    """
+    :param pclass: ``PriorityClass`` value
+    :return: function for ``initializer`` of a thread pool (no-op if classes not set up)
+    """
+    def initializer():
+        if classes:
+            classes.apply_thread(pclass)
+    return initializer
+
+def apply_thread(pclass, register = True):
+    """Apply class settings to the calling thread (no-op if classes not set up)
+
+    :param pclass: ``PriorityClass`` value
+    :param register: account CPU time of thread to class (see ``release_thread()``)
+    """
+    if classes:
+        classes.apply_thread(pclass, register)
+
+def account(pclass, secs):
+    """Account CPU time (of a thread, for a unit of work) to class (no-op if classes not
+    set up)
+
+    :param pclass: ``PriorityClass`` value
+    :param secs: CPU time
+    """
+    if classes:
+        classes.account(pclass, 'threads', secs)
+
+def release_thread(pclass):
+    """Account CPU time of the calling (exiting) thread (no-op if classes not set up)
+
+    :param pclass: ``PriorityClass`` value
+    """
+    if classes:
+        classes.release_thread(pclass)
+
+def start_thread(thread):
+    """Start (long-lived) capture thread at ``capture`` priority, regardless of the priority
+    of the calling thread (started directly if classes not set up)
+
+    :param thread: threading.Thread (not yet started)
+    """
+    if classes:
+        classes.start_thread(thread)
+    else:
+        thread.start()
+
+def spawn(args, pclass, nice = None, **kwargs):
+    """Start child process, and apply class settings to it (from the parent)
+
+    :param args: command line (list)
+    :param pclass: ``PriorityClass`` value
+    :param nice: [optional] niceness, overriding the class setting
+    :param kwargs: passed to ``subprocess.Popen``
+    :return: subprocess.Popen
+    """
+    proc = subprocess.Popen(args, **kwargs)
+    if classes:
+        classes.apply_process(pclass, proc.pid, nice)
+    elif nice:
+        try:
+            os.setpriority(os.PRIO_PROCESS, proc.pid, nice)
+        except OSError:
+            pass
+    return proc
+
+def wait(proc, pclass):
+    """Wait for child process, accounting its CPU time to class
+
+    :param proc: subprocess.Popen
+    :param pclass: ``PriorityClass`` value
+    :return: returncode
+    """
+    if proc.returncode is not None:
+        return proc.returncode
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        # already reaped (e.g. by ``poll()`` from another thread)
+        return proc.wait()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if classes:
+        classes.account(pclass, 'processes', usage.ru_utime + usage.ru_stime)
+    return proc.returncode
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+
+"""Station relay - re-streaming of stations to any number of HTTP listeners on the LAN,
+with a single upstream connection per station
+
+Each relayed station has one pump thread, which reads the stream and appends chunks to a
+bounded ring buffer; listeners read from the ring at their own pace (the pump never waits
+for a listener).  A listener that falls further behind than the ring holds
+(``client_buffer``) is evicted.  If a capture of the station is in progress (and its output
+is a raw frame-based format, i.e. MP3 or ADTS AAC), the capture file is tailed rather than
+opening another upstream connection.  The pump exits (closing the upstream connection)
+once a station has had no listeners for ``idle_timeout`` secs.
+"""
+
+import os
+import time
+import threading
+import urllib.request
+from collections import deque
+
+from core import cfg, log
+from playlist import get_playlists
+from seekindex import FRAME_PARSERS
+from priority import PriorityClass
+import inflight
+import priority
+
+##########
+# config #
+##########
+
+RELAY_DFLTS = {'enabled'        : False,
+               'chunk_size'     : 8192,   # bytes
+               'client_buffer'  : 512,    # KB (max lag for a listener before eviction)
+               'burst'          : 64,     # KB (sent to new listener right away)
+               'max_clients'    : 32,     # per station
+               'idle_timeout'   : 30,     # secs (keep upstream open with no listeners)
+               'connect_timeout': 10,     # secs
+               'capture_check'  : 5}      # secs (between checks for an active capture)
+
+USER_AGENT = 'cmdar-relay'
+
+# secs between reads of a tailed capture file (at end of file)
+TAIL_INTERVAL = 0.25
+
+def relay_params(cfg_profile = None):
+    """Get relay parameters (config overlaid on defaults)
+
+    :param cfg_profile: optional (None means ``default``)
+    :return: dict
+    """
+    params = dict(RELAY_DFLTS)
+    params.update(cfg.config('relay', cfg_profile))
+    return params
+
+class ListenerEvicted(Exception):
+    """Listener fell too far behind the stream
+    """
+    pass
+
+###############
+# StationPump #
+###############
+
+class StationPump(object):
+    """Single source of stream content for a station, fanned out to listeners through a
+    ring buffer of chunks
+    """
+    def __init__(self, name, info, params, cfg_profile = None):
+        """
+        :param name: station name
+        :param info: station config (``stream_url``, ``media_type``)
+        :param params: relay parameters
+        :param cfg_profile: optional (None means ``default``)
+        """
+        self.name        = name
+        self.params      = params
+        self.cfg_profile = cfg_profile
+        urls             = info['stream_url']
+        # same URL preference as scheduled recordings (last one on the list)
+        self.urls        = list(reversed(urls)) if isinstance(urls, list) else [urls]
+        self.media_type  = info['media_type']
+        nchunks          = max(params['client_buffer'] * 1024 // params['chunk_size'], 2)
+        self.burst       = min(params['burst'] * 1024 // params['chunk_size'], nchunks - 1)
+        self.ring        = deque(maxlen=nchunks)   # (seq, chunk)
+        self.last_seq    = 0
+        self.cond        = threading.Condition()
+        self.listeners   = 0
+        self.idle_since  = time.time()
+        self.source      = None
+        self.evictions   = 0
+        self.stopping    = threading.Event()
+        self.thread      = threading.Thread(target=self.run, name='relay-%s' % (name),
+                                            daemon=True)
+
+    def start(self):
+        # not from the calling thread, which may be running at a lower priority
+        priority.start_thread(self.thread)
+
+    @property
+    def alive(self):
+        return self.thread.is_alive()
+
+    def append(self, chunk):
+        """
+        :param chunk: bytes
+        """
+        with self.cond:
+            self.last_seq += 1
+            self.ring.append((self.last_seq, chunk))
+            self.cond.notify_all()
+
+    def listen(self):
+        """
+        :return: Listener (iterator of chunks), registered right away
+        """
+        with self.cond:
+            if self.listeners >= self.params['max_clients']:
+                raise RuntimeError("Too many listeners for station \"%s\"" % (self.name))
+            self.listeners += 1
+            return Listener(self, max(self.last_seq - self.burst, 0))
+
+    def release(self):
+        """Unregister listener
+        """
+        with self.cond:
+            self.listeners -= 1
+            if self.listeners == 0:
+                self.idle_since = time.time()
+
+    def read(self, seq):
+        """Get chunks after ``seq``, waiting for new chunks if needed (raises
+        ``ListenerEvicted`` if ``seq`` is no longer in the ring buffer)
+
+        :param seq: last chunk sequence number seen by listener
+        :return: tuple (new last seq, list of chunks), or (seq, None) if pump stopped
+        """
+        with self.cond:
+            while self.last_seq <= seq:
+                if self.stopping.is_set() or not self.alive:
+                    return seq, None
+                self.cond.wait(self.params['connect_timeout'])
+            first = self.ring[0][0]
+            if seq + 1 < first:
+                self.evictions += 1
+                raise ListenerEvicted("Listener for station \"%s\" evicted (%d chunks behind)" %
+                                      (self.name, self.last_seq - seq))
+            # ring seqs are contiguous, so index directly
+            return self.last_seq, [self.ring[i][1] for i in range(seq + 1 - first,
+                                                                 len(self.ring))]
+
+    def idle(self):
+        """
+        :return: bool (whether pump should exit, having had no listeners for a while)
+        """
+        with self.cond:
+            return (self.listeners == 0 and
+                    time.time() - self.idle_since >= self.params['idle_timeout'])
+
+    def active_capture(self):
+        """
+        :return: pathname of capture of station in progress (raw format only), or None
+        """
+        if not inflight.registry:
+            return None
+        now = time.time()
+        for entry in reversed(inflight.registry.entries()):
+            if entry['station'] != self.name or entry['end_time'] <= now:
+                continue
+            if os.path.splitext(entry['path'])[1].lower() not in FRAME_PARSERS:
+                continue
+            if inflight.pid_alive(entry['pid'], entry['proc_start']):
+                return entry['path']
+        return None
+
+    def tail_capture(self, path):
+        """Relay content appended to capture file, until the capture ends (or listeners go
+        away)
+
+        :param path: pathname of capture file
+        """
+        chunk_size = self.params['chunk_size']
+        next_check = time.time() + self.params['capture_check']
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            while not (self.stopping.is_set() or self.idle()):
+                chunk = f.read(chunk_size)
+                if chunk:
+                    self.append(chunk)
+                    continue
+                if time.time() >= next_check:
+                    if self.active_capture() != path:
+                        return
+                    next_check = time.time() + self.params['capture_check']
+                time.sleep(TAIL_INTERVAL)
+
+    def pull_upstream(self):
+        """Relay stream from upstream connection, until a capture of the station starts (or
+        listeners go away)
+        """
+        playlists = get_playlists(self.cfg_profile)
+        for url in self.urls:
+            stream_url = playlists.resolve(url) if playlists else url
+            req = urllib.request.Request(stream_url, headers={'User-Agent': USER_AGENT})
+            try:
+                resp = urllib.request.urlopen(req, timeout=self.params['connect_timeout'])
+            except Exception as e:
+                log.info("Relay for \"%s\" could not connect to \"%s\": %s" %
+                         (self.name, stream_url, e))
+                continue
+            log.info("Relay for \"%s\" connected to \"%s\"" % (self.name, stream_url))
+            self.source = stream_url
+            chunk_size = self.params['chunk_size']
+            next_check = time.time() + self.params['capture_check']
+            with resp:
+                while not (self.stopping.is_set() or self.idle()):
+                    chunk = resp.read1(chunk_size)
+                    if not chunk:
+                        log.info("Relay upstream for \"%s\" closed" % (self.name))
+                        break
+                    self.append(chunk)
+                    if time.time() >= next_check:
+                        if self.active_capture():
+                            return
+                        next_check = time.time() + self.params['capture_check']
+            return
+        # all URLs failed, back off before retrying
+        self.stopping.wait(self.params['connect_timeout'])
+
+    def run(self):
+        """Pump loop, switching between an active capture and the upstream connection
+        """
+        # pumps feed warm pool recordings, so run at capture priority
+        priority.apply_thread(PriorityClass.CAPTURE)
+        try:
+            while not (self.stopping.is_set() or self.idle()):
+                path = self.active_capture()
+                try:
+                    if path:
+                        log.info("Relay for \"%s\" tailing capture \"%s\"" % (self.name, path))
+                        self.source = path
+                        self.tail_capture(path)
+                    else:
+                        self.pull_upstream()
+                except Exception as e:
+                    log.info("Relay for \"%s\" failed: %s" % (self.name, e))
+                    self.stopping.wait(1.0)
+        finally:
+            self.source = None
+            with self.cond:
+                self.cond.notify_all()
+            priority.release_thread(PriorityClass.CAPTURE)
+            log.info("Relay for \"%s\" stopped" % (self.name))
+
+    def stop(self):
+        self.stopping.set()
+        with self.cond:
+            self.cond.notify_all()
+
+    def get_status(self):
+        """
+        :return: dict
+        """
+        with self.cond:
+            return {'listeners': self.listeners,
+                    'source'   : self.source,
+                    'evictions': self.evictions,
+                    'chunks'   : self.last_seq}
+
+############
+# Listener #
+############
+
+class Listener(object):
+    """Iterator of chunks for a listener (``close()`` must be called when done, which the
+    WSGI server does for a response iterable)
+    """
+    def __init__(self, pump, seq):
+        self.pump    = pump
+        self.seq     = seq
+        self.pending = deque()
+        self.closed  = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self.pending:
+            if self.closed:
+                raise StopIteration
+            try:
+                self.seq, chunks = self.pump.read(self.seq)
+            except ListenerEvicted as e:
+                log.info(str(e))
+                self.close()
+                raise StopIteration
+            if chunks is None:
+                self.close()
+                raise StopIteration
+            self.pending.extend(chunks)
+        return self.pending.popleft()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.pump.release()
+
+############
+# RelayHub #
+############
+
+# relay hub for the current process (set up by ``Dar``)
+hub = None
+
+class RelayHub(object):
+    """Station pumps, started on demand (first listener for a station)
+    """
+    def __init__(self, stations, cfg_profile = None):
+        """
+        :param stations: ``stations`` config
+        :param cfg_profile: optional (None means ``default``)
+        """
+        self.stations    = stations
+        self.cfg_profile = cfg_profile
+        self.params      = relay_params(cfg_profile)
+        self.pumps       = {}
+        self.lock        = threading.Lock()
+
+    def listen(self, station):
+        """
+        :param station: station name
+        :return: tuple (media type, Listener)
+        """
+        if station not in self.stations:
+            raise KeyError(station)
+        with self.lock:
+            pump = self.pumps.get(station)
+            if not pump or not pump.alive or pump.stopping.is_set():
+                pump = StationPump(station, self.stations[station], self.params,
+                                   self.cfg_profile)
+                self.pumps[station] = pump
+                pump.start()
+            return pump.media_type, pump.listen()
+
+    def stop(self):
+        with self.lock:
+            for pump in self.pumps.values():
+                pump.stop()
+            self.pumps = {}
+
+    def get_status(self):
+        """
+        :return: dict of station status, for active relays
+        """
+        with self.lock:
+            return {name: pump.get_status() for name, pump in self.pumps.items()
+                    if pump.alive}
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Retention - enforcement of retention policies and quotas for ``rec_dir``
+
+Policies are specified per station (``retention`` config, ``stations`` entry, with
+``default`` applying to stations not listed) or per program (``retention`` entry in the
+program config, which takes precedence for recordings of that program).  A policy may
+specify any of ``keep_last`` (number of recordings), ``max_age`` (days) and ``quota``
+(total MB); recordings exceeding any of the limits are removed, oldest first.
+
+Retention passes run as a background job, working from the catalog (no directory walks),
+and remove recordings in batches of ``batch_size`` with a pause in between.  With
+``action: archive``, a recording is first transcoded to the archive profile for its media
+type (see ``archive.py``), and only deleted if it still exceeds the policy in a later pass.
+Recordings being captured (``inflight`` registry) or transcoded are never removed.
+
+Each pass also reserves space for recordings scheduled within the next ``reserve_ahead``
+secs (based on expected bitrate and duration): if free space in ``rec_dir`` would fall
+below ``min_free``, the oldest recordings covered by a policy are removed (or archived)
+until the reservation fits.  Recordings of stations (and programs) with no policy are
+never removed automatically.
+"""
+
+import os
+import time
+
+from core import BASE_DIR, cfg, log
+from utils import truthy
+from streamer import Streamer
+from staging import free_bytes, DFLT_BITRATE
+from seekindex import IDX_SUFFIX
+from peaks import PEAKS_SUFFIX
+from checksum import HASH_SUFFIX
+from archive import archive_profile, archive_recording, archive_params, archiving
+import catalog
+import inflight
+
+##########
+# config #
+##########
+
+RETENTION_DFLTS = {'enabled'      : False,
+                   'interval'     : 3600,     # secs (between retention passes)
+                   'batch_size'   : 20,       # recordings
+                   'batch_pause'  : 1.0,      # secs (between batches)
+                   'action'       : 'delete', # or 'archive'
+                   'reserve_ahead': 3600,     # secs (look-ahead for scheduled recordings)
+                   'min_free'     : 1024,     # MB (to be left free after reservation)
+                   'default'      : {},       # policy for stations not listed
+                   'stations'     : {}}       # policies, keyed by station name
+
+POLICY_KEYS = ('keep_last', 'max_age', 'quota')
+
+# sidecar files removed along with a recording
+SIDECAR_SUFFIXES = [IDX_SUFFIX, PEAKS_SUFFIX, HASH_SUFFIX]
+
+def retention_params(cfg_profile = None):
+    """Get retention parameters (config overlaid on defaults)
+
+    :param cfg_profile: optional (None means ``default``)
+    :return: dict
+    """
+    params = dict(RETENTION_DFLTS)
+    params.update(cfg.config('retention', cfg_profile))
+    return params
+
+def get_policy(rec, params, programs):
+    """
+    :param rec: recording (dict from catalog)
+    :param params: retention parameters
+    :param programs: ``programs`` config
+    :return: tuple (group key, policy dict), or (None, None) if no policy applies
+    """
+    prog_policy = (programs.get(rec['job_id']) or {}).get('retention') if rec['job_id'] else None
+    if prog_policy:
+        return ('program', rec['job_id']), prog_policy
+    policy = (params['stations'] or {}).get(rec['station']) or params['default']
+    if not policy or not any(policy.get(key) for key in POLICY_KEYS):
+        return None, None
+    return ('station', rec['station']), policy
+
+##############
+# protection #
+##############
+
+def active_paths():
+    """
+    :return: set of pathnames of captures in progress on this host
+    """
+    if not inflight.registry:
+        return set()
+    return {entry['path'] for entry in inflight.registry.entries()
+            if inflight.pid_alive(entry['pid'], entry['proc_start'])}
+
+def is_protected(rec, active):
+    """
+    :param rec: recording (dict from catalog)
+    :param active: set of pathnames of captures in progress
+    :return: bool (whether recording must not be removed)
+    """
+    return rec['path'] in active or rec['path'] in archiving
+
+############
+# planning #
+############
+
+def plan_retention(recs, params, programs, now = None):
+    """Determine recordings exceeding their retention policies
+
+    :param recs: list of recordings (dicts from catalog), oldest first
+    :param params: retention parameters
+    :param programs: ``programs`` config
+    :param now: [optional] epoch time
+    :return: list of (recording, reason) tuples, oldest first
+    """
+    now = now or time.time()
+    groups = {}
+    for rec in recs:
+        key, policy = get_policy(rec, params, programs)
+        if key:
+            groups.setdefault(key, (policy, []))[1].append(rec)
+
+    expired = {}
+    for key, (policy, group) in groups.items():
+        keep_last = policy.get('keep_last')
+        max_age   = policy.get('max_age')
+        quota     = policy.get('quota')
+        total     = 0
+        # newest first, so that limits are applied to the oldest recordings
+        for n, rec in enumerate(reversed(group)):
+            total += rec['size'] or 0
+            if keep_last and n >= keep_last:
+                reason = 'keep_last'
+            elif max_age and now - rec['created'] > max_age * 86400:
+                reason = 'max_age'
+            elif quota and total > quota * 1024 * 1024:
+                reason = 'quota'
+            else:
+                continue
+            expired[rec['id']] = (rec, "%s %s" % (key[0], reason))
+    return sorted(expired.values(), key=lambda item: item[0]['created'])
+
+def plan_reservation(recs, needed, free, min_free, exclude = (), freed = None):
+    """Determine (oldest) recordings to remove so that ``needed`` bytes can be written while
+    leaving ``min_free`` MB free
+
+    :param recs: list of recordings (dicts from catalog), oldest first, covered by a policy
+    :param needed: bytes reserved for scheduled recordings
+    :param free: bytes currently available
+    :param min_free: MB
+    :param exclude: IDs of recordings already being removed
+    :param freed: [optional] function returning bytes freed by removing a recording
+                  (defaults to its size)
+    :return: list of (recording, reason) tuples, oldest first
+    """
+    deficit = needed + min_free * 1024 * 1024 - free
+    removed = []
+    for rec in recs:
+        if deficit <= 0:
+            break
+        if rec['id'] in exclude:
+            continue
+        removed.append((rec, 'reserve'))
+        deficit -= freed(rec) if freed else rec['size'] or 0
+    return removed
+
+def parse_bitrate(bitrate):
+    """
+    :param bitrate: bits/sec (int, or str with optional ``k``/``M`` suffix, as for ``ffmpeg``)
+    :return: bits/sec (int)
+    """
+    value = str(bitrate).strip()
+    mult = {'k': 1000, 'm': 1000000}.get(value[-1:].lower())
+    return int(float(value[:-1]) * mult) if mult else int(float(value))
+
+def estimate_freed(rec, action, streamer, cfg_profile = None):
+    """
+    :param rec: recording (dict from catalog)
+    :param action: 'delete' or 'archive'
+    :param streamer: streamer name in config.yml
+    :param cfg_profile: optional (None means ``default``)
+    :return: expected bytes freed by removing recording (see ``remove_recording()``);
+             archiving only frees the difference between source and archive bitrates
+    """
+    size = rec['size'] or 0
+    if action != 'archive' or rec['archived']:
+        return size
+    profile = archive_profile(streamer, rec['media_type'], cfg_profile)
+    if not profile:
+        return size
+    try:
+        src_bps = Streamer.get(streamer, cfg_profile).expected_bps(rec['media_type'])
+    except KeyError:
+        src_bps = None
+    ratio = parse_bitrate(profile['bitrate']) / 8 / (src_bps or DFLT_BITRATE / 8)
+    return max(int(size * (1 - ratio)), 0)
+
+def reserve_bytes(upcoming, streamer, cfg_profile = None):
+    """
+    :param upcoming: list of dicts for scheduled recordings (``media_type``, ``duration``,
+                     optional ``bitrate``)
+    :param streamer: streamer name in config.yml
+    :param cfg_profile: optional (None means ``default``)
+    :return: expected bytes to be written
+    """
+    engine = Streamer.get(streamer, cfg_profile)
+    total = 0
+    for item in upcoming:
+        try:
+            bps = engine.expected_bps(item['media_type'], item.get('bitrate'))
+        except KeyError:
+            bps = None
+        total += item['duration'] * (bps or DFLT_BITRATE / 8)
+    return int(total)
+
+#############
+# execution #
+#############
+
+def delete_recording(rec):
+    """Delete recording file (and sidecar files) and catalog entry
+
+    :param rec: recording (dict from catalog)
+    :return: bytes freed
+    """
+    path = rec['path']
+    size = 0
+    for file in [path] + [path + suffix for suffix in SIDECAR_SUFFIXES]:
+        try:
+            size += os.path.getsize(file)
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+    catalog.catalog.delete_recording(rec['id'])
+    return size
+
+def remove_recording(rec, action, streamer, cfg_profile = None):
+    """Archive recording (if ``action`` is ``archive`` and it has not already been archived),
+    otherwise delete it
+
+    :param rec: recording (dict from catalog)
+    :param action: 'delete' or 'archive'
+    :param streamer: streamer name in config.yml
+    :param cfg_profile: optional (None means ``default``)
+    :return: tuple (action taken, bytes freed)
+    """
+    if action == 'archive' and not rec['archived'] and os.path.exists(rec['path']):
+        profile = archive_profile(streamer, rec['media_type'], cfg_profile)
+        if profile:
+            size = os.path.getsize(rec['path'])
+            new_path = archive_recording(rec, profile, archive_params(cfg_profile)['nice'])
+            return 'archive', size - os.path.getsize(new_path)
+    return 'delete', delete_recording(rec)
+
+def run_retention(streamer, rec_path, upcoming = None, cfg_profile = None, dry_run = False):
+    """Retention pass: enforce policies and reserve space for scheduled recordings (invoked
+    as an interval job by the scheduler)
+
+    :param streamer: streamer name in config.yml
+    :param rec_path: recordings directory
+    :param upcoming: [optional] function returning list of recordings scheduled within the
+                     next ``secs`` (see ``reserve_bytes()``)
+    :param cfg_profile: optional (None means ``default``)
+    :param dry_run: only report recordings that would be removed
+    :return: list of dicts (``path``, ``reason``, ``action``, ``freed``)
+    """
+    if not catalog.catalog:
+        return []
+    params = retention_params(cfg_profile)
+    programs = cfg.config('programs', cfg_profile)
+    active = active_paths()
+    recs = [rec for rec in catalog.catalog.get_recordings() if not is_protected(rec, active)]
+
+    todo = plan_retention(recs, params, programs)
+    if upcoming:
+        needed = reserve_bytes(upcoming(params['reserve_ahead']), streamer, cfg_profile)
+        try:
+            free = free_bytes(rec_path)
+        except OSError as e:
+            log.info("Could not check free space in \"%s\": %s" % (rec_path, e))
+            free = None
+        if free is not None:
+            freed = lambda rec: estimate_freed(rec, params['action'], streamer, cfg_profile)
+            # space freed by policies counts toward the reservation
+            free += sum(freed(rec) for rec, _ in todo)
+            # only recordings covered by a policy are subject to automatic removal
+            covered = [rec for rec in recs if get_policy(rec, params, programs)[0]]
+            todo += plan_reservation(covered, needed, free, params['min_free'],
+                                     {rec['id'] for rec, _ in todo}, freed)
+    if dry_run:
+        return [{'path': rec['path'], 'reason': reason, 'action': None, 'freed': 0}
+                for rec, reason in todo]
+
+    results = []
+    batch_size = max(int(params['batch_size']), 1)
+    for i in range(0, len(todo), batch_size):
+        if i > 0:
+            time.sleep(params['batch_pause'])
+        for rec, reason in todo[i:i + batch_size]:
+            try:
+                action, freed = remove_recording(rec, params['action'], streamer, cfg_profile)
+            except Exception as e:
+                log.error("Could not remove \"%s\": %s" % (rec['path'], e))
+                continue
+            log.info("Retention (%s): %s \"%s\" (%d bytes freed)" %
+                     (reason, action, rec['path'], freed))
+            results.append({'path': rec['path'], 'reason': reason, 'action': action,
+                            'freed': freed})
+    if results:
+        log.info("Retention pass: %d recordings removed, %d bytes freed" %
+                 (len(results), sum(res['freed'] for res in results)))
+    return results
+
+def start_retention(sched, jobstore, executor, streamer, rec_path, upcoming = None,
+                    cfg_profile = None):
+    """Schedule retention passes (no-op if not enabled)
+
+    :param sched: apscheduler handle
+    :param jobstore: job store alias (should be non-persistent)
+    :param executor: executor alias (should be separate from capture jobs)
+    :param streamer: streamer name in config.yml
+    :param rec_path: recordings directory
+    :param upcoming: [optional] function returning scheduled recordings (see ``run_retention()``)
+    :param cfg_profile: optional (None means ``default``)
+    """
+    params = retention_params(cfg_profile)
+    if not truthy(params['enabled']):
+        return
+    sched.add_job(run_retention, 'interval', seconds=params['interval'],
+                  args=(streamer, rec_path, upcoming, cfg_profile), id='retention',
+                  name='Retention pass', jobstore=jobstore, executor=executor,
+                  replace_existing=True, coalesce=True, max_instances=1)
+
+#####################
+# command line tool #
+#####################
+
+import json
+import click
+
+@click.command()
+@click.option('--apply',    is_flag=True, help="Remove recordings (default is to only report them)")
+@click.option('--streamer', default='vlc', help="Streamer in config.yml (for archive profiles)")
+@click.option('--profile',  default=None, type=str, help="Profile in config.yml")
+def main(apply, streamer, profile):
+    """Report (or remove) recordings exceeding their retention policies
+    """
+    scheduler = cfg.config('scheduler', profile)
+    rec_dir = scheduler['rec_dir']
+    if rec_dir[0] not in ('/.'):
+        rec_dir = os.path.join(BASE_DIR, rec_dir)
+    if not scheduler.get('catalog_file'):
+        raise click.UsageError("Catalog not configured (scheduler.catalog_file)")
+    db_dir = scheduler.get('db_dir') or '.'
+    if db_dir[0] not in ('/.'):
+        db_dir = os.path.join(BASE_DIR, db_dir)
+    catalog.catalog = catalog.Catalog('sqlite:///' + os.path.join(db_dir, scheduler['catalog_file']))
+    print(json.dumps(run_retention(streamer, rec_dir, cfg_profile=profile, dry_run=not apply),
+                     indent=2))
+
+if __name__ == '__main__':
+    main()
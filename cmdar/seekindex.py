@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Seek index - sidecar file mapping elapsed time to byte offset for a recording
+
+The index is built while the recording is being written (the capture monitor thread
+tails the output file and parses frame headers), and records the byte offset of the first
+frame at or after each ``interval`` seconds of audio.  Looking up the offset for a given
+time is then a single array access, instead of a scan of the file from the start (which
+is otherwise needed for VBR streams).
+
+Sidecar format (``<recording>.idx``): 16-byte header (magic, interval as a little-endian
+double), followed by an array of little-endian unsigned 64-bit offsets.  Entries are only
+ever appended, so a partially written index is always a valid prefix.
+
+Only raw frame-based formats are indexed (MP3 and ADTS AAC); MP4 (``.m4a``) recordings
+carry their own sample tables, written by the muxer.
+"""
+
+import os
+import sys
+import struct
+import threading
+from array import array
+
+from core import cfg, log
+from utils import truthy
+
+##########
+# config #
+##########
+
+SEEK_DFLTS = {'enabled' : True,
+              'interval': 10}   # secs (between index entries)
+
+IDX_SUFFIX = '.idx'
+IDX_MAGIC  = b'DARIDX\x01\x00'
+IDX_HEADER = struct.Struct('<8sd')
+
+def seek_params(cfg_profile = None):
+    """Get seek index parameters (config overlaid on defaults)
+
+    :param cfg_profile: optional (None means ``default``)
+    :return: dict
+    """
+    params = dict(SEEK_DFLTS)
+    params.update(cfg.config('seek_index', cfg_profile))
+    return params
+
+#################
+# frame headers #
+#################
+
+# MPEG audio bitrates (kbps), by (version is MPEG-1, layer)
+MPEG_BITRATES = {(True, 1) : [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+                 (True, 2) : [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+                 (True, 3) : [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+                 (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+                 (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+                 (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]}
+
+# MPEG audio sample rates, by version bits (MPEG-2.5, reserved, MPEG-2, MPEG-1)
+MPEG_RATES    = {0: [11025, 12000, 8000],
+                 2: [22050, 24000, 16000],
+                 3: [44100, 48000, 32000]}
+
+ADTS_RATES    = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000,
+                 11025, 8000, 7350]
+
+def mpeg_frame(hdr):
+    """Parse MPEG audio (e.g. MP3) frame header
+
+    :param hdr: at least 4 bytes
+    :return: tuple (frame length, samples, sample rate), or None if not a valid header
+    """
+    if hdr[0] != 0xFF or hdr[1] & 0xE0 != 0xE0:
+        return None
+    version = (hdr[1] >> 3) & 0x03
+    layer   = 4 - ((hdr[1] >> 1) & 0x03)
+    br_idx  = hdr[2] >> 4
+    sr_idx  = (hdr[2] >> 2) & 0x03
+    padding = (hdr[2] >> 1) & 0x01
+    if version == 1 or layer == 4 or br_idx in (0, 15) or sr_idx == 3:
+        return None
+    mpeg1   = version == 3
+    bitrate = MPEG_BITRATES[(mpeg1, layer)][br_idx] * 1000
+    rate    = MPEG_RATES[version][sr_idx]
+    if layer == 1:
+        return (12 * bitrate // rate + padding) * 4, 384, rate
+    samples = 1152 if layer == 2 or mpeg1 else 576
+    return samples // 8 * bitrate // rate + padding, samples, rate
+
+def adts_frame(hdr):
+    """Parse ADTS (AAC) frame header
+
+    :param hdr: at least 7 bytes
+    :return: tuple (frame length, samples, sample rate), or None if not a valid header
+    """
+    if hdr[0] != 0xFF or hdr[1] & 0xF6 != 0xF0:
+        return None
+    sr_idx = (hdr[2] >> 2) & 0x0F
+    length = ((hdr[3] & 0x03) << 11) | (hdr[4] << 3) | (hdr[5] >> 5)
+    if sr_idx >= len(ADTS_RATES) or length < 7:
+        return None
+    return length, 1024 * ((hdr[6] & 0x03) + 1), ADTS_RATES[sr_idx]
+
+# frame parsers by file type, with header size
+FRAME_PARSERS = {'.mp3': (mpeg_frame, 4),
+                 '.aac': (adts_frame, 7)}
+
+def id3_size(data):
+    """
+    :param data: at least 10 bytes from start of file
+    :return: size of ID3v2 tag (0 if none)
+    """
+    if data[:3] != b'ID3':
+        return 0
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    return 10 + size + (10 if data[5] & 0x10 else 0)
+
+###############
+# SeekIndexer #
+###############
+
+class SeekIndexer(object):
+    """Incremental index builder for a recording being written (``feed()`` may be called
+    from another thread than ``close()``)
+    """
+    def __init__(self, path, interval = SEEK_DFLTS['interval']):
+        """
+        :param path: pathname of recording (must have a supported file type)
+        :param interval: secs between index entries
+        """
+        self.path      = path
+        self.parser, self.hdr_size = FRAME_PARSERS[os.path.splitext(path)[1].lower()]
+        self.interval  = interval
+        self.offset    = None   # file offset of next frame (None until ID3 tag skipped)
+        self.elapsed   = 0.0    # secs of audio before ``offset``
+        self.next_mark = 0.0
+        self.entries   = 0
+        self.idx_file  = None
+        self.lock      = threading.Lock()
+
+    def feed(self, final = False):
+        """Parse frames written since last call, and append index entries
+
+        :param final: recording is complete (last frame need not be followed by another)
+        :return: number of index entries so far
+        """
+        with self.lock:
+            try:
+                with open(self.path, 'rb') as f:
+                    if self.offset is None:
+                        head = f.read(10)
+                        if len(head) < 10 and not final:
+                            return self.entries
+                        self.offset = id3_size(head)
+                    f.seek(self.offset)
+                    data = f.read()
+            except FileNotFoundError:
+                return self.entries
+
+            offsets = array('Q')
+            pos = 0
+            hdr = self.hdr_size
+            while pos + hdr <= len(data):
+                frame = self.parser(data[pos:pos + hdr])
+                if frame:
+                    length, samples, rate = frame
+                    end = pos + length
+                    if end + hdr <= len(data):
+                        # guard against false sync: next frame must follow immediately
+                        if not self.parser(data[end:end + hdr]):
+                            frame = None
+                    elif not (final and end <= len(data)):
+                        break
+                if not frame:
+                    pos += 1
+                    continue
+                while self.elapsed >= self.next_mark:
+                    offsets.append(self.offset + pos)
+                    self.next_mark += self.interval
+                self.elapsed += samples / rate
+                pos = end
+            self.offset += pos
+            if offsets:
+                self.append(offsets)
+            return self.entries
+
+    def append(self, offsets):
+        """Append entries to sidecar file (creating it, if needed)
+
+        :param offsets: array('Q')
+        """
+        if not self.idx_file:
+            self.idx_file = open(self.path + IDX_SUFFIX, 'wb')
+            self.idx_file.write(IDX_HEADER.pack(IDX_MAGIC, self.interval))
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        self.idx_file.write(offsets.tobytes())
+        self.idx_file.flush()
+        self.entries += len(offsets)
+
+    def close(self):
+        """Index remaining frames and close sidecar file
+
+        :return: number of index entries
+        """
+        self.feed(final=True)
+        with self.lock:
+            if self.idx_file:
+                self.idx_file.close()
+                self.idx_file = None
+        log.debug("Seek index for \"%s\": %d entries, %.1f secs" %
+                  (self.path, self.entries, self.elapsed))
+        return self.entries
+
+def get_indexer(path, cfg_profile = None):
+    """
+    :param path: pathname of recording
+    :param cfg_profile: optional (None means ``default``)
+    :return: SeekIndexer (or None, if not enabled or file type not supported)
+    """
+    params = seek_params(cfg_profile)
+    if not truthy(params['enabled']):
+        return None
+    if os.path.splitext(path)[1].lower() not in FRAME_PARSERS:
+        return None
+    return SeekIndexer(path, params['interval'])
+
+def build_index(path, interval = SEEK_DFLTS['interval']):
+    """Build (or rebuild) index for a complete recording
+
+    :param path: pathname of recording
+    :param interval: secs between index entries
+    :return: number of index entries
+    """
+    if os.path.exists(path + IDX_SUFFIX):
+        os.remove(path + IDX_SUFFIX)
+    return SeekIndexer(path, interval).close()
+
+#############
+# SeekIndex #
+#############
+
+class SeekIndex(object):
+    """Read access to sidecar index
+    """
+    def __init__(self, path):
+        """
+        :param path: pathname of recording (or of the index file itself)
+        """
+        idx_path = path if path.endswith(IDX_SUFFIX) else path + IDX_SUFFIX
+        with open(idx_path, 'rb') as f:
+            magic, self.interval = IDX_HEADER.unpack(f.read(IDX_HEADER.size))
+            if magic != IDX_MAGIC:
+                raise RuntimeError("Not a seek index: \"%s\"" % (idx_path))
+            data = f.read()
+        self.offsets = array('Q')
+        # ignore partial trailing entry (index may still be written to)
+        self.offsets.frombytes(data[:len(data) - len(data) % self.offsets.itemsize])
+        if sys.byteorder != 'little':
+            self.offsets.byteswap()
+
+    def offset(self, secs):
+        """
+        :param secs: elapsed time in recording
+        :return: byte offset of frame at or before ``secs`` (to within ``interval``)
+        """
+        if not self.offsets:
+            raise RuntimeError("Seek index is empty")
+        return self.offsets[min(max(int(secs // self.interval), 0), len(self.offsets) - 1)]
+
+    @property
+    def duration(self):
+        """
+        :return: secs of audio covered by index (to within ``interval``)
+        """
+        return len(self.offsets) * self.interval
+
+#####################
+# command line tool #
+#####################
+
+import click
+
+@click.command()
+@click.option('--build',    is_flag=True, help="Build (or rebuild) index for recording")
+@click.option('--seek',     default=None, type=float, help="Print byte offset for time (secs)")
+@click.option('--interval', default=SEEK_DFLTS['interval'], help="Secs between index entries")
+@click.argument('path',     required=True)
+def main(build, seek, interval, path):
+    """Build or query seek index for recording
+    """
+    if build:
+        print("%d entries" % (build_index(path, interval)))
+    if seek is not None:
+        print(SeekIndex(path).offset(seek))
+
+if __name__ == '__main__':
+    main()
@@ -5,14 +5,21 @@
 """
 
 import sys
+import json
+import hashlib
 import logging
 import threading
+import time
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context, g
 import click
 
-from core import BASE_DIR, cfg, log, dbg_hand
-from dar import Dar, TodoState
+from __init__ import ConfigError
+from core import BASE_DIR, cfg, log, debug_logging
+from dar import Dar
+from priority import PriorityClass
+import events
+import priority
 
 #############
 # Flask App #
@@ -20,6 +27,55 @@ from dar import Dar, TodoState
 
 app = Flask(__name__)
 
+@app.before_request
+def request_priority():
+    """Run request handling at ``api`` priority (see ``priority.py``)
+    """
+    priority.apply_thread(PriorityClass.API, register=False)
+    g.cpu_start = time.thread_time()
+
+@app.teardown_request
+def request_cpu(exc):
+    """Account CPU time for request handling to ``api`` priority class
+    """
+    if 'cpu_start' in g:
+        priority.account(PriorityClass.API, time.thread_time() - g.cpu_start)
+
+####################
+# Cached Responses #
+####################
+
+# JSON response snapshots: {key: (version, etag, body)}; keys must come from a bounded set
+# (route names, configured stations), since snapshots are never evicted
+snapshots = {}
+snapshots_lock = threading.Lock()
+
+def cached_json(key, build):
+    """Respond with JSON from cached snapshot, which is rebuilt (using ``build()``) only
+    when the DAR version changes (i.e. on scheduler events and config reloads); supports
+    conditional GET (``ETag`` and ``If-None-Match``), so polling clients get 304s
+
+    :param key: snapshot name
+    :param build: function returning data (JSON-serializable)
+    :return: Response
+    """
+    version = dar.version
+    with snapshots_lock:
+        snap = snapshots.get(key)
+    if not snap or snap[0] != version:
+        body = json.dumps(build(), default=str, sort_keys=True).encode()
+        snap = (version, hashlib.sha1(body).hexdigest()[:20], body)
+        with snapshots_lock:
+            snapshots[key] = snap
+    _, etag, body = snap
+    if etag in request.if_none_match:
+        resp = Response(status=304)
+    else:
+        resp = Response(body, mimetype='application/json')
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
 ################
 # Flask Routes #
 ################
@@ -33,6 +89,8 @@ PATCH  /dar                             - change DAR state
 
 GET    /stations                        - list stations (state/info)
 GET    /stations/<id>                   - get station state/info
+GET    /stations/<name>/stream          - listen to station through relay [**]
+POST   /stations/<name>/record          - start manual recording now [**]
 PATCH  /stations/<id>                   - schedule manual recording
 
 GET    /programs[?<params>]             - list programs (state/info)
@@ -45,12 +103,21 @@ DELETE /programs/<id>                   - delete program
 [Note: Todo Items represent active programs + manual recordings]
 GET    /todos[?<params>]                - list todo items (state/info) [**]
 GET    /todos/<id>                      - get todo item state/info
+GET    /todos/<id>/runs[?<params>]      - get timing spans for recent runs [**]
 PATCH  /todos/<id>                      - change todo item state
 DELETE /todos/<id>                      - cancel todo item
 
+GET    /recordings/<id>/peaks[?<params>] - get waveform peaks for recording [**]
+
 ----------------------------
 Browser (pure-GET) shortcuts
 ----------------------------
+GET    /cluster                         - show cluster nodes and open claims [**]
+GET    /relay                           - show active station relays [**]
+GET    /warm_pool                       - show warm pool connections [**]
+GET    /priorities                      - show priority classes and CPU time per class [**]
+GET    /events[?<params>]               - stream scheduler events (server-sent events) [**]
+
 GET    /dar/state                       - get DAR state [**]
 GET    /dar/start                       - start DAR (new jobs enabled) [**]
 GET    /dar/pause                       - pause DAR (no new jobs) [**]
@@ -61,6 +128,7 @@ GET    /stations/<name>/record?<params> - schedule manual recording
 
 GET    /programs/create?<params>        - create new program
 GET    /programs/reload[?<params>]      - reload programs from config file [**]
+GET    /programs/sync_guides            - import programs from station guides [**]
 GET    /programs/<id>/update?<params>   - update program info
 GET    /programs/<id>/activate          - activate program
 GET    /programs/<id>/inactivate        - inactivate program
@@ -82,13 +150,13 @@ GET    /todos/<id>/delete               - delete todo item (same as ``cancel``??
 def dar_info():
     """Show DAR state/info
     """
-    return jsonify(dar.get_info())
+    return cached_json('dar', dar.get_info)
 
 @app.route('/dar/state')
 def dar_state():
     """Get DAR state
     """
-    return jsonify(state=dar.state)
+    return cached_json('dar/state', lambda: {'state': dar.state})
 
 @app.route('/dar/start')
 def dar_start():
@@ -142,6 +210,124 @@ def programs_reload():
         return "Error: " + str(e), 400
     return jsonify({i: list(j) for i, j in result.items()})
 
+@app.route('/programs/sync_guides')
+def programs_sync_guides():
+    """Import programs from station guides (only changes are applied to the job store)
+    """
+    result = dar.sync_guides()
+    if result is None:
+        return "Program guides not enabled", 404
+    return jsonify({i: list(j) for i, j in result.items()})
+
+#---------#
+# /events #
+#---------#
+
+@app.route('/events')
+def events_stream():
+    """Stream scheduler events (``text/event-stream``); reconnecting clients are caught up
+    from the replay buffer based on the ``Last-Event-ID`` header
+
+    Parameters (default):
+      - last_id (None) - replay events after this ID (0 means entire replay buffer; an ID
+        from before a restart also replays the entire buffer)
+    """
+    last_id = request.headers.get('Last-Event-ID', request.args.get('last_id'))
+    try:
+        last_id = events.bus.parse_id(last_id)
+    except ValueError as e:
+        log.info("Caught ValueError: %s" % (str(e)))
+        return "Error: " + str(e), 400
+    keepalive = cfg.config('server', dar.cfg_profile).get('keepalive', events.KEEPALIVE)
+
+    def generate():
+        for event in events.bus.subscribe(last_id, keepalive):
+            yield events.sse_format(event, events.bus.epoch)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+#-----------#
+# /stations #
+#-----------#
+
+@app.route('/stations/<name>/stream')
+def station_stream(name):
+    """Listen to station through relay (one upstream connection per station, shared by
+    all listeners and any capture in progress)
+    """
+    try:
+        result = dar.relay_stream(name)
+    except KeyError:
+        return "Station \"%s\" not found" % (name), 404
+    except RuntimeError as e:
+        log.info("Caught RuntimeError: %s" % (str(e)))
+        return "Error: " + str(e), 503
+    if result is None:
+        return "Relay not enabled", 404
+    media_type, listener = result
+    return Response(stream_with_context(listener), mimetype=media_type,
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/stations/<name>/record', methods=['POST'])
+def station_record(name):
+    """Start manual recording of station right away (through the warm pool, if enabled)
+
+    Parameters (default):
+      - duration (required): seconds or [HH:]MM:SS
+    """
+    duration = request.args.get('duration')
+    if not duration:
+        return "Error: duration must be specified", 400
+    try:
+        job_id = dar.record_station(name, duration)
+    except KeyError:
+        return "Station \"%s\" not found" % (name), 404
+    except (ConfigError, ValueError) as e:
+        log.info("Caught %s: %s" % (type(e).__name__, str(e)))
+        return "Error: " + str(e), 400
+    return jsonify(job_id=job_id), 202
+
+#--------#
+# /relay #
+#--------#
+
+@app.route('/relay')
+def relay_status():
+    """Show active station relays (null if relay not enabled)
+    """
+    return jsonify(dar.get_relay())
+
+#------------#
+# /warm_pool #
+#------------#
+
+@app.route('/warm_pool')
+def warm_pool_status():
+    """Show warm pool connections (null if warm pool not enabled)
+    """
+    return jsonify(dar.get_warm_pool())
+
+#-------------#
+# /priorities #
+#-------------#
+
+@app.route('/priorities')
+def priorities_status():
+    """Show priority class settings, and CPU secs consumed per class
+    """
+    return jsonify(dar.get_priorities())
+
+#----------#
+# /cluster #
+#----------#
+
+@app.route('/cluster')
+def cluster_status():
+    """Show cluster nodes and open claims (null if not clustered)
+    """
+    return jsonify(dar.get_cluster())
+
 #--------#
 # /todos #
 #--------#
@@ -149,12 +335,51 @@ def programs_reload():
 @app.route('/todos')
 def todos_list():
     """List todo items (state/info)
+
+    Parameters (default):
+      - station (None) - only todo items for station
+    """
+    station = request.args.get('station')
+    if station and station not in dar.stations:
+        # not cached, so that arbitrary query strings do not add snapshots
+        return jsonify(dar.list_todos(station))
+    return cached_json('todos:%s' % (station or ''), lambda: dar.list_todos(station))
+
+@app.route('/todos/<job_id>/runs')
+def todo_runs(job_id):
+    """Get timing spans (with per-stage durations) for recent runs of todo item
+
+    Parameters (default):
+      - history (False) - read from catalog, rather than in-memory ring of recent runs
+      - limit (50) - max number of runs (for history)
+    """
+    try:
+        result = dar.get_runs(job_id, **request.args)
+    except (TypeError, ValueError) as e:
+        log.info("Caught %s: %s" % (type(e).__name__, str(e)))
+        return "Error: " + str(e), 400
+    return jsonify(result)
+
+#-------------#
+# /recordings #
+#-------------#
+
+@app.route('/recordings/<int:rec_id>/peaks')
+def recording_peaks(rec_id):
+    """Get waveform peaks (min/max pairs) for recording
+
+    Parameters (default):
+      - width (2000) - number of peaks wanted (picks coarsest level with at least as many)
+      - level (None) - level number, 0 being the finest (overrides width)
     """
-    todos = []
-    for job in dar.get_jobs():
-        status = TodoState.QUEUED if job.next_run_time else TodoState.SUSPENDED
-        todos.append({'id': job.id, 'status': status, 'info': str(job)})
-    return jsonify(todos)
+    try:
+        result = dar.get_peaks(rec_id, **request.args)
+    except (TypeError, ValueError) as e:
+        log.info("Caught %s: %s" % (type(e).__name__, str(e)))
+        return "Error: " + str(e), 400
+    if result is None:
+        return "Peaks not found for recording %d" % (rec_id), 404
+    return jsonify(result)
 
 #############
 # DAR setup #
@@ -172,23 +397,25 @@ dar = None
 @click.option('--debug',    default=0, help="Debug level (0-3)")
 @click.option('--profile',  default=None, type=str, help="Profile in config.yml")
 @click.option('--public',   is_flag=True, help="Allow external access (outside of localhost)")
-def main(streamer, delay, debug, profile, public):
+@click.option('--port',     default=None, type=int, help="Port to listen on (defaults to server config)")
+@click.option('--node',     default=None, type=str, help="Cluster node name (enables clustering)")
+def main(streamer, delay, debug, profile, public, port, node):
     """Digital Audio Recorder server program (based on Flask)
     """
     if debug > 0:
-        log.setLevel(logging.DEBUG if debug > 1 else logging.INFO)
-        log.addHandler(dbg_hand)
+        debug_logging(logging.DEBUG if debug > 1 else logging.INFO)
     host = '0.0.0.0' if public else None
+    port = port or cfg.config('server', profile).get('port')
 
     global dar
-    dar = Dar(streamer, debug, profile)
+    dar = Dar(streamer, debug, profile, node)
     # defer starting scheduler in case Flask doesn't come up due to port conflict
     # (or whatever)--reduce chance of race between servers for running jobs
     start_timer = threading.Timer(delay, dar.start_scheduler)
     start_timer.start()
 
     try:
-        app.run(host=host)
+        app.run(host=host, port=port)
     except OSError as e:
         # trap known startup failure "[Errno 98] Address already in use"
         if e.errno == 98:
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Schedule simulator - runs the real apscheduler triggers (built by ``schedule_trigger``
+and ``schedule_duration``) against a virtual clock, with a fake streamer, so that days of
+schedule activity can be played out in seconds
+
+The model follows apscheduler (3.x) dispatch semantics: each trigger fire submits the job
+to the executor (skipped if ``max_instances`` is reached), jobs wait for a free worker in
+FIFO order, and a job that starts later than ``misfire_grace_time`` after its fire time is
+missed.  The report covers misfires, overlapping recordings (per station), executor
+saturation, dispatch latency, and job store write load.
+"""
+
+import heapq
+import random
+import datetime as dt
+from collections import deque, defaultdict, Counter
+
+from core import cfg, log
+from utils import LOV
+from dar import schedule_trigger, schedule_duration, DFLT_WORKERS, MISFIRE_GRACE_TIME
+
+SimOutcome = LOV(['COMPLETED',
+                  'FAILED',
+                  'MISSED',
+                  'SKIPPED'],
+                 'lower')
+
+# apscheduler default
+DFLT_MAX_INSTANCES = 1
+
+MAX_EXAMPLES = 10
+
+################
+# FakeStreamer #
+################
+
+class FakeStreamer(object):
+    """Stand-in for a streamer: determines how long a recording job holds an executor
+    worker, without doing anything
+    """
+    def __init__(self, postproc = 0.0, fail_rate = 0.0, seed = None):
+        """
+        :param postproc: secs of post-processing after capture (e.g. dead air analysis)
+        :param fail_rate: probability (0.0-1.0) of capture failing on startup
+        :param seed: random seed (for reproducible runs)
+        """
+        self.postproc  = postproc
+        self.fail_rate = fail_rate
+        self.random    = random.Random(seed)
+
+    def run(self, duration):
+        """
+        :param duration: recording duration (secs)
+        :return: tuple (secs worker is held, bool success)
+        """
+        if self.fail_rate and self.random.random() < self.fail_rate:
+            return 0.0, False
+        return duration + self.postproc, True
+
+#############
+# Simulator #
+#############
+
+class SimJob(object):
+    """Schedule item, as it would be added to the job store
+    """
+    def __init__(self, job_id, station, trigger, duration):
+        self.job_id    = job_id
+        self.station   = station
+        self.trigger   = trigger
+        self.duration  = duration
+        self.instances = 0
+        self.prev_fire = None
+
+class Simulator(object):
+    """Discrete-event simulation of the scheduler, executor and job store
+    """
+    def __init__(self, programs, stations, workers = DFLT_WORKERS,
+                 max_instances = DFLT_MAX_INSTANCES, grace_time = MISFIRE_GRACE_TIME,
+                 dispatch_delay = 0.0, streamer = None):
+        """
+        :param programs: program definitions (``programs`` config format)
+        :param stations: station definitions (``stations`` config format)
+        :param workers: executor size
+        :param max_instances: max concurrent instances per job
+        :param grace_time: misfire grace time (secs)
+        :param dispatch_delay: secs from trigger fire to executor submission
+        :param streamer: FakeStreamer (defaults to no post-processing, no failures)
+        """
+        self.workers        = workers
+        self.max_instances  = max_instances
+        self.grace_time     = grace_time
+        self.dispatch_delay = dispatch_delay
+        self.streamer       = streamer or FakeStreamer()
+        self.jobs           = []
+        for label, info in programs.items():
+            if info['station'] not in stations:
+                raise RuntimeError("Unknown station \"%s\" for program \"%s\"" %
+                                   (info['station'], label))
+            self.jobs.append(SimJob(label, info['station'],
+                                    schedule_trigger(info['schedule']),
+                                    schedule_duration(info['schedule'])))
+
+    def next_fire(self, job, now):
+        """
+        :param job: SimJob
+        :param now: virtual time (aware datetime)
+        :return: next fire time (aware datetime), or None
+        """
+        fire = job.trigger.get_next_fire_time(job.prev_fire, now)
+        job.prev_fire = fire
+        return fire
+
+    def run(self, start = None, days = 7):
+        """Play out schedule between ``start`` and ``start + days``
+
+        :param start: aware datetime (defaults to now)
+        :param days: number of days to simulate
+        :return: report (dict), see ``report()``
+        """
+        start = start or dt.datetime.now().astimezone()
+        t0    = start.timestamp()
+        t_end = t0 + days * 86400
+
+        # event queue: (time, seq, kind, payload); ``seq`` keeps ordering stable among
+        # simultaneous events (and avoids comparing payloads)
+        queue = []
+        seq = 0
+        def push(when, kind, payload):
+            nonlocal seq
+            heapq.heappush(queue, (when, seq, kind, payload))
+            seq += 1
+
+        for job in self.jobs:
+            job.instances = 0
+            job.prev_fire = None
+            if job.trigger is None:
+                # immediate schedule: runs once, at start
+                push(t0, 'fire', (job, t0))
+                continue
+            fire = self.next_fire(job, start)
+            if fire:
+                push(fire.timestamp(), 'fire', (job, fire.timestamp()))
+
+        self.stats    = Counter()
+        self.runs     = []      # (job_id, station, fire, start, end, outcome)
+        self.missed   = []
+        self.skipped  = []
+        self.pending  = deque() # FIFO of (job, fire) awaiting a worker
+        self.busy     = 0
+        self.peak     = 0
+        self.peak_q   = 0
+        self.full_secs = 0.0
+        self.busy_secs = 0.0
+        self.writes   = Counter()  # job store writes per minute
+        self.fires    = Counter()  # trigger fires per minute
+        self.active   = defaultdict(list)  # {station: [(job_id, end)]}
+        self.overlaps = Counter()  # overlapping recordings, per station
+        self.overlap_examples = []
+        self.latencies = []     # secs from trigger fire to job start
+        last = t0
+
+        while queue and queue[0][0] <= t_end:
+            now, _, kind, payload = heapq.heappop(queue)
+            self.busy_secs += self.busy * (now - last)
+            if self.busy >= self.workers:
+                self.full_secs += now - last
+            last = now
+
+            if kind == 'fire':
+                job, fire = payload
+                minute = int((now - t0) // 60)
+                self.fires[minute] += 1
+                self.stats['fires'] += 1
+                # job store update (next run time), or removal for one-shot triggers
+                self.writes[minute] += 1
+                if job.trigger is not None:
+                    nxt = self.next_fire(job, dt.datetime.fromtimestamp(now, start.tzinfo))
+                    if nxt:
+                        push(nxt.timestamp(), 'fire', (job, nxt.timestamp()))
+                push(now + self.dispatch_delay, 'submit', (job, fire))
+            elif kind == 'submit':
+                job, fire = payload
+                if job.instances >= self.max_instances:
+                    self.stats['skipped'] += 1
+                    self.skipped.append((job.job_id, fire))
+                    continue
+                job.instances += 1
+                self.pending.append((job, fire))
+                self.peak_q = max(self.peak_q, len(self.pending) - (self.workers - self.busy))
+            elif kind == 'done':
+                job, fire, started, outcome = payload
+                job.instances -= 1
+                self.busy -= 1
+                self.active[job.station] = [(j, e) for j, e in self.active[job.station]
+                                            if j != job.job_id or e != now]
+                self.runs.append((job.job_id, job.station, fire, started, now, outcome))
+                self.stats[outcome] += 1
+
+            # hand pending jobs to free workers (misfire check happens at execution time)
+            while self.pending and self.busy < self.workers:
+                job, fire = self.pending.popleft()
+                if now - fire > self.grace_time:
+                    job.instances -= 1
+                    self.stats[SimOutcome.MISSED] += 1
+                    self.missed.append((job.job_id, fire, now - fire))
+                    continue
+                held, success = self.streamer.run(job.duration)
+                self.busy += 1
+                self.peak = max(self.peak, self.busy)
+                end = now + held
+                outcome = SimOutcome.COMPLETED if success else SimOutcome.FAILED
+                if success:
+                    for other, other_end in self.active[job.station]:
+                        self.overlaps[job.station] += 1
+                        if len(self.overlap_examples) < MAX_EXAMPLES:
+                            self.overlap_examples.append((job.station, other, job.job_id,
+                                                          now, min(end, other_end) - now))
+                    self.active[job.station].append((job.job_id, end))
+                push(end, 'done', (job, fire, now, outcome))
+                self.latencies.append(now - fire)
+
+        self.busy_secs += self.busy * (t_end - last)
+        if self.busy >= self.workers:
+            self.full_secs += t_end - last
+        self.elapsed = t_end - t0
+        log.info("Simulated %d jobs for %s days: %d fires, %d missed, %d skipped" %
+                 (len(self.jobs), days, self.stats['fires'], self.stats[SimOutcome.MISSED],
+                  self.stats['skipped']))
+        return self.report()
+
+    def report(self):
+        """
+        :return: dict with simulation results
+        """
+        lat = sorted(self.latencies)
+        def pct(p):
+            return round(lat[min(int(len(lat) * p), len(lat) - 1)], 3) if lat else None
+
+        missed_by_job = Counter(job_id for job_id, _, _ in self.missed)
+        fmt = lambda when: dt.datetime.fromtimestamp(when).isoformat(' ', 'seconds')
+        return {'jobs'     : len(self.jobs),
+                'days'     : round(self.elapsed / 86400, 3),
+                'fires'    : self.stats['fires'],
+                'completed': self.stats[SimOutcome.COMPLETED],
+                'failed'   : self.stats[SimOutcome.FAILED],
+                'misfires' : {'missed'  : self.stats[SimOutcome.MISSED],
+                              'skipped' : self.stats['skipped'],
+                              'by_job'  : dict(missed_by_job.most_common(MAX_EXAMPLES)),
+                              'examples': [{'job_id': job_id, 'fire': fmt(fire),
+                                            'late': round(late, 3)}
+                                           for job_id, fire, late in self.missed[:MAX_EXAMPLES]]},
+                'overlaps' : {'count'     : sum(self.overlaps.values()),
+                              'by_station': dict(self.overlaps.most_common(MAX_EXAMPLES)),
+                              'examples'  : [{'station': station, 'jobs': [a, b],
+                                              'start': fmt(when), 'secs': round(secs)}
+                                             for station, a, b, when, secs
+                                             in self.overlap_examples]},
+                'executor' : {'workers'    : self.workers,
+                              'peak_busy'  : self.peak,
+                              'peak_queued': self.peak_q,
+                              'utilization': round(self.busy_secs /
+                                                   (self.workers * self.elapsed), 4)
+                                             if self.elapsed else None,
+                              'saturated_secs': round(self.full_secs)},
+                'latency'  : {'p50': pct(0.50), 'p95': pct(0.95), 'p99': pct(0.99),
+                              'max': round(lat[-1], 3) if lat else None},
+                'jobstore' : {'writes'          : sum(self.writes.values()),
+                              'peak_writes_min' : max(self.writes.values(), default=0),
+                              'peak_fires_min'  : max(self.fires.values(), default=0)}}
+
+#######################
+# synthetic schedules #
+#######################
+
+DAYS_CHOICES = ['Mon-Sun', 'Mon-Fri', 'Sat-Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+def synthesize_programs(num, stations, seed = None):
+    """Generate random weekly programs (for sizing the executor and job store)
+
+    :param num: number of programs
+    :param stations: station names (list)
+    :param seed: random seed
+    :return: dict (``programs`` config format)
+    """
+    rand = random.Random(seed)
+    programs = {}
+    for i in range(num):
+        # programs mostly start on the hour or half hour, as in real schedules
+        start = dt.time(rand.randrange(24), rand.choice([0, 0, 0, 30, 15, 45]))
+        programs["Synthetic Program %05d" % (i)] = {
+            'station' : rand.choice(stations),
+            'schedule': {'type'      : 'weekly',
+                         'days'      : rand.choice(DAYS_CHOICES),
+                         'start_time': start.strftime('%H:%M:%S'),
+                         'duration'  : str(rand.choice([30, 60, 60, 120, 180]) * 60)}}
+    return programs
+
+#####################
+# command line tool #
+#####################
+
+import json
+import click
+
+@click.command()
+@click.option('--days',      default=7, help="Number of days to simulate (defaults to 7)")
+@click.option('--start',     default=None, type=str, help="Start date/time (ISO format, defaults to now)")
+@click.option('--workers',   default=None, type=int, help="Executor size (defaults to scheduler config)")
+@click.option('--grace',     default=MISFIRE_GRACE_TIME, help="Misfire grace time (secs)")
+@click.option('--postproc',  default=0.0, help="Post-processing secs per recording")
+@click.option('--fail_rate', default=0.0, help="Probability of capture failure")
+@click.option('--synthetic', default=0, help="Number of synthetic programs (instead of config)")
+@click.option('--seed',      default=None, type=int, help="Random seed")
+@click.option('--profile',   default=None, type=str, help="Profile in config.yml")
+def main(days, start, workers, grace, postproc, fail_rate, synthetic, seed, profile):
+    """Simulate schedule for programs in config (or synthetic programs), and print report
+    """
+    stations = cfg.config('stations', profile)
+    if synthetic:
+        programs = synthesize_programs(synthetic, list(stations), seed)
+    else:
+        programs = cfg.config('programs', profile)
+    if workers is None:
+        workers = cfg.config('scheduler', profile).get('workers', DFLT_WORKERS)
+    start_dt = dt.datetime.fromisoformat(start).astimezone() if start else None
+
+    sim = Simulator(programs, stations, workers=workers, grace_time=grace,
+                    streamer=FakeStreamer(postproc, fail_rate, seed))
+    print(json.dumps(sim.run(start_dt, days), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+"""Timing spans - per-run timeline of the recording hot path
+
+Each run of a recording job produces a span record, with timestamps ("marks") for each
+stage reached: trigger fire (scheduled run time), executor dispatch (job function entered),
+``Streamer.get``, process spawn, first byte, last byte, process exit, and end of
+post-processing.  Completed spans are kept in a bounded in-memory ring, and written to the
+catalog (if set up).
+"""
+
+import time
+import uuid
+import threading
+from collections import deque
+
+from core import log
+from utils import LOV
+import catalog
+
+Stage = LOV(['TRIGGER',
+             'DISPATCH',
+             'STREAMER_GET',
+             'SPAWN',
+             'FIRST_BYTE',
+             'LAST_BYTE',
+             'EXIT',
+             'POSTPROC'],
+            'lower')
+
+# stages in timeline order (for computing per-stage durations)
+STAGE_ORDER = [Stage.TRIGGER,
+               Stage.DISPATCH,
+               Stage.STREAMER_GET,
+               Stage.SPAWN,
+               Stage.FIRST_BYTE,
+               Stage.LAST_BYTE,
+               Stage.EXIT,
+               Stage.POSTPROC]
+
+# stages for which the latest mark wins (e.g. across restarted captures)
+LATEST_STAGES = {Stage.LAST_BYTE, Stage.EXIT, Stage.POSTPROC}
+
+RunStatus = LOV(['RUNNING',
+                 'COMPLETED',
+                 'SKIPPED',
+                 'FAILED'],
+                'lower')
+
+RING_SIZE = 1000
+
+# max secs between trigger fire and dispatch, for attributing a fire time to a run
+MAX_DISPATCH_DELAY = 3600
+
+########
+# Span #
+########
+
+class Span(object):
+    """Timeline for a single job run
+    """
+    def __init__(self, job_id, station = None):
+        """
+        :param job_id: scheduler job ID
+        :param station: station name
+        """
+        self.run_id  = uuid.uuid4().hex
+        self.job_id  = job_id
+        self.station = station
+        self.marks   = {Stage.DISPATCH: time.time()}
+        self.status  = RunStatus.RUNNING
+        self.path    = None
+        self.ended   = None
+
+    def mark(self, stage, when = None):
+        """Record time at which stage was reached (first mark for a stage wins, except for
+        ``LATEST_STAGES``)
+
+        :param stage: ``Stage`` value
+        :param when: [optional] epoch time (defaults to now)
+        """
+        if stage in self.marks and stage not in LATEST_STAGES:
+            return
+        self.marks[stage] = when or time.time()
+
+    def durations(self):
+        """
+        :return: dict of secs between consecutive stages reached, keyed by "<from>-><to>"
+        """
+        reached = [stage for stage in STAGE_ORDER if stage in self.marks]
+        return {"%s->%s" % (a, b): round(self.marks[b] - self.marks[a], 3)
+                for a, b in zip(reached, reached[1:])}
+
+    def as_dict(self):
+        """
+        :return: dict (JSON-serializable)
+        """
+        return {'run_id'   : self.run_id,
+                'job_id'   : self.job_id,
+                'station'  : self.station,
+                'status'   : self.status,
+                'path'     : self.path,
+                'ended'    : self.ended,
+                'marks'    : dict(self.marks),
+                'durations': self.durations()}
+
+################
+# SpanRecorder #
+################
+
+class SpanRecorder(object):
+    """Bookkeeping for spans across threads (trigger fire times are reported by the
+    scheduler thread, everything else by the job's executor thread)
+    """
+    def __init__(self, ring_size = RING_SIZE):
+        """
+        :param ring_size: number of completed spans to keep in memory
+        """
+        self.ring       = deque(maxlen=ring_size)
+        self.fired      = {}  # {job_id: fire_time}
+        self.lock       = threading.Lock()
+        self.local      = threading.local()
+
+    def fire(self, job_id, fire_time):
+        """Note trigger fired for job (called from scheduler listener)
+
+        :param job_id: scheduler job ID
+        :param fire_time: scheduled run time (epoch)
+        """
+        with self.lock:
+            self.fired[job_id] = fire_time
+
+    def begin(self, job_id, station = None):
+        """Start span for job run in the current thread
+
+        :return: Span
+        """
+        span = Span(job_id, station)
+        self.local.span = span
+        return span
+
+    def current(self):
+        """
+        :return: Span for current thread (or None)
+        """
+        return getattr(self.local, 'span', None)
+
+    def finish(self, span, status, path = None):
+        """Complete span and record it in ring (and catalog)
+
+        :param span: Span returned by ``begin()``
+        :param status: ``RunStatus`` value
+        :param path: [optional] pathname of recording
+        """
+        self.local.span = None
+        with self.lock:
+            fire_time = self.fired.pop(span.job_id, None)
+        # only attribute fire time belonging to this run
+        delay = span.marks[Stage.DISPATCH] - fire_time if fire_time else None
+        if delay is not None and 0 <= delay <= MAX_DISPATCH_DELAY:
+            span.mark(Stage.TRIGGER, fire_time)
+        span.status = status
+        span.path   = path
+        span.ended  = time.time()
+        run = span.as_dict()
+        with self.lock:
+            self.ring.append(run)
+        if catalog.catalog:
+            try:
+                catalog.catalog.add_run(run)
+            except Exception as e:
+                log.error("Could not write run to catalog: %s" % (e))
+        log.debug("Run timeline: %s" % (run))
+
+    def get_runs(self, job_id):
+        """
+        :param job_id: scheduler job ID
+        :return: list of run records (dicts) in ring, most recent first
+        """
+        with self.lock:
+            return [run for run in reversed(self.ring) if run['job_id'] == job_id]
+
+# recorder for the current process
+recorder = SpanRecorder()
+
+def mark(stage, when = None):
+    """Record stage for the span of the current thread (no-op if there is none)
+
+    :param stage: ``Stage`` value
+    :param when: [optional] epoch time (defaults to now)
+    """
+    span = recorder.current()
+    if span:
+        span.mark(stage, when)
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+"""Staging directory - captures are written to a fast local directory, and published into
+``rec_dir`` (which may be slow, network or USB-backed storage) when complete
+
+Recordings are published under the same station subdirectory in ``rec_dir``, by atomic
+rename if the staging directory is on the same filesystem, otherwise by copying to a
+temporary file in the destination directory and renaming it into place.  Either way, a
+recording only ever appears in ``rec_dir`` complete.  Publishing is made durable with
+fsync; recordings tend to end together (top of the hour), so concurrent publishes are
+committed as a group, with one fsync per file and one per directory for the whole group.
+
+Free space is checked before a capture starts: if the staging directory cannot hold the
+expected size of the recording (plus ``min_free``), the capture is written directly to
+``rec_dir`` instead.
+"""
+
+import os
+import time
+import errno
+import shutil
+import threading
+
+from core import BASE_DIR, cfg, log
+from utils import truthy
+from inflight import STDERR_SUFFIX
+from checksum import read_hash, write_hash
+
+##########
+# config #
+##########
+
+STAGING_DFLTS = {'enabled'    : False,
+                 'staging_dir': None,
+                 'min_free'   : 512,    # MB (to be left free after recording)
+                 'sync_delay' : 0.5}    # secs (wait for other publishes to join fsync group)
+
+TMP_SUFFIX = '.publishing'
+
+# sidecar files moved along with a recording
+SIDECAR_SUFFIXES = ['.idx', '.sha256']
+
+# assumed stream bitrate (bits/sec), if not known
+DFLT_BITRATE = 320000
+
+def staging_params(cfg_profile = None):
+    """Get staging parameters (config overlaid on defaults)
+
+    :param cfg_profile: optional (None means ``default``)
+    :return: dict
+    """
+    params = dict(STAGING_DFLTS)
+    params.update(cfg.config('staging', cfg_profile))
+    return params
+
+def staging_path(cfg_profile = None):
+    """
+    :param cfg_profile: optional (None means ``default``)
+    :return: pathname of staging directory (or None, if staging not enabled)
+    """
+    params = staging_params(cfg_profile)
+    staging_dir = params['staging_dir']
+    if not truthy(params['enabled']) or not staging_dir:
+        return None
+    if staging_dir[0] in ('/.'):
+        return staging_dir
+    return os.path.join(BASE_DIR, staging_dir)
+
+##############
+# free space #
+##############
+
+def free_bytes(path):
+    """
+    :param path: pathname on filesystem
+    :return: bytes available to unprivileged users
+    """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+def has_space(path, needed, min_free = STAGING_DFLTS['min_free']):
+    """
+    :param path: directory
+    :param needed: bytes to be written
+    :param min_free: MB to be left free
+    :return: bool
+    """
+    return free_bytes(path) >= needed + min_free * 1024 * 1024
+
+def stage_filebase(filebase, duration, bps = None, cfg_profile = None):
+    """Map filebase for recording (in ``rec_dir``) to the staging directory, if enabled and
+    there is enough free space for the capture
+
+    :param filebase: file or path name [minus file type], in ``rec_dir``
+    :param duration: secs
+    :param bps: expected bytes/sec for stream (or None, if not known)
+    :param cfg_profile: optional (None means ``default``)
+    :return: filebase to capture to
+    """
+    staging = staging_path(cfg_profile)
+    params = staging_params(cfg_profile)
+    needed = duration * (bps or DFLT_BITRATE / 8)
+    dest_dir = os.path.dirname(filebase) or '.'
+    try:
+        if not has_space(dest_dir, needed, 0):
+            log.error("Not enough space in \"%s\" for recording (%d MB)" %
+                      (dest_dir, needed // 1024 // 1024))
+    except OSError as e:
+        log.error("Could not check free space in \"%s\": %s" % (dest_dir, e))
+    if not staging:
+        return filebase
+    stage_dir = os.path.join(staging, os.path.basename(os.path.abspath(dest_dir)))
+    try:
+        os.makedirs(stage_dir, exist_ok=True)
+        if not has_space(stage_dir, needed, params['min_free']):
+            log.notice("Not enough space in staging directory, capturing to \"%s\"" % (dest_dir))
+            return filebase
+    except OSError as e:
+        log.notice("Staging directory not usable (%s), capturing to \"%s\"" % (e, dest_dir))
+        return filebase
+    return os.path.join(stage_dir, os.path.basename(filebase))
+
+def is_staged(path, cfg_profile = None):
+    """
+    :param path: pathname of recording
+    :param cfg_profile: optional (None means ``default``)
+    :return: bool
+    """
+    staging = staging_path(cfg_profile)
+    if not staging:
+        return False
+    return os.path.dirname(os.path.dirname(os.path.abspath(path))) == os.path.abspath(staging)
+
+def staged_files(cfg_profile = None):
+    """
+    :param cfg_profile: optional (None means ``default``)
+    :return: list of pathnames of recordings in staging directory (excluding sidecar and
+             temporary files)
+    """
+    staging = staging_path(cfg_profile)
+    if not staging or not os.path.isdir(staging):
+        return []
+    skip = tuple(SIDECAR_SUFFIXES + [TMP_SUFFIX, STDERR_SUFFIX])
+    paths = []
+    for entry in os.scandir(staging):
+        if not entry.is_dir():
+            continue
+        for file in os.scandir(entry.path):
+            if file.is_file() and not file.name.endswith(skip):
+                paths.append(file.path)
+    return sorted(paths)
+
+#############
+# SyncGroup #
+#############
+
+def rename_noreplace(src, dest):
+    """Rename ``src`` to ``dest``, failing (rather than overwriting) if ``dest`` exists
+
+    :param src: pathname
+    :param dest: pathname (same filesystem)
+    :raises FileExistsError: if ``dest`` exists
+    """
+    try:
+        os.link(src, dest)
+    except FileExistsError:
+        raise
+    except OSError:
+        # no hard links on this filesystem (not atomic against concurrent publishers)
+        if os.path.exists(dest):
+            raise FileExistsError(errno.EEXIST, "File exists", dest)
+        os.replace(src, dest)
+        return
+    os.unlink(src)
+
+class SyncGroup(object):
+    """Group commit for publishing: the first caller waits ``delay`` secs for others to join,
+    then fsyncs all files, renames them into place, and fsyncs each destination directory
+    once, on behalf of the whole group
+    """
+    def __init__(self, delay = STAGING_DFLTS['sync_delay']):
+        self.delay   = delay
+        self.cond    = threading.Condition()
+        self.pending = []     # list of (tmp_path, dest_path, result)
+        self.leader  = False
+
+    def commit(self, tmp_path, dest_path):
+        """Rename ``tmp_path`` to ``dest_path`` durably
+
+        :param tmp_path: pathname of complete file (not yet synced)
+        :param dest_path: final pathname
+        """
+        result = {}
+        with self.cond:
+            self.pending.append((tmp_path, dest_path, result))
+            if self.leader:
+                while not result:
+                    self.cond.wait()
+                if result.get('error'):
+                    raise result['error']
+                return
+            self.leader = True
+        time.sleep(self.delay)
+        with self.cond:
+            batch, self.pending = self.pending, []
+            self.leader = False
+        self.flush(batch)
+        with self.cond:
+            self.cond.notify_all()
+        if result.get('error'):
+            raise result['error']
+
+    def flush(self, batch):
+        """
+        :param batch: list of (tmp_path, dest_path, result)
+        """
+        dirs = set()
+        for tmp_path, dest_path, result in batch:
+            try:
+                fd = os.open(tmp_path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                rename_noreplace(tmp_path, dest_path)
+                dirs.add(os.path.dirname(dest_path) or '.')
+                dirs.add(os.path.dirname(tmp_path) or '.')
+            except OSError as e:
+                result['error'] = e
+        for dir_path in dirs:
+            try:
+                fd = os.open(dir_path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                log.info("Could not sync directory \"%s\": %s" % (dir_path, e))
+        for _, _, result in batch:
+            result.setdefault('done', True)
+        log.debug("Published %d file(s), synced %d dir(s)" % (len(batch), len(dirs)))
+
+sync_group = SyncGroup()
+
+##############
+# publishing #
+##############
+
+MAX_UNIQUE = 100   # suffixes tried for a name collision in ``rec_dir``
+
+def unique_dest(dest):
+    """
+    :param dest: pathname in ``rec_dir``
+    :return: ``dest``, or with a numeric suffix (``<name>-<n>.<ext>``), if a recording (or
+             sidecar file) of that name already exists
+    """
+    base, ext = os.path.splitext(dest)
+    for n in range(MAX_UNIQUE):
+        path = "%s-%d%s" % (base, n, ext) if n else dest
+        if not any(os.path.exists(path + suffix) for suffix in [''] + SIDECAR_SUFFIXES):
+            return path
+    raise RuntimeError("no unique name for \"%s\"" % (dest))
+
+def publish_file(src, dest):
+    """
+    :param src: pathname in staging directory
+    :param dest: pathname in ``rec_dir``
+    """
+    if os.stat(src).st_dev == os.stat(os.path.dirname(dest) or '.').st_dev:
+        sync_group.commit(src, dest)
+        return
+    tmp_path = dest + TMP_SUFFIX
+    try:
+        shutil.copyfile(src, tmp_path)
+        sync_group.commit(tmp_path, dest)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.remove(src)
+
+def publish(path, dest_dir, cfg_profile = None):
+    """Publish staged recording (and sidecar files) into ``rec_dir``; if publishing fails,
+    the recording is left in the staging directory
+
+    :param path: pathname of recording (no-op if not in staging directory)
+    :param dest_dir: station directory in ``rec_dir``
+    :param cfg_profile: optional (None means ``default``)
+    :return: pathname of published recording (or ``path``, if not published)
+    """
+    if not path or not is_staged(path, cfg_profile) or not os.path.exists(path):
+        return path
+    params = staging_params(cfg_profile)
+    sync_group.delay = params['sync_delay']
+    try:
+        if os.stat(path).st_dev != os.stat(dest_dir).st_dev:
+            if not has_space(dest_dir, os.path.getsize(path), 0):
+                raise RuntimeError("not enough space in \"%s\"" % (dest_dir))
+        # never overwrite an existing recording (e.g. a rerun or late join within the same
+        # minute, since timestamped names only go down to the minute)
+        while True:
+            dest = unique_dest(os.path.join(dest_dir, os.path.basename(path)))
+            try:
+                publish_file(path, dest)
+                break
+            except FileExistsError:
+                continue  # taken by a concurrent publish
+    except (OSError, RuntimeError) as e:
+        log.error("Could not publish \"%s\" (left in staging directory): %s" % (path, e))
+        return path
+    for suffix in SIDECAR_SUFFIXES:
+        if os.path.exists(path + suffix):
+            try:
+                publish_file(path + suffix, dest + suffix)
+            except OSError as e:
+                log.info("Could not publish \"%s\": %s" % (path + suffix, e))
+    if os.path.basename(dest) != os.path.basename(path) and read_hash(dest):
+        # hash sidecar names the recording (``sha256sum`` format)
+        write_hash(dest, read_hash(dest))
+    log.info("Published \"%s\" to \"%s\"" % (path, dest))
+    return dest
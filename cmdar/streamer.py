@@ -4,14 +4,44 @@
 """Streamer/media player
 """
 
+import os
 import sys
 import re
+import time
 import logging
 import subprocess
 import datetime as dt
 
 from core import cfg, log
-from utils import LOV, str2time_dt
+from utils import LOV, str2time_dt, str2timedelta
+from monitor import Capture, StallAction, get_monitor
+from seekindex import get_indexer
+from checksum import get_hasher
+from spans import Stage, mark
+import spans
+from inflight import STDERR_SUFFIX
+import inflight
+import warmpool
+from priority import PriorityClass
+import priority
+
+##############
+# exceptions #
+##############
+
+class StreamStalled(RuntimeError):
+    """Capture process terminated by the capture monitor (see ``monitor.py``)
+    """
+    def __init__(self, path, action, level):
+        """
+        :param path: pathname of (partial) output file
+        :param action: ``StallAction`` that terminated the capture
+        :param level: escalation level reached (pass to restarted capture)
+        """
+        super().__init__("Stream stalled, action: %s" % (action))
+        self.path   = path
+        self.action = action
+        self.level  = level
 
 ##############
 # base class #
@@ -50,6 +80,16 @@ class Streamer(object):
         """
         raise NotImplementedError("abstract method")
 
+    @classmethod
+    def expected_bps(cls, media_type, bitrate = None):
+        """
+        :param media_type: stream content-type (str)
+        :param bitrate: [optional] bits/sec for stream (overrides media type config)
+        :return: expected throughput in bytes/sec (or None, if not known)
+        """
+        bitrate = bitrate or cls.info['media_types'][media_type].get('bitrate')
+        return bitrate / 8 if bitrate else None
+
 ################
 # subclass(es) #
 ################
@@ -68,7 +108,8 @@ class VlcStreamer(Streamer):
     """
     @classmethod
     def save_stream(cls, url, media_type, filebase, duration, add_ts = False, force = False,
-                    verbose = False, dryrun = False):
+                    verbose = False, dryrun = False, bitrate = None, stall_level = 0,
+                    cfg_profile = None):
         """
         :param url: stream URL (str)
         :param media_type: stream content-type (str)
@@ -78,6 +119,9 @@ class VlcStreamer(Streamer):
         :param force: whether to overwrite existing file (bool)
         :param verbose: level (0-3) or False|True (same as 0|1)
         :param dryrun: build command, but do not execute (bool)
+        :param bitrate: [optional] bits/sec for stream, for stall detection
+        :param stall_level: escalation level to start at (see ``StreamStalled``)
+        :param cfg_profile: optional (None means ``default``), for capture monitor config
         :return: pathname of saved stream (or command line, if dryrun=True)
         """
         if not hasattr(cls, 'name') or not hasattr(cls, 'info'):
@@ -111,11 +155,76 @@ class VlcStreamer(Streamer):
             return ' '.join(args)
 
         log.info("Saving stream, cmd = '%s'" % (' '.join(args)))
-        cp = subprocess.run(args, check=True, text=True, capture_output=True)
+        # run capture in its own session, with stderr to a file (rather than a pipe), so
+        # that it survives a server restart (see ``inflight.py``)
+        with open(fileout + STDERR_SUFFIX, 'w') as stderr_file:
+            proc = priority.spawn(args, PriorityClass.CAPTURE, stdout=subprocess.DEVNULL,
+                                  stderr=stderr_file, text=True, start_new_session=True)
+        mark(Stage.SPAWN)
+        if inflight.registry:
+            span = spans.recorder.current()
+            inflight.registry.add(proc, fileout, duration, span and span.job_id,
+                                  span and span.station, url, media_type)
+        try:
+            cls.wait_capture(proc, fileout, media_type, bitrate, stall_level, cfg_profile)
+        finally:
+            if inflight.registry:
+                inflight.registry.remove(fileout)
+        return fileout
+
+    @classmethod
+    def wait_capture(cls, proc, fileout, media_type, bitrate = None, stall_level = 0,
+                     cfg_profile = None):
+        """Wait for capture process to complete (with stall monitoring and seek indexing),
+        and check for errors; also used for captures reattached after a restart
+
+        :param proc: subprocess.Popen (or ``inflight.ReattachedProcess``)
+        :param fileout: pathname of output file
+        :param media_type: stream content-type (str)
+        :param bitrate: [optional] bits/sec for stream, for stall detection
+        :param stall_level: escalation level to start at (see ``StreamStalled``)
+        :param cfg_profile: optional (None means ``default``)
+        """
+        monitor = get_monitor(cfg_profile)
+        expected = cls.expected_bps(media_type, bitrate)
+        indexer = get_indexer(fileout, cfg_profile)
+        hasher = get_hasher(fileout, cfg_profile)
+        capture = None
+        if monitor and expected:
+            capture = Capture(proc, fileout, expected, stall_level, indexer, hasher)
+            monitor.add(capture)
+        try:
+            priority.wait(proc, PriorityClass.CAPTURE)
+        finally:
+            if capture:
+                monitor.remove(capture)
+            if indexer:
+                try:
+                    indexer.close()
+                except Exception as e:
+                    log.info("Could not complete seek index for \"%s\": %s" % (fileout, e))
+            if hasher:
+                try:
+                    hasher.close()
+                except Exception as e:
+                    log.info("Could not complete hash for \"%s\": %s" % (fileout, e))
+        mark(Stage.EXIT)
+        if capture:
+            mark(Stage.FIRST_BYTE, capture.first_byte)
+            mark(Stage.LAST_BYTE, capture.last_byte)
+        stderr = ''
+        if os.path.exists(fileout + STDERR_SUFFIX):
+            with open(fileout + STDERR_SUFFIX) as f:
+                stderr = f.read()
+            os.remove(fileout + STDERR_SUFFIX)
+        if capture and capture.action:
+            raise StreamStalled(fileout, capture.action, capture.level)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=stderr)
         # VLC does not have non-zero returncode on error, have to grep through stderr
         ignore = set(cls.info.get('ignore_errors', []))
         errors = []
-        for line in cp.stderr.splitlines():
+        for line in stderr.splitlines():
             m = re.fullmatch(r'(\[[0-9a-f]+\]) ([\w ]+) error: (.+)', line)
             if m:
                 error_msg = m.group(3)
@@ -125,8 +234,115 @@ class VlcStreamer(Streamer):
                     errors.append(error_msg)
         if errors:
             log.info("Errors: %s" % (errors))
-            log.debug("Full stderr:\n" + cp.stderr.rstrip())
+            log.debug("Full stderr:\n" + stderr.rstrip())
             raise RuntimeError(errors[0])
+
+class RelayStreamer(Streamer):
+    """In-process capture from a relay pump (see ``warmpool.py``), for manual recordings;
+    no capture process is started, so captures are not registered as in-flight (and do not
+    survive a server restart)
+    """
+    @classmethod
+    def save_stream(cls, url, media_type, filebase, duration, add_ts = False, verbose = False,
+                    dryrun = False, bitrate = None, stall_level = 0, cfg_profile = None,
+                    **kwargs):
+        """
+        :param url: stream URL (str), not used (station is taken from the current span)
+        :param media_type: stream content-type (str)
+        :param filebase: file or path name [minus file type] (str)
+        :param duration: seconds (int) or [HH:]MM:SS (str)
+        :param add_ts: whether to add timestamp to filebase (bool)
+        :param dryrun: build output pathname, but do not record (bool)
+        :param stall_level: escalation level to start at (see ``StreamStalled``)
+        :param cfg_profile: optional (None means ``default``)
+        :return: pathname of saved stream
+        """
+        if not hasattr(cls, 'name') or not hasattr(cls, 'info'):
+            raise RuntimeError("%s must be obtained through Streamer.get()" % (cls.__name__))
+        if media_type not in cls.info['media_types']:
+            raise RuntimeError("media type \"%s\" not defined for streamer \"%s\"" % (media_type, cls.name))
+        media_info = cls.info['media_types'][media_type]
+        if add_ts:
+            filebase += dt.datetime.now().strftime('%m%d%H%M')
+        fileout = filebase + '.' + media_info['file_type']
+        if isinstance(duration, str):
+            duration = str2timedelta(duration).seconds
+        if dryrun:
+            return fileout
+
+        span = spans.recorder.current()
+        if not warmpool.pool or not span or not span.station:
+            raise RuntimeError("Warm pool not available for streamer \"%s\"" % (cls.name))
+        end_time = time.time() + duration
+        _, listener = warmpool.pool.listen(span.station)
+        mark(Stage.SPAWN)
+        log.info("Saving stream for \"%s\" from relay to \"%s\"" % (span.station, fileout))
+        indexer = get_indexer(fileout, cfg_profile)
+        hasher = get_hasher(fileout, cfg_profile)
+        next_feed = time.time() + 1.0
+        complete = False
+        try:
+            with open(fileout, 'wb') as f:
+                for chunk in listener:
+                    f.write(chunk)
+                    mark(Stage.FIRST_BYTE)
+                    mark(Stage.LAST_BYTE)
+                    now = time.time()
+                    if now >= end_time:
+                        complete = True
+                        break
+                    if now >= next_feed:
+                        f.flush()
+                        if indexer:
+                            indexer.feed()
+                        if hasher:
+                            hasher.feed()
+                        next_feed = now + 1.0
+        finally:
+            listener.close()
+            for name, sidecar in (('seek index', indexer), ('hash', hasher)):
+                if sidecar:
+                    try:
+                        sidecar.close()
+                    except Exception as e:
+                        log.info("Could not complete %s for \"%s\": %s" % (name, fileout, e))
+            mark(Stage.EXIT)
+        if not complete:
+            # relay stopped, or listener evicted
+            raise StreamStalled(fileout, StallAction.RESTART, stall_level + 1)
+        return fileout
+
+class NullStreamer(Streamer):
+    """Stand-in streamer for test harnesses (e.g. ``loadtest.py``): writes an empty output
+    file and waits out the duration, without starting a capture process
+    """
+    @classmethod
+    def save_stream(cls, url, media_type, filebase, duration, add_ts = False, verbose = False,
+                    dryrun = False, cfg_profile = None, **kwargs):
+        """
+        :param url: stream URL (str), not used
+        :param media_type: stream content-type (str)
+        :param filebase: file or path name [minus file type] (str)
+        :param duration: seconds (int) or [HH:]MM:SS (str)
+        :param add_ts: whether to add timestamp to filebase (bool)
+        :param dryrun: do not write file or wait (bool)
+        :return: pathname of (empty) output file
+        """
+        if not hasattr(cls, 'name') or not hasattr(cls, 'info'):
+            raise RuntimeError("%s must be obtained through Streamer.get()" % (cls.__name__))
+        media_info = cls.info['media_types'][media_type]
+        if add_ts:
+            filebase += dt.datetime.now().strftime('%m%d%H%M')
+        fileout = filebase + '.' + media_info['file_type']
+        if isinstance(duration, str):
+            duration = str2timedelta(duration).seconds
+        if dryrun:
+            return fileout
+
+        open(fileout, 'wb').close()
+        mark(Stage.SPAWN)
+        time.sleep(duration)
+        mark(Stage.EXIT)
         return fileout
 
 #####################
@@ -134,7 +350,7 @@ class VlcStreamer(Streamer):
 #####################
 
 import click
-from core import dbg_hand
+from core import debug_logging
 
 @click.command()
 @click.option('--media_type', required=True, help="Stream content-type (e.g. audio/aacp)")
@@ -149,8 +365,7 @@ def main(media_type, filebase, duration, add_ts, force, dryrun, debug, url):
     """Command line for saving audio stream to a file
     """
     if debug > 0:
-        log.setLevel(logging.DEBUG)
-        log.addHandler(dbg_hand)
+        debug_logging(logging.DEBUG)
 
     if re.fullmatch(r'\d+', duration):
         duration = int(duration)
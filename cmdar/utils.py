@@ -2,7 +2,10 @@
 
 import logging
 import json
+import copy
 import re
+import urllib.request
+import urllib.error
 import datetime as dt
 
 import yaml
@@ -49,6 +52,18 @@ class Config(object):
 
         return Config.cfg_profiles[self.path][profile].get(section, {})
 
+    def add_profile(self, name, sections, base = None):
+        """Register a derived profile (not in the config file), e.g. for test harnesses
+
+        :param name: profile name
+        :param sections: dict of sections to replace in the base profile
+        :param base: [optional] profile to derive from (None means ``default``)
+        """
+        self.config('default', base)
+        prof_data = copy.deepcopy(Config.cfg_profiles[self.path][base])
+        prof_data.update(sections)
+        Config.cfg_profiles[self.path][name] = prof_data
+
 ################
 # util classes #
 ################
@@ -239,6 +254,38 @@ class MyLogger(logging.getLoggerClass()):
 
 logging.setLoggerClass(MyLogger)
 
+########
+# HTTP #
+########
+
+def conditional_get(url, etag = None, last_modified = None, timeout = 10):
+    """HTTP GET with conditional revalidation (also works for ``file:`` URLs, for which
+    the file modification time is used as ``Last-Modified``)
+
+    :param url: URL to fetch
+    :param etag: ``ETag`` from previous response (or None)
+    :param last_modified: ``Last-Modified`` from previous response (or None)
+    :param timeout: secs
+    :return: tuple(body, etag, last_modified), with body None if not modified
+    """
+    req = urllib.request.Request(url)
+    if etag:
+        req.add_header('If-None-Match', etag)
+    if last_modified:
+        req.add_header('If-Modified-Since', last_modified)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            new_etag = resp.headers.get('ETag')
+            new_modified = resp.headers.get('Last-Modified')
+            if (new_etag or new_modified) and (new_etag, new_modified) == (etag, last_modified):
+                # e.g. ``file:`` URLs, which do not honor conditional headers
+                return None, etag, last_modified
+            return resp.read(), new_etag, new_modified
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, etag, last_modified
+        raise
+
 ########
 # Misc #
 ########
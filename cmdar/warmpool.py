@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""Warm pool - pre-warmed capture sources for manual ("record now") recordings
+
+A manual recording through a regular streamer pays for process start, DNS lookup,
+connecting and buffering before any audio is written.  With the warm pool enabled,
+manual recordings are instead made by the pool's streamer (``RelayStreamer``, see
+``streamer.py``), which writes the stream in-process from a relay pump (see ``relay.py``):
+no process is started, and for the ``stations`` listed in the config, the upstream
+connection is kept open (and buffered) at all times, so audio is written right away (the
+recording starts with up to ``relay.burst`` KB of audio received just before the request).
+Manual recordings run on their own executor (``workers`` threads), so they are never
+queued behind scheduled captures.
+
+The pool shares the relay hub, if the relay is enabled.  Only media types defined for the
+pool's streamer (raw frame-based formats, i.e. MP3 and ADTS AAC) can be recorded this
+way; other manual recordings fall back to the regular streamer.
+"""
+
+import threading
+
+from core import cfg, log
+import relay
+
+##########
+# config #
+##########
+
+WARM_DFLTS = {'enabled'   : False,
+              'streamer'  : 'relay',  # streamer name in config.yml
+              'workers'   : 2,        # threads for manual recordings
+              'stations'  : [],       # kept connected
+              'check_secs': 30}       # secs (between checks of warm connections)
+
+def warm_params(cfg_profile = None):
+    """Get warm pool parameters (config overlaid on defaults)
+
+    :param cfg_profile: optional (None means ``default``)
+    :return: dict
+    """
+    params = dict(WARM_DFLTS)
+    params.update(cfg.config('warm_pool', cfg_profile))
+    return params
+
+############
+# WarmPool #
+############
+
+# warm pool for the current process (set up by ``Dar``)
+pool = None
+
+class WarmPool(object):
+    """Relay pumps for warm stations, each held open by a keeper (a listener that never
+    reads, so the pump is never idle, and is not subject to eviction)
+    """
+    def __init__(self, stations, cfg_profile = None):
+        """
+        :param stations: ``stations`` config
+        :param cfg_profile: optional (None means ``default``)
+        """
+        self.stations    = stations
+        self.cfg_profile = cfg_profile
+        self.params      = warm_params(cfg_profile)
+        self.own_hub     = relay.hub is None
+        self.hub         = relay.hub or relay.RelayHub(stations, cfg_profile)
+        self.keepers     = {}     # station -> Listener
+        self.lock        = threading.Lock()
+
+    def warm(self, station):
+        """Open (or reopen) connection for warm station
+
+        :param station: station name
+        """
+        with self.lock:
+            keeper = self.keepers.get(station)
+            if keeper and not keeper.closed and keeper.pump.alive:
+                return
+            if keeper:
+                keeper.close()
+            try:
+                _, self.keepers[station] = self.hub.listen(station)
+                log.info("Warm pool connection for \"%s\" opened" % (station))
+            except (KeyError, RuntimeError) as e:
+                self.keepers.pop(station, None)
+                log.info("Could not warm station \"%s\": %s" % (station, e))
+
+    def check(self):
+        """Reopen warm connections whose pump has exited (invoked as an interval job)
+        """
+        for station in self.params['stations']:
+            self.warm(station)
+
+    def start(self, sched, jobstore, executor):
+        """Open warm connections, and schedule checks on them
+
+        :param sched: apscheduler handle
+        :param jobstore: job store alias (should be non-persistent)
+        :param executor: executor alias (should be separate from capture jobs)
+        """
+        self.check()
+        sched.add_job(self.check, 'interval', seconds=self.params['check_secs'],
+                      id='warm_pool', name='Warm pool check', jobstore=jobstore,
+                      executor=executor, replace_existing=True, coalesce=True, max_instances=1)
+
+    def stop(self):
+        with self.lock:
+            for keeper in self.keepers.values():
+                keeper.close()
+            self.keepers = {}
+        if self.own_hub:
+            self.hub.stop()
+
+    def listen(self, station):
+        """
+        :param station: station name
+        :return: tuple (media type, ``relay.Listener``)
+        """
+        return self.hub.listen(station)
+
+    def get_status(self):
+        """
+        :return: dict with warm stations, and status of active pumps
+        """
+        with self.lock:
+            warm = sorted(station for station, keeper in self.keepers.items()
+                          if not keeper.closed and keeper.pump.alive)
+        return {'warm': warm, 'relays': self.hub.get_status()}
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+"""Shared fixtures
+"""
+
+import os
+import sys
+import copy
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'cmdar'))
+
+from core import cfg
+from utils import Config
+
+PROFILE = 'test'
+
+@pytest.fixture
+def station():
+    """
+    :return: name of first configured station
+    """
+    return next(iter(cfg.config('stations')))
+
+@pytest.fixture
+def profile(tmp_path):
+    """Config profile (``default`` overlaid with scheduler paths in ``tmp_path``, and no
+    programs); may be modified by the test before creating ``Dar``
+
+    :return: dict (config sections), registered as profile ``PROFILE``
+    """
+    prof = copy.deepcopy(Config.cfg_profiles[cfg.path][None])
+    prof['scheduler'] = {'db_dir': str(tmp_path), 'db_file': 'aps.db',
+                         'rec_dir': str(tmp_path), 'catalog_file': 'catalog.db'}
+    prof['programs'] = {}
+    Config.cfg_profiles[cfg.path][PROFILE] = prof
+    yield prof
+    del Config.cfg_profiles[cfg.path][PROFILE]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for dead air detection (``audio.py``)
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'cmdar'))
+
+from audio import find_loops, DEAD_AIR_DFLTS
+
+WINDOW = 0.25   # secs (envelope window)
+
+def looped_envelope(period, total, noise = 0.0, seed = 0):
+    """
+    :param period: loop period (secs)
+    :param total: length of envelope (secs)
+    :param noise: std dev of noise added to each window (dB)
+    :return: np.ndarray (RMS envelope in dBFS)
+    """
+    rng = np.random.default_rng(seed)
+    pattern = rng.normal(-20.0, 6.0, int(period / WINDOW))
+    env = np.tile(pattern, int(total / period) + 1)[:int(total / WINDOW)]
+    if noise:
+        env = env + rng.normal(0.0, noise, env.size)
+    return env.astype(np.float32)
+
+def detect(env):
+    return find_loops(env, WINDOW, DEAD_AIR_DFLTS['loop_min'], DEAD_AIR_DFLTS['loop_max'],
+                      DEAD_AIR_DFLTS['loop_corr'], DEAD_AIR_DFLTS['loop_tol'])
+
+@pytest.mark.parametrize('period', [25, 60, 97, 150])
+@pytest.mark.parametrize('noise', [0.0, 1.0])
+def test_loop_period(period, noise):
+    loops = detect(looped_envelope(period, 3600, noise))
+    assert loops
+    # period reported is the loop itself, not a multiple of it
+    assert {loop[2] for loop in loops} == {float(period)}
+
+def test_no_loop():
+    rng = np.random.default_rng(1)
+    assert detect(rng.normal(-20.0, 6.0, int(3600 / WINDOW)).astype(np.float32)) == []
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for cluster claims (``cluster.py``), with nodes in separate processes sharing a
+single SQLite job store
+"""
+
+import os
+import sys
+import time
+import multiprocessing
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'cmdar'))
+
+from cluster import ClusterNode
+from dar import Dar, INTERNAL_JOBSTORE
+from conftest import PROFILE
+
+mp = multiprocessing.get_context('fork')
+
+SPEC = {'args': ['vlc', None, 'http://example.com/stream', 'audio/mpeg', '/tmp/test'],
+        'kwargs': {'job_id': 'once', 'station': 'TEST', 'redundancy': 1}}
+
+def race(db_url, node_id, job_id, barrier, results):
+    """Claim occurrence of job (in child process), as close to simultaneously with the
+    other nodes as possible
+    """
+    node = ClusterNode(db_url, node_id)
+    barrier.wait()
+    results.put((node_id, node.claim(job_id, 60, spec=SPEC)))
+
+def claim_and_die(db_url, node_id, job_id, lease):
+    """Claim occurrence of job (in child process), and exit without renewing the lease
+    """
+    node = ClusterNode(db_url, node_id, lease=lease)
+    assert node.claim(job_id, 60, spec=SPEC)
+
+@pytest.fixture
+def db_url(tmp_path):
+    return 'sqlite:///' + str(tmp_path / 'aps.db')
+
+@pytest.mark.parametrize('nodes', [2, 4])
+def test_claim_race(db_url, nodes):
+    ClusterNode(db_url)  # create schema before the race
+    for i in range(5):
+        job_id = 'job%d' % (i)
+        barrier = mp.Barrier(nodes)
+        results = mp.Queue()
+        procs = [mp.Process(target=race, args=(db_url, 'node%d' % (n), job_id, barrier, results))
+                 for n in range(nodes)]
+        for proc in procs:
+            proc.start()
+        claims = [results.get(timeout=30) for proc in procs]
+        for proc in procs:
+            proc.join(timeout=30)
+            assert proc.exitcode == 0
+        winners = [node_id for node_id, claim in claims if claim]
+        assert len(winners) == 1
+
+def test_takeover_after_lease(db_url):
+    lease = 1
+    proc = mp.Process(target=claim_and_die, args=(db_url, 'dead', 'once', lease))
+    proc.start()
+    proc.join(timeout=30)
+    assert proc.exitcode == 0
+
+    node = ClusterNode(db_url, 'live', lease=lease, min_remaining=0)
+    assert node.find_uncovered() == []
+    time.sleep(lease + 0.5)
+    claims = node.find_uncovered()
+    assert len(claims) == 1
+    assert claims[0]['job_id'] == 'once' and claims[0]['slot'] == 0
+    assert claims[0]['spec'] == SPEC
+    # now covered by the live node
+    assert node.find_uncovered() == []
+
+def test_takeover_one_off(profile):
+    """Takeover of a job that is no longer in the job store (e.g. one-off job) uses the
+    recording args kept with the claim
+    """
+    dar = Dar('vlc', cfg_profile=PROFILE)
+    dar.sched.start(paused=True)
+    try:
+        dar.takeover({'job_id': 'once', 'run_time': time.time() - 60, 'slot': 0,
+                      'end_time': time.time() + 120, 'spec': SPEC})
+        jobs = [job for job in dar.sched.get_jobs(INTERNAL_JOBSTORE)
+                if job.name.endswith('[takeover]')]
+        assert len(jobs) == 1
+        assert list(jobs[0].args[:-1]) == SPEC['args']
+        assert 110 <= jobs[0].args[-1] <= 120
+        assert jobs[0].kwargs['claim']['job_id'] == 'once'
+        assert jobs[0].kwargs['station'] == 'TEST'
+    finally:
+        dar.sched.shutdown(wait=False)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the event bus (``events.py``)
+"""
+
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'cmdar'))
+
+from events import EventBus, sse_format
+
+def take(bus, last_id, count):
+    """
+    :return: list of event IDs from subscription (up to ``count``)
+    """
+    stop = threading.Event()
+    ids = []
+    for event in bus.subscribe(last_id, keepalive=0.01, stop=stop):
+        if event is None:
+            break
+        ids.append(event[0])
+        if len(ids) == count:
+            stop.set()
+    return ids
+
+def test_replay():
+    bus = EventBus()
+    for i in range(5):
+        bus.publish('job_added', {'n': i})
+    assert take(bus, 0, 10) == [1, 2, 3, 4, 5]
+    assert take(bus, 3, 10) == [4, 5]
+    assert take(bus, None, 10) == []
+
+def test_replay_after_restart():
+    old = EventBus()
+    for i in range(50):
+        old.publish('job_added', {'n': i})
+    last_seen = sse_format(old.buffer[-1], old.epoch).split('\n')[0][len('id: '):]
+
+    # new process: fewer events than the client saw
+    bus = EventBus()
+    bus.epoch = old.epoch + 1
+    for i in range(3):
+        bus.publish('job_added', {'n': i})
+    assert bus.parse_id(last_seen) == 0
+    assert take(bus, bus.parse_id(last_seen), 10) == [1, 2, 3]
+    # unprefixed ID past the end of the current sequence
+    assert take(bus, bus.parse_id('50'), 10) == [1, 2, 3]
+    # same epoch
+    assert take(bus, bus.parse_id("%d-2" % (bus.epoch)), 10) == [3]
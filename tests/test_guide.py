@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for program guide import (``guide.py``, ``Dar.sync_guides()``)
+"""
+
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'cmdar'))
+
+from guide import GuideCache, GUIDE_PREFIX
+from dar import Dar, JOBSTORE
+from conftest import PROFILE
+
+def write_guide(path, entries):
+    with open(path, 'w') as f:
+        json.dump({'programs': entries}, f)
+
+@pytest.fixture
+def guide_dar(tmp_path, profile, station):
+    """Dar for test profile, with a guide (``file:`` URL) for one station
+    """
+    guide_path = str(tmp_path / 'guide.json')
+    profile['guides'] = {'enabled': True, 'cache_file': 'guides.json',
+                         'stations': {station: {'url': 'file://' + guide_path}}}
+    dar = Dar('vlc', cfg_profile=PROFILE)
+    yield dar, guide_path
+    dar.sched.shutdown(wait=False)
+
+def test_sync_guides_bad_entries(guide_dar, station):
+    dar, guide_path = guide_dar
+    write_guide(guide_path, [
+        {'title': 'Good Show', 'days': 'mon', 'start_time': '10:00', 'duration': 3600},
+        {'title': 'Bad Days', 'days': 'xyz', 'start_time': '10:00', 'duration': 3600},
+        {'title': 'Bad Time', 'days': 'tue', 'start_time': '10am', 'duration': 3600},
+        {'title': 'No Duration', 'days': 'wed', 'start_time': '10:00'},
+        {'days': 'thu', 'start_time': '10:00', 'duration': 3600},
+        'not a program'])
+    res = dar.sync_guides()
+    assert len(res['created']) == 1
+    label = res['created'].pop()
+    assert label.startswith("%s%s:Good Show" % (GUIDE_PREFIX, station))
+    assert [job.id for job in dar.sched.get_jobs(JOBSTORE)] == [label]
+
+def test_guide_cache_titles(tmp_path, station):
+    guide_path = str(tmp_path / 'guide.json')
+    write_guide(guide_path, [
+        {'title': 'Morning Show', 'days': 'mon', 'start_time': '08:00', 'duration': 3600},
+        {'title': 'Evening Show', 'days': 'mon', 'start_time': '18:00', 'duration': 3600}])
+    cache = GuideCache(str(tmp_path / 'guides.json'))
+    info = {'url': 'file://' + guide_path, 'titles': ['morning']}
+    assert len(cache.fetch(station, info)) == 1
+    # guide unchanged, but the title filter is applied to the new config
+    info['titles'] = ['morning', 'evening']
+    assert len(cache.fetch(station, info)) == 2
+    del info['titles']
+    assert len(cache.fetch(station, info)) == 2